@@ -0,0 +1,131 @@
+"""
+Benchmark the bin-matching kernel of `calculate_prr.compute_ABCD_one_drug`
+against the original set-based implementation, and the block engine
+`calculate_prr.compute_ABCD_drug_block`, on a synthetic matrix the size of
+FAERS (4,694,086 reports x 17,000 outcomes by default).
+
+Usage: python benchmark_abcd.py [n_reports] [n_outcomes] [n_drugs]
+"""
+import collections
+import sys
+import time
+
+import numpy as np
+import scipy.sparse
+
+sys.path.insert(0, '../src/')
+import calculate_prr  # noqa:E402
+
+
+def compute_ABCD_one_drug_sets(drug_exposures, drug_propensity_scores,
+                               all_outcomes, bins=np.arange(0, 1.2, 0.2),
+                               seed=0, ordered=False):
+    """
+    Original set-based implementation, kept for comparison. With `ordered`,
+    unexposed candidates are sampled in ascending order instead of in the
+    (hash table dependent) iteration order of a Python set.
+    """
+    exposed_indices, _ = drug_exposures.nonzero()
+    binned_scores = np.digitize(drug_propensity_scores, bins=bins)
+    exposed_bin_freq = collections.Counter(binned_scores[exposed_indices])
+    np.random.seed(seed)
+    matched_exposed_indices = list()
+    matched_unexposed_indices = list()
+    for bin_number, num_exposed_bin in exposed_bin_freq.items():
+        if num_exposed_bin == 0:
+            continue
+        reports_in_bin = np.where(binned_scores == bin_number)[0]
+        reports_in_bin = set(reports_in_bin.tolist())
+        available_unexposed_indices = reports_in_bin - set(exposed_indices)
+        if len(available_unexposed_indices) == 0:
+            continue
+        bin_exposed_indices = reports_in_bin.intersection(set(exposed_indices))
+        matched_exposed_indices.extend(list(bin_exposed_indices))
+        num_unexposed = 10 * num_exposed_bin
+        available_unexposed_indices = (sorted(available_unexposed_indices)
+                                       if ordered else
+                                       list(available_unexposed_indices))
+        unexposed_sample = np.random.choice(available_unexposed_indices,
+                                            size=num_unexposed, replace=True)
+        matched_unexposed_indices.extend(unexposed_sample)
+    n_exposed = len(matched_exposed_indices)
+    exposed_with_outcome = all_outcomes[matched_exposed_indices].sum(axis=0)
+    exposed_with_outcome = np.array(exposed_with_outcome).flatten()
+    n_unexposed = len(matched_unexposed_indices)
+    unexposed_with_outcome = all_outcomes[matched_unexposed_indices].sum(axis=0)
+    unexposed_with_outcome = np.array(unexposed_with_outcome).flatten()
+    return exposed_with_outcome, n_exposed, unexposed_with_outcome, n_unexposed
+
+
+def make_synthetic_data(n_reports, n_outcomes, n_drugs, outcomes_per_report=3,
+                        seed=0):
+    """Random outcome matrix, exposure columns and propensity scores"""
+    rng = np.random.RandomState(seed)
+    nnz = n_reports * outcomes_per_report
+    outcome_matrix = scipy.sparse.csc_matrix(
+        (np.ones(nnz), (rng.randint(0, n_reports, nnz),
+                        rng.randint(0, n_outcomes, nnz))),
+        shape=(n_reports, n_outcomes)
+    )
+    outcome_matrix.data[:] = 1
+
+    # Exposure frequencies spanning rare to very common drugs
+    n_exposed = np.geomspace(100, n_reports // 20, n_drugs).astype(int)
+    drugs = list()
+    for n in n_exposed:
+        rows = np.unique(rng.randint(0, n_reports, n))
+        exposures = scipy.sparse.csc_matrix(
+            (np.ones(len(rows)), (rows, np.zeros(len(rows), dtype=int))),
+            shape=(n_reports, 1)
+        )
+        scores = rng.beta(2, 5, n_reports)
+        scores[rows] = rng.beta(5, 2, len(rows))
+        drugs.append((exposures, scores))
+    return outcome_matrix, drugs
+
+
+def time_function(function, drugs, outcome_matrix):
+    results = list()
+    start = time.perf_counter()
+    for exposures, scores in drugs:
+        results.append(function(exposures, scores, outcome_matrix))
+    return time.perf_counter() - start, results
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    n_reports, n_outcomes, n_drugs = args + [4_694_086, 17_000, 5][len(args):]
+
+    print(f'Generating {n_reports} x {n_outcomes} outcomes, {n_drugs} drugs')
+    outcome_matrix, drugs = make_synthetic_data(n_reports, n_outcomes, n_drugs)
+
+    vectorized_time, vectorized = time_function(
+        calculate_prr.compute_ABCD_one_drug, drugs, outcome_matrix)
+    sets_time, _ = time_function(
+        compute_ABCD_one_drug_sets, drugs, outcome_matrix)
+    start = time.perf_counter()
+    block = calculate_prr.compute_ABCD_drug_block(drugs, outcome_matrix)
+    block_time = time.perf_counter() - start
+
+    # Same seed must give identical A, A + B, C and C + D. The vectorized
+    #  kernel samples candidates in ascending order, so it is compared to the
+    #  original with that same candidate order.
+    for (exposures, scores), new in zip(drugs, vectorized):
+        old = compute_ABCD_one_drug_sets(exposures, scores, outcome_matrix,
+                                         ordered=True)
+        assert np.array_equal(new[0], old[0]) and new[1] == old[1]
+        assert np.array_equal(new[2], old[2]) and new[3] == old[3]
+    for i, new in enumerate(vectorized):
+        assert all(np.array_equal(new[j], block[j][i]) for j in range(4))
+    print('A, A + B, C, C + D identical for all drugs')
+
+    print(f'Set-based:  {sets_time:8.2f} s ({n_drugs / sets_time:.2f} drugs/s)')
+    print(f'Vectorized: {vectorized_time:8.2f} s '
+          f'({n_drugs / vectorized_time:.2f} drugs/s)')
+    print(f'Block:      {block_time:8.2f} s ({n_drugs / block_time:.2f} drugs/s)')
+    print(f'Speedup:    {sets_time / vectorized_time:8.1f}x (vectorized), '
+          f'{sets_time / block_time:.1f}x (block)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark gathering and summing the outcome rows of a set of reports (as
+`calculate_prr.compute_ABCD_one_drug` does for the matched reports of each
+drug) with the outcome matrix in the layout built by
+`1.format_outcomes_data.ipynb` (CSC, float64 entries, int64 indices) and in
+the layout of `matrices.prepare_outcome_matrix` (CSR, bool entries, int32
+indices), on a synthetic matrix the size of FAERS (4,694,086 reports x
+17,000 outcomes by default).
+
+Usage: python benchmark_layout.py [n_reports] [n_outcomes] [n_gathers]
+"""
+import sys
+import time
+
+import numpy as np
+import scipy.sparse
+
+sys.path.insert(0, '../src/')
+import matrices  # noqa:E402
+
+# Numbers of reports gathered, from a rare drug to a very common one (or the
+#  10x unexposed reports matched to it)
+GATHER_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+
+def make_notebook_matrix(n_reports, n_outcomes, outcomes_per_report=3,
+                         seed=0):
+    """Random outcome matrix as built by the notebook, a COO -> CSC of ones"""
+    rng = np.random.RandomState(seed)
+    nnz = n_reports * outcomes_per_report
+    matrix = scipy.sparse.coo_matrix(
+        (np.ones(nnz), (rng.randint(0, n_reports, nnz).astype(np.int64),
+                        rng.randint(0, n_outcomes, nnz).astype(np.int64))),
+        shape=(n_reports, n_outcomes)
+    ).tocsc()
+    matrix.data[:] = 1
+    matrix.indices = matrix.indices.astype(np.int64)
+    matrix.indptr = matrix.indptr.astype(np.int64)
+    return matrix
+
+
+def matrix_megabytes(matrix):
+    return sum(getattr(matrix, attribute).nbytes
+               for attribute in ('data', 'indices', 'indptr')) / 1e6
+
+
+def time_gathers(matrix, gathers):
+    """Seconds to gather and sum the rows of each set of reports"""
+    sums = list()
+    start = time.perf_counter()
+    for report_indices in gathers:
+        sums.append(np.asarray(matrix[report_indices].sum(axis=0)).ravel())
+    return time.perf_counter() - start, sums
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    n_reports, n_outcomes, n_gathers = args + [4_694_086, 17_000, 3][len(args):]
+
+    print(f'Generating {n_reports} x {n_outcomes} outcomes')
+    notebook = make_notebook_matrix(n_reports, n_outcomes)
+    layouts = {
+        'CSC float64 (notebook)': notebook,
+        'CSR float64': notebook.tocsr(),
+        'CSR bool int32 (prepared)': matrices.prepare_outcome_matrix(notebook),
+    }
+    for name, matrix in layouts.items():
+        print(f'{name:28} {matrix_megabytes(matrix):9.1f} MB')
+
+    rng = np.random.RandomState(1)
+    print(f'\n{"Reports gathered":28}' + ''.join(
+        f'{n:>14,}' for n in GATHER_SIZES) + '   (rows/s)')
+    reference = None
+    for name, matrix in layouts.items():
+        rates = list()
+        all_sums = list()
+        for n in GATHER_SIZES:
+            gathers = [np.sort(rng.randint(0, n_reports, min(n, n_reports)))
+                       for _ in range(n_gathers)]
+            seconds, sums = time_gathers(matrix, gathers)
+            rates.append(n * n_gathers / seconds)
+            all_sums.append((gathers, sums))
+        print(f'{name:28}' + ''.join(f'{rate:14,.0f}' for rate in rates))
+
+        # Every layout must give the same sums for the same reports
+        if reference is None:
+            reference = layouts[name]
+        for gathers, sums in all_sums:
+            _, reference_sums = time_gathers(reference, gathers)
+            assert all(np.array_equal(a, b)
+                       for a, b in zip(sums, reference_sums))
+    print('Sums identical for all layouts')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""
+Benchmark the main steps of the pipeline on deterministic synthetic data
+(`src/synthetic.py`) at several scales, reporting throughput and peak
+memory. Each benchmark runs in a fresh process, so peak memory (the maximum
+resident set size of the process and its workers) is its own.
+
+Results can be saved as a JSON baseline and later runs compared to it:
+
+    python benchmark_pipeline.py small --save baselines/small.json
+    python benchmark_pipeline.py small --compare baselines/small.json
+
+Usage: python benchmark_pipeline.py [scale] [--only NAME ...] [--save PATH]
+                                    [--compare PATH] [--tolerance FRACTION]
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import pathlib
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse
+
+sys.path.insert(0, '../src/')
+import calculate_prr  # noqa:E402
+import checkpoint  # noqa:E402
+import matrices  # noqa:E402
+import parallel_utils  # noqa:E402
+import prr_io  # noqa:E402
+import synthetic  # noqa:E402
+import utils  # noqa:E402
+
+SCRIPTS_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath('scripts')
+
+# (reports, drugs, outcomes), the OFFSIDES drugs in archives and TWOSIDES
+#  pairs, and the drugs used for the per-drug kernels
+SCALES = {
+    'tiny': dict(n_reports=5_000, n_drugs=50, n_outcomes=500,
+                 n_archive_drugs=10, n_pairs=20, n_kernel_drugs=10),
+    'small': dict(n_reports=100_000, n_drugs=500, n_outcomes=2_000,
+                  n_archive_drugs=40, n_pairs=200, n_kernel_drugs=40),
+    'medium': dict(n_reports=1_000_000, n_drugs=2_000, n_outcomes=10_000,
+                   n_archive_drugs=40, n_pairs=1_000, n_kernel_drugs=40),
+    'faers': dict(n_reports=synthetic.FAERS_SHAPE[0],
+                  n_drugs=synthetic.FAERS_SHAPE[1],
+                  n_outcomes=synthetic.FAERS_SHAPE[2],
+                  n_archive_drugs=20, n_pairs=2_000, n_kernel_drugs=40),
+}
+
+
+def _load_script(file_name, module_name):
+    """Import a pipeline script, whose file name is not a module name"""
+    spec = importlib.util.spec_from_file_location(
+        module_name, SCRIPTS_PATH.joinpath(file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_data(data_path, scale):
+    """Write the synthetic data for a scale as in the `/data` tree"""
+    parameters = SCALES[scale]
+    data = synthetic.make_dataset(parameters['n_reports'], parameters['n_drugs'],
+                                  parameters['n_outcomes'])
+    synthetic.write_meta(data, data_path.joinpath('meta/'))
+
+    # Drugs spanning common to rare, for the archives and per-drug kernels
+    n_exposed = np.diff(data.exposures.indptr)
+    by_frequency = np.argsort(-n_exposed, kind='stable')
+    for name in ('archive', 'kernel'):
+        n = parameters[f'n_{name}_drugs']
+        drugs = by_frequency[np.linspace(0, len(by_frequency) - 1, n).astype(int)]
+        np.save(data_path.joinpath(f'meta/{name}_drugs.npy'), np.sort(drugs))
+
+    synthetic.write_offsides_archives(
+        data, data_path.joinpath('archives/1/'),
+        drugs=np.load(data_path.joinpath('meta/archive_drugs.npy')),
+        drugs_per_archive=5)
+    synthetic.write_twosides_archives(
+        data, data_path.joinpath('archives/2/'),
+        synthetic.common_pairs(data, parameters['n_pairs']))
+    synthetic.write_scores(data, data_path.joinpath('scores/1/'),
+                           drugs=np.load(data_path.joinpath('meta/kernel_drugs.npy')))
+
+
+def _load_kernel_inputs(data_path):
+    meta_path = data_path.joinpath('meta/')
+    exposures = matrices.load_exposure_matrix(
+        meta_path.joinpath('drug_exposure_matrix.npz'))
+    outcomes = matrices.load_outcome_matrix(
+        meta_path.joinpath('outcome_matrix.npz'))
+    drugs = np.load(meta_path.joinpath('kernel_drugs.npy'))
+    scores = [utils.load_scores_offsides(drug, exposures.shape[0],
+                                         data_path.joinpath('scores/1/'))
+              for drug in drugs]
+    return exposures, outcomes, drugs, scores
+
+
+# Each benchmark takes the data directory and a scratch directory, does its
+#  (untimed) setup, and returns a function to time, which returns the number
+#  of units processed, and the name of those units
+
+def bench_compute_ABCD_one_drug(data_path, work_path):
+    exposures, outcomes, drugs, scores = _load_kernel_inputs(data_path)
+
+    def run():
+        for drug, drug_scores in zip(drugs, scores):
+            calculate_prr.compute_ABCD_one_drug(exposures[:, drug], drug_scores,
+                                                outcomes)
+        return len(drugs)
+    return run, 'drugs'
+
+
+def bench_compute_ABCD_expected(data_path, work_path):
+    exposures, outcomes, drugs, scores = _load_kernel_inputs(data_path)
+
+    def run():
+        for drug, drug_scores in zip(drugs, scores):
+            calculate_prr.compute_ABCD_one_drug(exposures[:, drug], drug_scores,
+                                                outcomes, matching='expected')
+        return len(drugs)
+    return run, 'drugs'
+
+
+def bench_compute_ABCD_quantile_bins(data_path, work_path):
+    exposures, outcomes, drugs, scores = _load_kernel_inputs(data_path)
+
+    def run():
+        for drug, drug_scores in zip(drugs, scores):
+            calculate_prr.compute_ABCD_one_drug(
+                exposures[:, drug], drug_scores, outcomes,
+                matching=calculate_prr.QuantileBins(20))
+        return len(drugs)
+    return run, 'drugs'
+
+
+def bench_compute_ABCD_resampled(data_path, work_path):
+    exposures, outcomes, drugs, scores = _load_kernel_inputs(data_path)
+
+    def run():
+        for drug, drug_scores in zip(drugs, scores):
+            calculate_prr.compute_ABCD_resampled(
+                exposures[:, drug], drug_scores, outcomes, n_resamples=50)
+        return len(drugs)
+    return run, 'drugs'
+
+
+def bench_compute_ABCD_drug_block(data_path, work_path):
+    exposures, outcomes, drugs, scores = _load_kernel_inputs(data_path)
+
+    def run():
+        for start in range(0, len(drugs), 16):
+            calculate_prr.compute_ABCD_drug_block(
+                [(exposures[:, drug], drug_scores) for drug, drug_scores
+                 in zip(drugs[start:start + 16], scores[start:start + 16])],
+                outcomes)
+        return len(drugs)
+    return run, 'drugs'
+
+
+def bench_compute_prr(data_path, work_path):
+    exposures, outcomes, drugs, scores = _load_kernel_inputs(data_path)
+    inputs = [calculate_prr.compute_ABCD_one_drug(exposures[:, drug],
+                                                  drug_scores, outcomes)
+              for drug, drug_scores in zip(drugs, scores)]
+
+    def run():
+        for A, a_plus_b, C, c_plus_d in inputs:
+            calculate_prr.compute_prr(A, a_plus_b, C, c_plus_d)
+        return len(inputs) * outcomes.shape[1]
+    return run, 'rows'
+
+
+def bench_compute_file_map(data_path, work_path):
+    compute_file_maps = _load_script('1.compute_file_maps.py',
+                                     'compute_file_maps')
+
+    def run():
+        file_map = compute_file_maps.compute_file_map(
+            2, data_path.joinpath('archives/2/'))
+        return len(file_map)
+    return run, 'members'
+
+
+def bench_prr_one_archive_twosides(data_path, work_path):
+    compute_prr = _load_script('3.compute_prr.py', 'compute_prr')
+    exposures = matrices.load_exposure_matrix(
+        data_path.joinpath('meta/drug_exposure_matrix.npz'))
+    outcomes = matrices.load_outcome_matrix(
+        data_path.joinpath('meta/outcome_matrix.npz'))
+    drug_id_vector = np.load(data_path.joinpath('meta/drug_id_vector.npy'))
+    outcome_id_vector = np.load(data_path.joinpath('meta/outcome_id_vector.npy'))
+    archive_paths = sorted(data_path.joinpath('archives/2/').glob('*.tgz'))
+
+    def run():
+        for archive_path in archive_paths:
+            compute_prr.prr_one_archive_twosides(
+                archive_path, None, exposures, outcomes, drug_id_vector,
+                outcome_id_vector, work_path, 'csv')
+        return len(list(work_path.glob('*.csv.xz')))
+    return run, 'pairs'
+
+
+def bench_average_propensity_scores(data_path, work_path):
+    compute_propensity_scores = _load_script('2.compute_propensity_scores.py',
+                                             'compute_propensity_scores')
+    for name in ('meta', 'scores', 'partial'):
+        work_path.joinpath(name).mkdir()
+
+    def run():
+        compute_propensity_scores.compute_propensity_scores_archive_major(
+            work_path.joinpath('meta/'), data_path.joinpath('archives/1/'),
+            work_path.joinpath('scores/'), work_path.joinpath('partial/'))
+        return len(np.load(data_path.joinpath('meta/archive_drugs.npy')))
+    return run, 'drugs'
+
+
+def bench_compute_multi_exposure(data_path, work_path):
+    exposures = matrices.load_exposure_matrix(
+        data_path.joinpath('meta/drug_exposure_matrix.npz'))
+    drugs = np.load(data_path.joinpath('meta/kernel_drugs.npy'))
+    combinations = [(a, b) for i, a in enumerate(drugs) for b in drugs[i + 1:]]
+    combinations += [(a, b, c) for a, b, c in zip(drugs, drugs[1:], drugs[2:])]
+
+    def run():
+        for combination in combinations:
+            utils.compute_multi_exposure(combination, exposures)
+        return len(combinations)
+    return run, 'combinations'
+
+
+def bench_combine_prr_files(data_path, work_path):
+    combine_prr_clean = _load_script('4.combine_prr_clean.py',
+                                     'combine_prr_clean')
+    exposures, outcomes, drugs, _ = _load_kernel_inputs(data_path)
+    drug_id_vector = np.load(data_path.joinpath('meta/drug_id_vector.npy'))
+    outcome_id_vector = np.load(data_path.joinpath('meta/outcome_id_vector.npy'))
+    prr_path = work_path.joinpath('prr/')
+    prr_path.mkdir()
+    for drug in drugs:
+        parallel_utils.prr_one_drug(
+            drug, exposures, outcomes, exposures.shape[0], drug_id_vector,
+            outcome_id_vector, data_path.joinpath('scores/1/'), prr_path,
+            output_format='npz')
+    n_rows = sum(len(prr_io.read_npz_indices(path))
+                 for path in prr_path.glob('*.npz'))
+
+    def run():
+        with checkpoint.TaskManifest(
+                work_path.joinpath('4.tables.jsonl')) as manifest:
+            combine_prr_clean.combine_prr_files(
+                prr_path, work_path.joinpath('tables/offsides.csv.xz'),
+                drug_id_vector, outcome_id_vector, manifest)
+        return n_rows
+    return run, 'rows'
+
+
+BENCHMARKS = {
+    'compute_ABCD_one_drug': bench_compute_ABCD_one_drug,
+    'compute_ABCD_expected': bench_compute_ABCD_expected,
+    'compute_ABCD_quantile_bins': bench_compute_ABCD_quantile_bins,
+    'compute_ABCD_resampled': bench_compute_ABCD_resampled,
+    'compute_ABCD_drug_block': bench_compute_ABCD_drug_block,
+    'compute_prr': bench_compute_prr,
+    'compute_file_map': bench_compute_file_map,
+    'prr_one_archive_twosides': bench_prr_one_archive_twosides,
+    'average_propensity_scores': bench_average_propensity_scores,
+    'compute_multi_exposure': bench_compute_multi_exposure,
+    'combine_prr_files': bench_combine_prr_files,
+}
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process and of its largest child"""
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        peak_kb /= 1024
+    return peak_kb / 1024
+
+
+def _run_benchmark(name, data_path, work_path, connection):
+    run, unit = BENCHMARKS[name](data_path, work_path)
+    setup_rss_mb = _peak_rss_mb()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    n_units = run()
+    seconds = time.perf_counter() - start_wall
+    connection.send({
+        'seconds': seconds,
+        'cpu_seconds': time.process_time() - start_cpu,
+        'units': n_units,
+        'unit': unit,
+        'throughput': n_units / seconds,
+        'peak_rss_mb': _peak_rss_mb(),
+        'setup_rss_mb': setup_rss_mb,
+    })
+    connection.close()
+
+
+def run_benchmark(name, data_path):
+    """Run one benchmark in a fresh process, returning its measurements"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_run_benchmark,
+            args=(name, data_path, pathlib.Path(work_dir), sender)
+        )
+        process.start()
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            raise RuntimeError(f'Benchmark {name} failed') from None
+        finally:
+            process.join()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print each benchmark's throughput relative to a baseline. Returns the
+    names of benchmarks slower than the baseline by more than `tolerance`.
+    """
+    regressions = list()
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        reference = baseline['results'][name]
+        ratio = result['throughput'] / reference['throughput']
+        memory_ratio = result['peak_rss_mb'] / reference['peak_rss_mb']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:28s} {ratio:6.2f}x throughput, '
+              f'{memory_ratio:6.2f}x peak memory{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scale', nargs='?', default='small',
+                        choices=list(SCALES))
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS))
+    parser.add_argument('--data', type=pathlib.Path, default=None,
+                        help='Keep the synthetic data here (it is reused if '
+                             'present), instead of in a temporary directory')
+    parser.add_argument('--save', type=pathlib.Path,
+                        help='Save results as a JSON baseline')
+    parser.add_argument('--compare', type=pathlib.Path,
+                        help='Compare results to a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction of baseline throughput that may be '
+                             'lost before a benchmark counts as a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_path = args.data or pathlib.Path(temp_dir)
+        data_path = data_path.joinpath(args.scale)
+        if not data_path.joinpath('meta/kernel_drugs.npy').is_file():
+            print(f'Generating {args.scale} data: {SCALES[args.scale]}')
+            start = time.perf_counter()
+            write_data(data_path, args.scale)
+            print(f'Generated in {time.perf_counter() - start:.1f} s')
+
+        results = dict()
+        for name in args.only:
+            results[name] = run_benchmark(name, data_path)
+            result = results[name]
+            print(f'{name:28s} {result["seconds"]:8.2f} s '
+                  f'{result["throughput"]:12.1f} {result["unit"]}/s '
+                  f'{result["peak_rss_mb"]:8.0f} MB peak')
+
+    report = {
+        'scale': args.scale,
+        'parameters': SCALES[args.scale],
+        'machine': {'platform': platform.platform(),
+                    'processor': platform.processor(),
+                    'cpu_count': multiprocessing.cpu_count(),
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'scipy': scipy.__version__},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.save is not None:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['scale'] != args.scale:
+            print(f'Warning: baseline is for scale {baseline["scale"]}')
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
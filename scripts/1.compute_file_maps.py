@@ -9,6 +9,8 @@ import pandas as pd
 import tqdm
 
 sys.path.insert(0, '../src/')
+import checkpoint  # noqa:E402
+import profiling  # noqa:E402
 import utils  # noqa:E402
 
 
@@ -25,25 +27,21 @@ def get_subfiles(archive_file_path, n_drugs):
     """
     file_locations = list()
     try:
-        tar = tarfile.open(archive_file_path, mode='r:gz')
-        subfiles = tar.getnames()
+        with profiling.timer('archive_list'):
+            tar = tarfile.open(archive_file_path, mode='r:gz')
+            subfiles = tar.getnames()
     except tarfile.ReadError:
         return None
     except EOFError:
         return None
+    profiling.count('archive_bytes_read', archive_file_path.stat().st_size)
 
     if n_drugs == 1:
         for subfile in subfiles:
-            if 'interaction' in subfile:
-                drug = re.match(r'(?:interactions__)([0-9]+)(?:\.npy)', subfile)
-                if not drug:
-                    raise ValueError(f'{archive_file_path.name} contained {subfile} not matched')
-                drug = drug.group(1)
-                bootstrap = None
-                file_type = 'interaction'
-            else:
-                drug, bootstrap = utils.extract_indices(subfile)
-                file_type = re.match('^[a-z]+(?=_.+)', subfile).group()
+            try:
+                drug, bootstrap, file_type = utils.parse_member_offsides(subfile)
+            except ValueError:
+                raise ValueError(f'{archive_file_path.name} contained {subfile} not matched')
             file_locations.append([drug, bootstrap, file_type, subfile,
                                    archive_file_path.name])
     elif n_drugs == 2:
@@ -85,7 +83,13 @@ def compute_file_map(n_drugs, archives_path):
     return pd.DataFrame(flattened_file_locations, columns=column_names)
 
 
-def compute_all_filemaps():
+def compute_all_filemaps(offsides=True):
+    """
+    Compute and save file maps. The OFFSIDES file map can be skipped when it
+    is instead produced by the single-pass (archive-major) mode of
+    `2.compute_propensity_scores.py`, saving a full decompression of every
+    OFFSIDES archive.
+    """
     # Path to where the `.tgz` archives are stored
     archives_path = pathlib.Path('/data/archives/')
 
@@ -93,15 +97,21 @@ def compute_all_filemaps():
     meta_path = pathlib.Path('/data/meta')
 
     # Compute and save OFFSIDES file map
-    offsides_file_map = compute_file_map(1, archives_path.joinpath('1/'))
-    offsides_file_map.to_csv(meta_path.joinpath('file_map_offsides.csv'),
-                             index=False)
+    if offsides:
+        offsides_file_map = compute_file_map(1, archives_path.joinpath('1/'))
+        with checkpoint.atomic_path(
+                meta_path.joinpath('file_map_offsides.csv')) as temp_path:
+            offsides_file_map.to_csv(temp_path, index=False)
 
     # Compute and save TWOSIDES file map
     twosides_file_map = compute_file_map(2, archives_path.joinpath('2/'))
-    twosides_file_map.to_csv(meta_path.joinpath('file_map_twosides.csv'),
-                             index=False)
+    with checkpoint.atomic_path(
+            meta_path.joinpath('file_map_twosides.csv')) as temp_path:
+        twosides_file_map.to_csv(temp_path, index=False)
 
 
 if __name__ == "__main__":
-    compute_all_filemaps()
+    profiling.start_stage('1.compute_file_maps')
+    # The OFFSIDES file map is written by 2.compute_propensity_scores.py
+    compute_all_filemaps(offsides=False)
+    profiling.write_stage_report()
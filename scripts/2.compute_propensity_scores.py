@@ -1,3 +1,4 @@
+import collections
 import concurrent.futures
 import functools
 import os
@@ -10,6 +11,9 @@ import pandas as pd
 import tqdm
 
 sys.path.insert(0, '../src/')
+import checkpoint  # noqa:E402
+import profiling  # noqa:E402
+import shared_data  # noqa:E402
 import utils  # noqa:E402
 
 
@@ -136,7 +140,7 @@ def compute_propensity_scores_one_drug(drug_index, files_map_df,
     Parameters
     ----------
     drug_index : int
-    files_map_df : pandas.DataFrame
+    files_map_df : pandas.DataFrame or shared_data.SharedReference
         DataFrame showing in which tar archives bootstrapped score and log
         files for each drug are located.
     computed_scores_path : pathlib.Path
@@ -156,6 +160,7 @@ def compute_propensity_scores_one_drug(drug_index, files_map_df,
         need not be read in at all.
     """
     # Query a dataframe of files for the drug of interest
+    files_map_df = shared_data.resolve(files_map_df)
     drug_df = files_map_df.query(f'drug == {drug_index}')
 
     # Only open each tar file once, map paths to these open files
@@ -198,13 +203,18 @@ def compute_propensity_scores_offsides(meta_files_path, archives_path,
         )
     )
     drugs = sorted(set(files_map_df['drug'].astype(int)))
+
+    # The file map is sent once to each worker, rather than with each drug
     compute_scores_partial = functools.partial(
-        compute_propensity_scores_one_drug, files_map_df=files_map_df,
+        compute_propensity_scores_one_drug,
+        files_map_df=shared_data.SharedReference('files_map_df'),
         temporary_directory=temp_extract_dir,
         computed_scores_path=computed_scores_path
     )
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    with concurrent.futures.ProcessPoolExecutor(
+            initializer=shared_data.init_worker,
+            initargs=({}, {'files_map_df': files_map_df})) as executor:
         all_aucs = list(tqdm.tqdm(
             executor.map(compute_scores_partial, drugs),
             total=len(drugs)
@@ -217,6 +227,266 @@ def compute_propensity_scores_offsides(meta_files_path, archives_path,
                       index=False)
 
 
+# Columns of the `{archive}.scan.csv` files written by `scan_offsides_archive`
+SCAN_COLUMNS = ['drug', 'bootstrap', 'file_type', 'file_name', 'archive_file',
+                'auc']
+
+
+def scan_offsides_archive(archive_path, partial_scores_path):
+    """
+    Read an OFFSIDES archive exactly once, streaming members into memory
+    rather than extracting them. Scores from bootstrap iterations with
+    AUC > 0.5 are summed per drug, and each drug's partial sum (with the
+    number of iterations summed) is saved as
+    `{drug}__{archive}.npz` in `partial_scores_path`. Score files whose log
+    is not in this archive cannot yet be judged, so they are saved alone as
+    `{drug}__{bootstrap}__unresolved.npy`. The file map rows and AUCs found
+    are saved as `{archive}.scan.csv` (see `load_archive_scan`).
+
+    Returns
+    -------
+    Tuple[List[list], List[Tuple[int, int, float]]]
+        File map rows ([drug, bootstrap, file_type, file_name, archive_file],
+        as in `1.compute_file_maps.py`) and (drug, bootstrap, auc) tuples.
+        Both are empty if the archive cannot be read.
+    """
+    file_locations = list()
+    bootstrap_to_auc = dict()
+    pending_scores = dict()
+    drug_sums = dict()
+    drug_counts = collections.Counter()
+
+    def add_scores(drug, bootstrap, scores):
+        if not bootstrap_to_auc[(drug, bootstrap)] > 0.5:
+            return
+        with profiling.timer('score_sum'):
+            if drug in drug_sums:
+                drug_sums[drug] += scores
+            else:
+                drug_sums[drug] = scores.astype(np.float64)
+        drug_counts[drug] += 1
+
+    members = utils.iter_archive_arrays(
+        archive_path,
+        member_filter=lambda name: 'interaction' not in name
+    )
+    profiling.count('archive_bytes_read', archive_path.stat().st_size)
+    try:
+        for subfile, array in members:
+            drug, bootstrap, file_type = utils.parse_member_offsides(subfile)
+            file_locations.append([drug, bootstrap, file_type, subfile,
+                                   archive_path.name])
+            if file_type == 'log':
+                bootstrap_to_auc[(drug, bootstrap)] = array.item()['auc']
+                # Scores seen before their log can now be added
+                if (drug, bootstrap) in pending_scores:
+                    add_scores(drug, bootstrap,
+                               pending_scores.pop((drug, bootstrap)))
+            elif file_type == 'scores':
+                if (drug, bootstrap) in bootstrap_to_auc:
+                    add_scores(drug, bootstrap, array)
+                else:
+                    pending_scores[(drug, bootstrap)] = array
+    except (tarfile.ReadError, EOFError):
+        _save_archive_scan(archive_path, partial_scores_path, list(), dict())
+        return list(), list()
+
+    with profiling.timer('write'):
+        _save_partial_scores(archive_path, partial_scores_path, drug_sums,
+                             drug_counts, pending_scores)
+
+    # Saved last, so a scan is only complete once its partial sums are saved
+    _save_archive_scan(archive_path, partial_scores_path, file_locations,
+                       bootstrap_to_auc)
+    aucs = [(drug, bootstrap, auc)
+            for (drug, bootstrap), auc in bootstrap_to_auc.items()]
+    return file_locations, aucs
+
+
+def _save_partial_scores(archive_path, partial_scores_path, drug_sums,
+                         drug_counts, pending_scores):
+    for drug, drug_sum in drug_sums.items():
+        np.savez(partial_scores_path.joinpath(f'{drug}__{archive_path.stem}.npz'),
+                 scores_sum=drug_sum, n_bootstraps=drug_counts[drug])
+    for (drug, bootstrap), scores in pending_scores.items():
+        np.save(partial_scores_path.joinpath(f'{drug}__{bootstrap}__unresolved.npy'),
+                scores)
+
+
+def _save_archive_scan(archive_path, partial_scores_path, file_locations,
+                       bootstrap_to_auc):
+    scan_df = pd.DataFrame(file_locations, columns=SCAN_COLUMNS[:-1])
+    scan_df['auc'] = [bootstrap_to_auc.get((drug, bootstrap))
+                      if file_type == 'log' else None
+                      for drug, bootstrap, file_type, *_ in file_locations]
+    scan_path = partial_scores_path.joinpath(f'{archive_path.stem}.scan.csv')
+    with checkpoint.atomic_path(scan_path) as temp_path:
+        scan_df.to_csv(temp_path, index=False)
+
+
+def load_archive_scan(archive_path, partial_scores_path):
+    """Read the file map rows and AUCs saved by `scan_offsides_archive`"""
+    scan_path = partial_scores_path.joinpath(f'{archive_path.stem}.scan.csv')
+    scan_df = pd.read_csv(scan_path, dtype={'drug': str})
+    file_locations = [
+        [drug, None if pd.isnull(bootstrap) else int(bootstrap), file_type,
+         file_name, archive_file]
+        for drug, bootstrap, file_type, file_name, archive_file
+        in scan_df[SCAN_COLUMNS[:-1]].values.tolist()
+    ]
+    # Drugs are strings only for interaction files (as in
+    #  utils.parse_member_offsides)
+    for row in file_locations:
+        if row[2] != 'interaction':
+            row[0] = int(row[0])
+    logs = scan_df.loc[scan_df['file_type'] == 'log']
+    aucs = [(int(drug), int(bootstrap), auc) for drug, bootstrap, auc
+            in logs[['drug', 'bootstrap', 'auc']].values.tolist()]
+    return file_locations, aucs
+
+
+def combine_partial_scores(drug_index, partial_scores_path,
+                           computed_scores_path, bootstrap_to_auc):
+    """
+    Average a drug's partial score sums (from `scan_offsides_archive`) and
+    save the result as `{drug}.npz`. Partial files are kept (see
+    `remove_partial_scores`), so that an interrupted run can combine again.
+
+    Returns
+    -------
+    bool
+        Whether any bootstrap iteration had AUC > 0.5 (ie. a file was saved)
+    """
+    with profiling.timer('combine_scores'):
+        return _combine_partial_scores(drug_index, partial_scores_path,
+                                       computed_scores_path, bootstrap_to_auc)
+
+
+def _combine_partial_scores(drug_index, partial_scores_path,
+                            computed_scores_path, bootstrap_to_auc):
+    drug_sum = None
+    n_bootstraps = 0
+    partial_paths = list(partial_scores_path.glob(f'{drug_index}__*.np[yz]'))
+    for path in partial_paths:
+        if path.name.endswith('__unresolved.npy'):
+            bootstrap = int(path.name.split('__')[1])
+            if not bootstrap_to_auc.get((drug_index, bootstrap), 0) > 0.5:
+                continue
+            scores, count = np.load(path), 1
+        else:
+            with np.load(path) as partial:
+                scores, count = partial['scores_sum'], int(partial['n_bootstraps'])
+        drug_sum = scores if drug_sum is None else drug_sum + scores
+        n_bootstraps += count
+
+    if drug_sum is not None:
+        score_path = computed_scores_path.joinpath(f'{drug_index}.npz')
+        with checkpoint.atomic_path(score_path) as temp_path:
+            np.savez_compressed(temp_path, scores=drug_sum / n_bootstraps)
+    return drug_sum is not None
+
+
+def remove_partial_scores(drug_index, partial_scores_path):
+    for path in partial_scores_path.glob(f'{drug_index}__*.np[yz]'):
+        os.remove(path)
+
+
+def compute_propensity_scores_archive_major(meta_files_path, archives_path,
+                                            computed_scores_path,
+                                            partial_scores_path,
+                                            manifest=None):
+    """
+    Compute PS by averaging bootstrap iterations, reading each archive only
+    once. Unlike `compute_propensity_scores_offsides`, this does not need a
+    file map. Instead it writes the OFFSIDES file map as a by-product, along
+    with the bootstrap AUCs and the averaged `{drug}.npz` files.
+
+    With a `manifest` (see `checkpoint.TaskManifest`), archives already
+    scanned and drugs already combined are skipped, so an interrupted run
+    resumes where it stopped. Archives that changed are scanned again.
+    """
+    archive_paths = sorted(archives_path.glob('scores_*.tgz'))
+    scan_units = [f'scan:{path.name}' for path in archive_paths]
+    scan_fingerprints = [checkpoint.file_fingerprint(path)
+                         for path in archive_paths]
+    pending_scans = set(scan_units if manifest is None else
+                        manifest.pending(scan_units, scan_fingerprints))
+
+    # Partial sums are removed once drugs are combined, so if any archive
+    #  changed after that, every archive must be scanned again
+    if manifest is not None and pending_scans and any(
+            unit.startswith('combine:') for unit in manifest.done_units()):
+        pending_scans = set(scan_units)
+    pending_archives = [(path, unit, unit_fingerprint) for path, unit, unit_fingerprint
+                        in zip(archive_paths, scan_units, scan_fingerprints)
+                        if unit in pending_scans]
+
+    scan_partial = functools.partial(scan_offsides_archive,
+                                     partial_scores_path=partial_scores_path)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        scans = executor.map(scan_partial,
+                             [path for path, *_ in pending_archives])
+        for (_, unit, unit_fingerprint), _ in tqdm.tqdm(
+                zip(pending_archives, scans), total=len(pending_archives)):
+            if manifest is not None:
+                manifest.mark_done(unit, unit_fingerprint)
+
+    # Scans of every archive, including those from earlier runs
+    results = [load_archive_scan(path, partial_scores_path)
+               for path in archive_paths]
+
+    file_locations = [row for rows, _ in results for row in rows]
+    file_map_path = meta_files_path.joinpath('file_map_offsides.csv')
+    with checkpoint.atomic_path(file_map_path) as temp_path:
+        pd.DataFrame(
+            file_locations,
+            columns=['drug', 'bootstrap', 'file_type', 'file_name',
+                     'archive_file']
+        ).to_csv(temp_path, index=False)
+
+    all_aucs = [auc for _, aucs in results for auc in aucs]
+    bootstrap_to_auc = {(drug, bootstrap): auc
+                        for drug, bootstrap, auc in all_aucs}
+
+    # Drugs with no iteration having AUC > 0.5 are recorded as in
+    #  `compute_propensity_scores_offsides`, with no bootstrap or AUC
+    drugs = sorted({int(drug) for drug, *_ in file_locations})
+
+    # Drugs are combined again if any archive was scanned again
+    combine_fingerprint = checkpoint.fingerprint(scan_fingerprints)
+    combine_units = [f'combine:{drug}' for drug in drugs]
+    pending_combines = set(
+        combine_units if manifest is None else
+        manifest.pending(combine_units, [combine_fingerprint] * len(drugs))
+    )
+    pending_drugs = [drug for drug, unit in zip(drugs, combine_units)
+                     if unit in pending_combines]
+
+    combine_partial = functools.partial(
+        combine_partial_scores, partial_scores_path=partial_scores_path,
+        computed_scores_path=computed_scores_path,
+        bootstrap_to_auc=bootstrap_to_auc
+    )
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        combined = executor.map(combine_partial, pending_drugs)
+        for drug, _ in tqdm.tqdm(zip(pending_drugs, combined),
+                                 total=len(pending_drugs)):
+            if manifest is not None:
+                manifest.mark_done(f'combine:{drug}', combine_fingerprint)
+            remove_partial_scores(drug, partial_scores_path)
+
+    # Drugs combined in this run or an earlier one have a file if any
+    #  iteration had AUC > 0.5
+    no_scores = {drug for drug in drugs
+                 if not computed_scores_path.joinpath(f'{drug}.npz').is_file()}
+    all_aucs = ([auc for auc in sorted(all_aucs) if auc[0] not in no_scores]
+                + [(drug, None, None) for drug in sorted(no_scores)])
+    all_auc_df = pd.DataFrame(all_aucs, columns=['drug', 'bootstrap', 'auc'])
+    auc_path = meta_files_path.joinpath('offsides_bootstrap_auc.csv')
+    with checkpoint.atomic_path(auc_path) as temp_path:
+        all_auc_df.to_csv(temp_path, index=False)
+
+
 def main():
     # User-specified directory paths
     meta_files_path = pathlib.Path('/data/meta/')
@@ -230,11 +500,24 @@ def main():
     computed_scores_path = pathlib.Path('/data/scores/1/')
     computed_scores_path.mkdir(parents=True, exist_ok=True)
 
-    compute_propensity_scores_offsides(meta_files_path,
-                                       archives_path,
-                                       computed_scores_path,
-                                       temp_extract_dir)
+    # Read each archive once, also writing the OFFSIDES file map. To instead
+    #  use the file map from 1.compute_file_maps.py and extract files to
+    #  temp_extract_dir, use compute_propensity_scores_offsides.
+    partial_scores_path = temp_extract_dir.joinpath('partial_scores/')
+    partial_scores_path.mkdir(exist_ok=True)
+
+    # Records of completed work, so that an interrupted run resumes
+    checkpoints_path = pathlib.Path('/data/checkpoints/')
+    with checkpoint.TaskManifest(
+            checkpoints_path.joinpath('2.offsides.jsonl')) as manifest:
+        compute_propensity_scores_archive_major(meta_files_path,
+                                                archives_path,
+                                                computed_scores_path,
+                                                partial_scores_path,
+                                                manifest=manifest)
 
 
 if __name__ == "__main__":
+    profiling.start_stage('2.compute_propensity_scores')
     main()
+    profiling.write_stage_report()
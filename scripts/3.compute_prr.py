@@ -1,124 +1,546 @@
+import collections
 import concurrent.futures
 import functools
-import os
+import gzip
+import itertools
 import pathlib
-import re
 import sys
 import tarfile
+import warnings
 
 import numpy as np
 import pandas as pd
-import scipy.sparse
 import tqdm
 
 sys.path.insert(0, '../src/')
+import candidates  # noqa:E402
+import checkpoint  # noqa:E402
+import coexposure  # noqa:E402
+import matrices  # noqa:E402
 import parallel_utils  # noqa:E402
+import profiling  # noqa:E402
+import prr_io  # noqa:E402
+import scheduling  # noqa:E402
+import score_store  # noqa:E402
+import shared_data  # noqa:E402
+import thread_pipeline  # noqa:E402
 import utils  # noqa:E402
 
 
-def extract_scores_twosides(tar_file_path, computed_scores_path):
-    """Extract all propensity score files from a tar file at the given path"""
-    try:
-        tar = tarfile.open(tar_file_path, mode='r:gz')
-        members = tar.getmembers()
-    except:  # noqa:E722
-        return None
+def _pending_combinations(combinations, manifest, scores_path, prr_save_path,
+                          output_format, run_fingerprint):
+    """
+    Combinations (tuples of drug indices) that are not recorded as done in
+    `manifest` with the same inputs, or whose output is missing, along with
+    the fingerprint of each. Without a manifest, every combination is pending.
+    """
+    if manifest is None:
+        return [(combination, None) for combination in combinations]
+    keys = ['_'.join(map(str, combination)) for combination in combinations]
+    fingerprints = [
+        checkpoint.fingerprint(run_fingerprint, output_format,
+                               utils.score_fingerprint(combination, scores_path))
+        for combination in combinations
+    ]
+    extension = prr_io.EXTENSIONS[output_format]
+    output_paths = [prr_save_path.joinpath(key + extension) for key in keys]
+    pending_keys = set(manifest.pending(keys, fingerprints, output_paths))
+    return [(combination, unit_fingerprint) for combination, key, unit_fingerprint
+            in zip(combinations, keys, fingerprints) if key in pending_keys]
+
+
+def _options_fingerprint(run_fingerprint, rows, matching):
+    """
+    Fingerprint of a run that writes `rows` (see
+    `calculate_prr.compute_prr_rows`) with `matching` (see
+    `calculate_prr.MATCHING`). Runs with the default options keep the
+    fingerprints of earlier runs.
+    """
+    # Options that are namedtuples (eg. `calculate_prr.Caliper`) are
+    #  fingerprinted by their repr, which includes their type
+    options = [str(option) for option, default in [(rows, 'all'),
+                                                   (matching, 'sampled')]
+               if option != default]
+    if len(options) == 0:
+        return run_fingerprint
+    return checkpoint.fingerprint(run_fingerprint, *options)
+
+
+def _scored_combinations(scores_path):
+    """
+    Drug combinations (tuples of indices) with propensity scores in a score
+    store, or a directory of `{i}.npz` or `{i}_{j}_{k}.npy` files
+    """
+    if score_store.is_store(scores_path):
+        keys = score_store.store_keys(score_store.open_store(scores_path))
+    else:
+        keys = [path.stem for path in scores_path.glob('*.np[yz]')]
+    return sorted(tuple(map(int, key.split('_'))) for key in keys)
+
+
+def _mark_done(manifest, combinations_and_fingerprints):
+    if manifest is None:
+        return
+    for combination, unit_fingerprint in combinations_and_fingerprints:
+        manifest.mark_done('_'.join(map(str, combination)), unit_fingerprint)
+
+
+def compute_prr_offsides(propensity_scores_path, prr_save_path, matrix_specs,
+                         drug_id_vector, outcome_id_vector, block_size=16,
+                         output_format='npz', manifest=None,
+                         run_fingerprint=None, max_workers=None, rows='all',
+                         matching='sampled'):
+    """
+    Compute PRR for every drug with propensity scores. Drugs are processed in
+    blocks of up to `block_size`, each block needing one sparse product with
+    the outcome matrix (see `parallel_utils.prr_drug_block`). Blocks are
+    planned from the drugs' numbers of exposed reports, most expensive
+    first, and shrink towards the end of the run (see
+    `scheduling.plan_chunks`), so that a few common drugs do not leave one
+    worker busy while the rest are idle. `matrix_specs` are
+    the published `"exposures"` and `"outcomes"` matrices (see
+    `shared_data.publish_sparse_matrix`), which workers memory-map once.
+    Results are saved in `output_format` (see `prr_io.WRITERS`), with the
+    outcome rows selected by `rows` (every outcome, or only exposed outcomes
+    or signals, see `calculate_prr.compute_prr_rows`) and C computed as set
+    by `matching` (see `calculate_prr.MATCHING`).
+    `propensity_scores_path` is a directory of `{drug}.npz` files or a score
+    store (see `score_store`).
+
+    With a `manifest` (see `checkpoint.TaskManifest`), drugs already computed
+    from the same inputs (`run_fingerprint` and the drug's scores) are
+    skipped, and drugs are recorded as their blocks complete.
+    """
+    computable_drugs = [drug for (drug,)
+                        in _scored_combinations(propensity_scores_path)]
+    run_fingerprint = _options_fingerprint(run_fingerprint, rows, matching)
+    pending = _pending_combinations(
+        [(drug,) for drug in computable_drugs], manifest,
+        propensity_scores_path, prr_save_path, output_format, run_fingerprint)
+    costs = scheduling.exposure_costs(
+        shared_data.attach_sparse_matrix(matrix_specs['exposures']),
+        [drug for (drug,), _ in pending])
+    pending_blocks = [
+        [pending[i] for i in block] for block in scheduling.plan_chunks(
+            costs, scheduling.pool_size(max_workers), max_size=block_size)
+    ]
+    drug_blocks = [[drug for (drug,), _ in block] for block in pending_blocks]
 
-    scores_members = [member for member in members if 'score' in member.name]
-    tar.extractall(path=computed_scores_path, members=scores_members)
-
-    # Rename files from 'scores_lrc__0_1.npy' to '0_1.npy'
-    extracted_paths = list()
-    for member in scores_members:
-        path = computed_scores_path.joinpath(member.name)
-        assert path.is_file()
-        new_name = re.match(r'(?:.+__)([0-9_]+\.npy)', member.name).group(1)
-        new_path = path.parent.joinpath(new_name)
-        path.rename(new_path)
-        extracted_paths.append(new_path)
-    return extracted_paths
-
-
-def compute_prr_offsides(propensity_scores_path, prr_save_path,
-                         report_exposure_matrix, report_outcome_matrix,
-                         drug_id_vector, outcome_id_vector):
-    computable_drugs = list(propensity_scores_path.glob('*.npz'))
-    computable_drugs = sorted([int(drug.stem) for drug in computable_drugs])
-
-    run_one_drug = functools.partial(
-        parallel_utils.prr_one_drug,
-        all_exposures=report_exposure_matrix,
-        all_outcomes=report_outcome_matrix,
-        n_reports=report_exposure_matrix.shape[0],
+    run_drug_block = functools.partial(
+        parallel_utils.prr_drug_block,
+        all_exposures=shared_data.SharedReference('exposures'),
+        all_outcomes=shared_data.SharedReference('outcomes'),
+        n_reports=matrix_specs['exposures']['shape'][0],
         drug_id_vector=drug_id_vector,
         outcome_id_vector=outcome_id_vector,
         scores_path=propensity_scores_path,
         save_path=prr_save_path,
+        output_format=output_format,
+        rows=rows,
+        matching=matching,
     )
 
     # Compute and save disproportionality files (one for each drug)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = list(  # noqa: F841
-            tqdm.tqdm(executor.map(run_one_drug, computable_drugs),
-                    total=len(computable_drugs))
-        )
-
-
-def prr_one_archive_twosides(archive_path, file_map, extract_dir,
-                             report_exposure_matrix, report_outcome_matrix,
-                             drug_id_vector, outcome_id_vector, prr_save_path):
-    # Extract propensity scores from archive
-    extracted_paths = parallel_utils.extract_scores_twosides(archive_path,
-                                                             extract_dir)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=shared_data.init_worker,
+            initargs=(matrix_specs,)) as executor:
+        progress = tqdm.tqdm(total=len(pending))
+        for block, _ in zip(pending_blocks,
+                            executor.map(run_drug_block, drug_blocks)):
+            _mark_done(manifest, block)
+            progress.update(len(block))
+        progress.close()
+
+
+def _open_pair_scores(archive_path, keep_pairs, n_reports):
+    """
+    Stream the score arrays of the drug pairs in `keep_pairs` (all pairs when
+    None) out of a TWOSIDES archive, without extracting them to disk.
+
+    For some reason a number of archives fail to load. An archive that
+    cannot be opened is skipped with a warning, and None is returned. Errors
+    reading an archive once it is open are raised by the returned
+    generator. The archive is decompressed with `gzip`, which checks that
+    the compressed stream is complete (`tarfile` alone stops quietly at the
+    end of a truncated archive).
+    """
+    def is_kept(name):
+        return 'score' in name and (
+            keep_pairs is None
+            or utils.extract_indices_twosides(name) in keep_pairs)
+
+    archive = gzip.open(archive_path)
+    try:
+        tar = tarfile.open(fileobj=archive, mode='r|')
+    except (tarfile.TarError, OSError, EOFError) as error:
+        archive.close()
+        warnings.warn(f'Skipping {archive_path}, which cannot be opened: '
+                      f'{error!r}')
+        return None
 
-    if extracted_paths is None:
-        return
+    def pair_scores():
+        with archive, tar:
+            for name, scores in utils.iter_tar_arrays(tar, is_kept):
+                if scores is not None:
+                    yield (utils.extract_indices_twosides(name),
+                           scores[:n_reports])
+    return pair_scores()
+
+
+def prr_one_archive_twosides(archive_path, pairs, report_exposure_matrix,
+                             report_outcome_matrix, drug_id_vector,
+                             outcome_id_vector, prr_save_path, output_format,
+                             compute_threads=1, writer_threads=1,
+                             queue_size=2, rows='all', matching='sampled'):
+    """
+    Compute PRR for the drug `pairs` (tuples of indices) in an archive, or
+    for every pair in it when `pairs` is None, writing the outcome rows
+    selected by `rows`, with C computed as set by `matching`.
+
+    The archive is processed as a pipeline (see
+    `thread_pipeline.run_thread_pipeline`): one thread streams score arrays
+    out of the archive in memory, `compute_threads` threads match and count,
+    and `writer_threads` threads compress and write results, so that
+    decompression, computation and compression overlap. At most
+    `queue_size` arrays wait between two stages, and nothing is extracted
+    to disk.
+
+    Returns
+    -------
+    bool
+        Whether the archive was read. An archive that cannot be opened is
+        skipped (see `_open_pair_scores`). Any other error is raised.
+    """
+    report_exposure_matrix = shared_data.resolve(report_exposure_matrix)
+    report_outcome_matrix = shared_data.resolve(report_outcome_matrix)
+    keep_pairs = None if pairs is None else set(pairs)
+    pair_scores = _open_pair_scores(archive_path, keep_pairs,
+                                    report_exposure_matrix.shape[0])
+    if pair_scores is None:
+        return False
+
+    def compute(indices_and_scores):
+        drug_indices, scores = indices_and_scores
+        with profiling.timer('combination'):
+            drug_df, totals = parallel_utils.prr_combination_frame(
+                drug_indices, scores, report_exposure_matrix,
+                report_outcome_matrix, outcome_id_vector, rows, matching)
+        return drug_indices, drug_df, totals
+
+    def write(result):
+        drug_indices, drug_df, totals = result
+        prr_io.write_prr_result(
+            drug_df, prr_save_path.joinpath('_'.join(map(str, drug_indices))),
+            output_format, drug_id_vector, outcome_id_vector, totals,
+            drug_indices)
+
+    thread_pipeline.run_thread_pipeline(
+        pair_scores, [(compute, compute_threads), (write, writer_threads)],
+        queue_size=queue_size)
+    return True
+
+
+def plan_archive_tasks(archive_paths, file_map, n_reports, n_workers,
+                       coexposure_counts=None, min_coexposure=1):
+    """
+    Tasks for `prr_one_archive_twosides`, each an archive and the pairs to
+    compute from it, most expensive first (see `scheduling.split_archives`).
+    The pairs of each archive are read from the file map, and with
+    `coexposure_counts`, pairs with fewer than `min_coexposure` co-exposed
+    reports are dropped, and the cost of a pair is estimated from its number
+    of co-exposed reports. Archives missing from the file map are computed
+    whole (pairs of None), and archives without pairs left are not tasks.
+
+    Returns
+    -------
+    List[Tuple[pathlib.Path, List[Tuple[int, int]]]]
+    """
+    score_files = file_map.loc[file_map['file_type'] == 'scores']
+    mapped_pairs = {
+        name: list(zip(files['drug_index_1'].astype(int),
+                       files['drug_index_2'].astype(int)))
+        for name, files in score_files.groupby('archive_file')
+    }
+    archive_pairs = dict()
+    pair_costs = dict()
+    unmapped = list()
+    for path in archive_paths:
+        if path.name not in mapped_pairs:
+            unmapped.append(path)
+            continue
+        pairs = mapped_pairs[path.name]
+        if coexposure_counts is not None:
+            pairs = coexposure.filter_combinations(pairs, coexposure_counts,
+                                                   min_coexposure)
+        if len(pairs) == 0:
+            continue
+        archive_pairs[path.name] = pairs
+        pair_costs[path.name] = scheduling.combination_costs(
+            pairs, coexposure_counts, n_reports)
+    paths = {path.name: path for path in archive_paths}
+    tasks = [(paths[name], pairs) for name, pairs in
+             scheduling.split_archives(archive_pairs, pair_costs, n_workers)]
+    return tasks + [(path, None) for path in unmapped]
+
+
+def compute_prr_twosides(archives_path, file_map, matrix_specs,
+                         drug_id_vector, outcome_id_vector, prr_save_path,
+                         output_format='npz', coexposure_counts=None,
+                         min_coexposure=1, manifest=None, run_fingerprint=None,
+                         max_workers=None, compute_threads=1,
+                         writer_threads=1, rows='all', matching='sampled'):
+    """
+    Compute PRR for the drug pairs in every TWOSIDES archive. With
+    `coexposure_counts` (see `coexposure.coexposure_counts`), pairs with
+    fewer than `min_coexposure` co-exposed reports are not extracted. With a
+    `manifest`, archives already computed from the same inputs are skipped.
+    Archives are computed from most to least expensive, and archives with
+    much more work than the others are split between workers (see
+    `plan_archive_tasks`). Within each worker, reading, computing and writing
+    overlap, with `compute_threads` and `writer_threads` threads (see
+    `prr_one_archive_twosides`). `rows` selects the outcome rows written
+    (see `calculate_prr.compute_prr_rows`), and `matching` how C is computed
+    (see `calculate_prr.MATCHING`). Archives that cannot be opened are
+    skipped and not recorded in the manifest, and an error reading any
+    other archive is raised.
+    """
+    archive_paths = sorted(archives_path.glob('scores_*.tgz'))
+    run_fingerprint = _options_fingerprint(run_fingerprint, rows, matching)
+    fingerprints = [checkpoint.fingerprint(run_fingerprint, output_format,
+                                           min_coexposure,
+                                           checkpoint.file_fingerprint(path))
+                    for path in archive_paths]
+    if manifest is not None:
+        pending_names = set(manifest.pending(
+            [path.name for path in archive_paths], fingerprints))
+        fingerprints = [unit_fingerprint for path, unit_fingerprint
+                        in zip(archive_paths, fingerprints)
+                        if path.name in pending_names]
+        archive_paths = [path for path in archive_paths
+                         if path.name in pending_names]
+    tasks = plan_archive_tasks(archive_paths, file_map,
+                               matrix_specs['exposures']['shape'][0],
+                               scheduling.pool_size(max_workers),
+                               coexposure_counts, min_coexposure)
+
+    # An archive is done when all of its tasks are
+    remaining_tasks = collections.Counter(path.name for path, _ in tasks)
+    unit_fingerprints = dict(zip([path.name for path in archive_paths],
+                                 fingerprints))
+    if manifest is not None:
+        for path in archive_paths:
+            if remaining_tasks[path.name] == 0:
+                manifest.mark_done(path.name, unit_fingerprints[path.name])
+
+    # The matrices are sent to each worker once, not per task
+    run_one_archive = functools.partial(
+        prr_one_archive_twosides,
+        report_exposure_matrix=shared_data.SharedReference('exposures'),
+        report_outcome_matrix=shared_data.SharedReference('outcomes'),
+        drug_id_vector=drug_id_vector,
+        outcome_id_vector=outcome_id_vector,
+        prr_save_path=prr_save_path,
+        output_format=output_format,
+        compute_threads=compute_threads,
+        writer_threads=writer_threads,
+        rows=rows,
+        matching=matching,
+    )
 
-    # Get indices of drug combinations stored in the archive
-    drug_indices = [
-        utils.extract_indices_twosides(file.name, original=False)
-        for file in extracted_paths
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=shared_data.init_worker,
+            initargs=(matrix_specs,)) as executor:
+        results = executor.map(run_one_archive,
+                               [path for path, _ in tasks],
+                               [pairs for _, pairs in tasks])
+        unread = set()
+        for (archive_path, _), read in tqdm.tqdm(zip(tasks, results),
+                                                 total=len(tasks)):
+            remaining_tasks[archive_path.name] -= 1
+            if not read:
+                unread.add(archive_path.name)
+            if (manifest is not None
+                    and remaining_tasks[archive_path.name] == 0
+                    and archive_path.name not in unread):
+                manifest.mark_done(archive_path.name,
+                                   unit_fingerprints[archive_path.name])
+
+
+def compute_prr_twosides_store(store_path, matrix_specs, drug_id_vector,
+                               outcome_id_vector, prr_save_path,
+                               output_format='npz', pairs=None, chunksize=64,
+                               coexposure_counts=None, min_coexposure=1,
+                               manifest=None, run_fingerprint=None,
+                               max_workers=None, rows='all',
+                               matching='sampled'):
+    """
+    Compute PRR for drug pairs whose scores are in a score store (see
+    `repack_scores.py`). Each pair's scores are read directly from the store,
+    so computing a subset of `pairs` (eg. `[(1001, 1888), ...]`) only reads
+    the scores of that subset. By default, every pair in the store is used.
+    With `coexposure_counts`, pairs with fewer than `min_coexposure`
+    co-exposed reports are skipped, and the rest are computed from most to
+    least co-exposed, in chunks of up to `chunksize` pairs that shrink
+    towards the end of the run (see `scheduling.plan_chunks`). With a
+    `manifest`, pairs already computed from the same inputs are skipped.
+    `rows` selects the outcome rows written (see
+    `calculate_prr.compute_prr_rows`), and `matching` how C is computed (see
+    `calculate_prr.MATCHING`).
+    """
+    if pairs is None:
+        store = score_store.open_store(store_path)
+        pairs = [tuple(map(int, key.split('_')))
+                 for key in score_store.store_keys(store)]
+    if coexposure_counts is not None:
+        pairs = coexposure.filter_combinations(pairs, coexposure_counts,
+                                               min_coexposure)
+    run_fingerprint = _options_fingerprint(run_fingerprint, rows, matching)
+    pending = _pending_combinations(pairs, manifest, store_path, prr_save_path,
+                                    output_format, run_fingerprint)
+
+    n_reports = matrix_specs['exposures']['shape'][0]
+    costs = scheduling.combination_costs([pair for pair, _ in pending],
+                                         coexposure_counts, n_reports)
+    pending_chunks = [
+        [pending[i] for i in chunk] for chunk in scheduling.plan_chunks(
+            costs, scheduling.pool_size(max_workers), max_size=chunksize)
     ]
 
+    prr_combinations = functools.partial(
+        parallel_utils.prr_combinations,
+        all_exposures=shared_data.SharedReference('exposures'),
+        all_outcomes=shared_data.SharedReference('outcomes'),
+        n_reports=n_reports,
+        drug_id_vector=drug_id_vector,
+        outcome_id_vector=outcome_id_vector,
+        scores_path=store_path,
+        save_path=prr_save_path,
+        output_format=output_format,
+        rows=rows,
+        matching=matching,
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=shared_data.init_worker,
+            initargs=(matrix_specs,)) as executor:
+        results = executor.map(prr_combinations,
+                               [[pair for pair, _ in chunk]
+                                for chunk in pending_chunks])
+        progress = tqdm.tqdm(total=len(pending))
+        for chunk, _ in zip(pending_chunks, results):
+            _mark_done(manifest, chunk)
+            progress.update(len(chunk))
+        progress.close()
+
+
+def compute_prr_work_list(work_list_path, scores_path, matrix_specs,
+                          drug_id_vector, outcome_id_vector, prr_save_path,
+                          output_format='npz', rows_per_batch=10_000,
+                          chunksize=16, manifest=None, run_fingerprint=None,
+                          rows='all', matching='sampled'):
+    """
+    Compute PRR for the drug combinations in a work list written by
+    compute_candidates.py (eg. triplets), in the order of the list. The list
+    is streamed in batches of `rows_per_batch` combinations, so it need not
+    fit in memory. Combinations without scores in `scores_path` (a score
+    store or directory of `{i}_{j}_{k}.npy` files) are skipped. With a
+    `manifest`, combinations already computed from the same inputs are
+    skipped. `rows` selects the outcome rows written (see
+    `calculate_prr.compute_prr_rows`), and `matching` how C is computed (see
+    `calculate_prr.MATCHING`).
+    """
+    run_fingerprint = _options_fingerprint(run_fingerprint, rows, matching)
     prr_one_combo = functools.partial(
         parallel_utils.prr_one_combination,
-        all_exposures=report_exposure_matrix,
-        all_outcomes=report_outcome_matrix,
-        n_reports=report_exposure_matrix.shape[0],
+        all_exposures=shared_data.SharedReference('exposures'),
+        all_outcomes=shared_data.SharedReference('outcomes'),
+        n_reports=matrix_specs['exposures']['shape'][0],
         drug_id_vector=drug_id_vector,
         outcome_id_vector=outcome_id_vector,
-        scores_path=extract_dir,
+        scores_path=scores_path,
         save_path=prr_save_path,
+        output_format=output_format,
+        rows=rows,
+        matching=matching,
     )
 
-    # Compute PRR et al. for each drug combination
-    for indices in drug_indices:
-        prr_one_combo(indices)
-
-    # Delete extracted files
-    list(map(os.remove, extracted_paths))
-
-
-def compute_prr_twosides(archives_path, file_map, extract_dir,
-                         report_exposure_matrix, report_outcome_matrix,
-                         drug_id_vector, outcome_id_vector, prr_save_path):
-    archive_paths = list(archives_path.glob('scores_*.tgz'))
+    combinations = candidates.iter_work_list(work_list_path,
+                                             chunksize=rows_per_batch)
+    with concurrent.futures.ProcessPoolExecutor(
+            initializer=shared_data.init_worker,
+            initargs=(matrix_specs,)) as executor:
+        progress = tqdm.tqdm()
+        while True:
+            batch = list(itertools.islice(combinations, rows_per_batch))
+            if len(batch) == 0:
+                break
+            pending = _pending_combinations(batch, manifest, scores_path,
+                                            prr_save_path, output_format,
+                                            run_fingerprint)
+            results = executor.map(prr_one_combo,
+                                   [combination for combination, _ in pending],
+                                   chunksize=chunksize)
+            for combination_and_fingerprint, _ in zip(pending, results):
+                _mark_done(manifest, [combination_and_fingerprint])
+            progress.update(len(batch))
+        progress.close()
+
+
+def compute_prr_resampled(scores_path, matrix_specs, drug_id_vector,
+                          outcome_id_vector, save_path, n_resamples=50,
+                          combinations=None, chunksize=16,
+                          coexposure_counts=None, manifest=None,
+                          run_fingerprint=None, max_workers=None):
+    """
+    Estimate how sensitive PRR is to the sample of unexposed controls, by
+    computing PRR for `n_resamples` control samples of each drug (or
+    combination) at once and saving the mean, standard deviation and 95%
+    interval of each exposed outcome's PRR (see
+    `parallel_utils.prr_resampled_combination`). `combinations` are tuples
+    of drug indices, by default every drug or combination with scores in
+    `scores_path` (a score store or directory of score files). Work is
+    computed most expensive first (see `scheduling.plan_chunks`), and with a
+    `manifest`, combinations already computed from the same inputs are
+    skipped.
+    """
+    if combinations is None:
+        combinations = _scored_combinations(scores_path)
+    run_fingerprint = checkpoint.fingerprint(run_fingerprint, n_resamples)
+    pending = _pending_combinations(combinations, manifest, scores_path,
+                                    save_path, 'csv', run_fingerprint)
+
+    n_reports = matrix_specs['exposures']['shape'][0]
+    costs = scheduling.combination_costs([combination for combination, _
+                                          in pending],
+                                         coexposure_counts, n_reports)
+    pending_chunks = [
+        [pending[i] for i in chunk] for chunk in scheduling.plan_chunks(
+            costs, scheduling.pool_size(max_workers), max_size=chunksize)
+    ]
 
-    run_one_archive = functools.partial(
-        prr_one_archive_twosides,
-        file_map=file_map, extract_dir=extract_dir,
-        report_exposure_matrix=report_exposure_matrix,
-        report_outcome_matrix=report_outcome_matrix,
+    prr_resampled_combinations = functools.partial(
+        parallel_utils.prr_resampled_combinations,
+        all_exposures=shared_data.SharedReference('exposures'),
+        all_outcomes=shared_data.SharedReference('outcomes'),
+        n_reports=n_reports,
         drug_id_vector=drug_id_vector,
         outcome_id_vector=outcome_id_vector,
-        prr_save_path=prr_save_path
+        scores_path=scores_path,
+        save_path=save_path,
+        n_resamples=n_resamples,
     )
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = list(  # noqa: F841
-            tqdm.tqdm(executor.map(run_one_archive, archive_paths),
-                      total=len(archive_paths))
-        )
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=shared_data.init_worker,
+            initargs=(matrix_specs,)) as executor:
+        results = executor.map(prr_resampled_combinations,
+                               [[combination for combination, _ in chunk]
+                                for chunk in pending_chunks])
+        progress = tqdm.tqdm(total=len(pending))
+        for chunk, _ in zip(pending_chunks, results):
+            _mark_done(manifest, chunk)
+            progress.update(len(chunk))
+        progress.close()
 
 
 def main():
@@ -126,25 +548,66 @@ def main():
     meta_files_path = pathlib.Path('/data/meta/')
     propensity_scores_path = pathlib.Path('/data/scores/')
     twosides_archives_path = pathlib.Path('/data/archives/2/')
-    temp_extract_dir = pathlib.Path('/data/extract_dir/')
-    temp_extract_dir.mkdir(exist_ok=True)
+
+    # Score stores written by repack_scores.py, used instead of the score
+    #  files and archives when present
+    score_store_path = pathlib.Path('/data/score_store/')
+
+    # Directory for uncompressed matrix buffers that workers memory-map
+    shared_matrices_path = pathlib.Path('/data/shared_matrices/')
+
+    # Records of completed work (see checkpoint.TaskManifest)
+    checkpoints_path = pathlib.Path('/data/checkpoints/')
+
+    # Outcome rows written for each drug: "all", "exposed" (A > 0), or
+    #  "signals" (see calculate_prr.compute_prr_rows)
+    output_rows = 'all'
+
+    # How C is computed: "sampled" unexposed reports, as in the released
+    #  data, or their "expected" counts, which are free of sampling noise
+    #  (see calculate_prr.MATCHING). calculate_prr.QuantileBins(20) matches
+    #  as in the paper, and calculate_prr.Caliper() to the nearest scores.
+    #  Both need scores rather than bin codes (see repack_scores.py).
+    matching = 'sampled'
+
+    # Number of resampled control samples used to estimate the stability of
+    #  each PRR (see compute_prr_resampled), or 0 to skip the estimates
+    n_resamples = 0
 
     prr_save_path = pathlib.Path('/data/prr/')
     prr_save_path.mkdir(exist_ok=True)
     prr_save_path.joinpath('1/').mkdir(exist_ok=True)
     prr_save_path.joinpath('2/').mkdir(exist_ok=True)
 
-    # Load matrices of reports by exposures and outcomes
-    report_exposure_matrix = scipy.sparse.load_npz(
+    # Load matrices of reports by exposures and outcomes, in the layouts the
+    #  kernels read fastest (see matrices.OUTCOME_FORMAT)
+    report_exposure_matrix = matrices.load_exposure_matrix(
         meta_files_path.joinpath('drug_exposure_matrix.npz')
     )
-    report_outcome_matrix = scipy.sparse.load_npz(
+    report_outcome_matrix = matrices.load_outcome_matrix(
         meta_files_path.joinpath('outcome_matrix.npz')
     )
 
     print(f'Exposures: {report_exposure_matrix.shape},'
           f' Outcomes: {report_outcome_matrix.shape}')
 
+    # Reports exposed to each pair of drugs, used to skip pairs that no
+    #  reports were exposed to (rebuilt if the exposure matrix changed)
+    coexposure_counts = coexposure.load_coexposure_counts(
+        meta_files_path.joinpath('coexposure_counts.npz'),
+        meta_files_path.joinpath('drug_exposure_matrix.npz'),
+        report_exposure_matrix
+    )
+
+    # Publish matrices once, to be memory-mapped (not copied) by every worker
+    matrix_specs = {
+        'exposures': shared_data.publish_sparse_matrix(
+            report_exposure_matrix, shared_matrices_path, 'exposures'),
+        'outcomes': shared_data.publish_sparse_matrix(
+            report_outcome_matrix, shared_matrices_path, 'outcomes'),
+    }
+    del report_exposure_matrix, report_outcome_matrix
+
     # Load vectors of the ids at each index for exposures and outcomes
     drug_id_vector = np.load(
         meta_files_path.joinpath('drug_id_vector.npy')
@@ -157,16 +620,88 @@ def main():
     twosides_file_map = pd.read_csv(meta_files_path
                                     .joinpath('file_map_twosides.csv'))
 
-    compute_prr_offsides(propensity_scores_path.joinpath('1/'),
-                         prr_save_path.joinpath('1/'),
-                         report_exposure_matrix, report_outcome_matrix,
-                         drug_id_vector, outcome_id_vector)
-
-    compute_prr_twosides(twosides_archives_path, twosides_file_map,
-                         temp_extract_dir, report_exposure_matrix,
-                         report_outcome_matrix, drug_id_vector,
-                         outcome_id_vector, prr_save_path.joinpath('2/'))
+    # Completed drugs, pairs and archives, so that an interrupted run resumes
+    #  where it stopped. Work is redone if the matrices or ID vectors change.
+    run_fingerprint = checkpoint.file_fingerprint(*[
+        meta_files_path.joinpath(name)
+        for name in ('drug_exposure_matrix.npz', 'outcome_matrix.npz',
+                     'drug_id_vector.npy', 'outcome_id_vector.npy')
+    ])
+
+    offsides_scores_path = score_store_path.joinpath('1/')
+    if not score_store.is_store(offsides_scores_path):
+        offsides_scores_path = propensity_scores_path.joinpath('1/')
+    with checkpoint.TaskManifest(
+            checkpoints_path.joinpath('3.offsides.jsonl')) as manifest:
+        compute_prr_offsides(offsides_scores_path,
+                             prr_save_path.joinpath('1/'), matrix_specs,
+                             drug_id_vector, outcome_id_vector,
+                             manifest=manifest,
+                             run_fingerprint=run_fingerprint,
+                             rows=output_rows, matching=matching)
+
+    with checkpoint.TaskManifest(
+            checkpoints_path.joinpath('3.twosides.jsonl')) as manifest:
+        if score_store.is_store(score_store_path.joinpath('2/')):
+            compute_prr_twosides_store(score_store_path.joinpath('2/'),
+                                       matrix_specs, drug_id_vector,
+                                       outcome_id_vector,
+                                       prr_save_path.joinpath('2/'),
+                                       coexposure_counts=coexposure_counts,
+                                       manifest=manifest,
+                                       run_fingerprint=run_fingerprint,
+                                       rows=output_rows, matching=matching)
+        else:
+            compute_prr_twosides(twosides_archives_path, twosides_file_map,
+                                 matrix_specs, drug_id_vector,
+                                 outcome_id_vector,
+                                 prr_save_path.joinpath('2/'),
+                                 coexposure_counts=coexposure_counts,
+                                 manifest=manifest,
+                                 run_fingerprint=run_fingerprint,
+                                 rows=output_rows, matching=matching)
+
+    # Stability of OFFSIDES and TWOSIDES PRR across control samples. Pairs
+    #  are read from the score store (see repack_scores.py), not archives.
+    if n_resamples > 0:
+        resampled_save_path = pathlib.Path('/data/prr_resampled/')
+        for n_drugs, scores_path in [
+                (1, offsides_scores_path),
+                (2, score_store_path.joinpath('2/'))]:
+            if not score_store.is_store(scores_path) and n_drugs > 1:
+                continue
+            save_path = resampled_save_path.joinpath(f'{n_drugs}/')
+            save_path.mkdir(parents=True, exist_ok=True)
+            with checkpoint.TaskManifest(checkpoints_path.joinpath(
+                    f'3.resampled_{n_drugs}.jsonl')) as manifest:
+                compute_prr_resampled(scores_path, matrix_specs,
+                                      drug_id_vector, outcome_id_vector,
+                                      save_path, n_resamples=n_resamples,
+                                      coexposure_counts=coexposure_counts,
+                                      manifest=manifest,
+                                      run_fingerprint=run_fingerprint)
+
+    # Higher-order combinations (candidates from compute_candidates.py), for
+    #  sizes with propensity scores
+    for n_drugs in (3, 4):
+        work_list_path = meta_files_path.joinpath(f'candidates_{n_drugs}.csv')
+        scores_path = score_store_path.joinpath(f'{n_drugs}/')
+        if not score_store.is_store(scores_path):
+            scores_path = propensity_scores_path.joinpath(f'{n_drugs}/')
+        if not (work_list_path.is_file() and scores_path.is_dir()):
+            continue
+        prr_save_path.joinpath(f'{n_drugs}/').mkdir(exist_ok=True)
+        with checkpoint.TaskManifest(
+                checkpoints_path.joinpath(f'3.nsides_{n_drugs}.jsonl')) as manifest:
+            compute_prr_work_list(work_list_path, scores_path, matrix_specs,
+                                  drug_id_vector, outcome_id_vector,
+                                  prr_save_path.joinpath(f'{n_drugs}/'),
+                                  manifest=manifest,
+                                  run_fingerprint=run_fingerprint,
+                                  rows=output_rows, matching=matching)
 
 
 if __name__ == "__main__":
+    profiling.start_stage('3.compute_prr')
     main()
+    profiling.write_stage_report()
@@ -1,23 +1,160 @@
 import os
 import pathlib
+import sys
 import tarfile
 
-import pandas as pd
+import numpy as np
 import tqdm
 
+sys.path.insert(0, '../src/')
+import checkpoint  # noqa:E402
+import parallel_combine  # noqa:E402
+import profiling  # noqa:E402
+import prr_io  # noqa:E402
 
-def combine_prr_files(prr_files_path, save_path):
-    files = list(prr_files_path.glob('*.csv.xz'))
 
-    header = True
-    for file_path in tqdm.tqdm(files):
-        (
-            pd.read_csv(file_path)
-            .to_csv(save_path, index=False, header=header, mode='a',
-                    compression='xz')
-        )
-        header = False
+def combine_prr_files(prr_files_path, save_path, drug_id_vector,
+                      outcome_id_vector, manifest, files_per_block=64,
+                      codec='xz', shard_rows=None):
+    """
+    Combine result files (of any format) into a single compressed CSV table,
+    or into shards of about `shard_rows` rows each. Blocks of
+    `files_per_block` files are read and compressed in parallel and streamed
+    to the output in order (see `parallel_combine.write_blocks`). Input files
+    are removed only after the output has been verified against its
+    manifest.
+
+    The output is then recorded as done in `manifest` (a
+    `checkpoint.TaskManifest`), before its inputs are removed, as in
+    `combine_prr_table`. When it is done, a rerun keeps it: result files
+    already combined into it are removed, and new result files raise a
+    RuntimeError. With no input files left and an unrecorded output, the
+    output is kept and a RuntimeError is raised, rather than replacing it
+    with an empty one.
+
+    Returns
+    -------
+    bool
+        Whether the output was written
+    """
+    files = prr_io.find_prr_results(prr_files_path)
+    output_manifest = parallel_combine.read_manifest(save_path, codec)
+    if (save_path.name in manifest.done_units()
+            and output_manifest is not None and 'files' in output_manifest):
+        combined = set(output_manifest['files'])
+        new_files = [path for path in files if path.name not in combined]
+        if new_files:
+            raise RuntimeError(
+                f'{len(new_files)} result files in {prr_files_path} are not in '
+                f'the combined output {save_path}. Remove the output (or rerun '
+                f'with --reset) to combine them.')
+        print(f'{save_path.name}: already combined')
+        for file_path in files:
+            os.remove(file_path)
+        return False
+    if not files and (save_path.exists() or output_manifest is not None):
+        raise RuntimeError(f'No result files in {prr_files_path} to combine, '
+                           f'and {save_path} was not recorded as combined. '
+                           f'It was kept.')
+
+    files_fingerprint = checkpoint.file_fingerprint(*files)
+    blocks = [(files[i:i + files_per_block], drug_id_vector, outcome_id_vector)
+              for i in range(0, len(files), files_per_block)]
+    output_manifest = parallel_combine.write_blocks(
+        parallel_combine.prr_files_block, blocks, save_path, codec=codec,
+        shard_rows=shard_rows, sources=[path.name for path in files]
+    )
+    if not parallel_combine.verify_output(output_manifest, save_path.parent):
+        raise RuntimeError(f'Combined output {save_path} failed verification. '
+                           f'Input files in {prr_files_path} were kept.')
+    manifest.mark_done(save_path.name, files_fingerprint)
+    manifest.sync()
+    for file_path in files:
         os.remove(file_path)
+    return True
+
+
+def combine_prr_table(prr_files_path, table_path, drug_id_vector,
+                      outcome_id_vector, manifest, files_per_block=64):
+    """
+    Combine `.npz` result files into a columnar table directory, copying
+    blocks of `files_per_block` files in parallel (see
+    `prr_io.write_prr_table`). Input files are removed only after the table
+    has been verified: its number of rows must be the total length of the
+    files, and every block of rows must match the checksum in its manifest.
+
+    The table is then recorded as done in `manifest` (a
+    `checkpoint.TaskManifest`), before its inputs are removed. When a table
+    is done, rerunning this (eg. after an interruption) keeps it: result
+    files already combined into it are removed, and new result files raise
+    a RuntimeError rather than replacing the table's rows.
+
+    Returns
+    -------
+    bool
+        Whether the table was written
+    """
+    files = sorted(prr_files_path.glob('*.npz'))
+    table_manifest = prr_io.read_table_manifest(table_path)
+    if table_path.name in manifest.done_units() and table_manifest is not None:
+        combined = set(table_manifest['files'])
+        new_files = [path for path in files if path.name not in combined]
+        if new_files:
+            raise RuntimeError(
+                f'{len(new_files)} result files in {prr_files_path} are not in '
+                f'the combined table {table_path}. Remove the table (or rerun '
+                f'with --reset) to combine them.')
+        print(f'{table_path.name}: already combined')
+        for file_path in files:
+            os.remove(file_path)
+        return False
+    if not files and table_path.exists():
+        raise RuntimeError(f'No result files in {prr_files_path} to combine, '
+                           f'and {table_path} was not recorded as combined. '
+                           f'It was kept.')
+
+    files_fingerprint = checkpoint.file_fingerprint(*files)
+    expected_rows = sum(prr_io.npz_length(path) for path in files)
+    table_manifest = prr_io.write_prr_table(files, table_path, drug_id_vector,
+                                            outcome_id_vector, files_per_block)
+    if (table_manifest['rows'] != expected_rows
+            or prr_io.prr_table_length(table_path) != expected_rows
+            or not prr_io.verify_prr_table(table_path)):
+        raise RuntimeError(f'Combined table {table_path} failed verification. '
+                           f'Input files in {prr_files_path} were kept.')
+    print(f'{table_path.name}: {table_manifest["rows"]} rows from '
+          f'{len(files)} files')
+    manifest.mark_done(table_path.name, files_fingerprint)
+    manifest.sync()
+    for file_path in files:
+        os.remove(file_path)
+    return True
+
+
+def export_table_csv(table_path, save_path, rows_per_block=1_000_000,
+                     codec='xz', shard_rows=None):
+    """
+    Export a columnar table as a compressed CSV file (or shards) with drug
+    and outcome IDs, compressing blocks of `rows_per_block` rows in parallel.
+    The table's side table of exposed and unexposed report totals, if any,
+    is exported next to it (eg. `offsides_totals.csv.xz`).
+    """
+    n_rows = prr_io.prr_table_length(table_path)
+    blocks = [(table_path, start, min(start + rows_per_block, n_rows))
+              for start in range(0, n_rows, rows_per_block)]
+    manifest = parallel_combine.write_blocks(
+        parallel_combine.prr_table_block, blocks, save_path, codec=codec,
+        shard_rows=shard_rows
+    )
+    if not parallel_combine.verify_output(manifest, save_path.parent):
+        raise RuntimeError(f'CSV export {save_path} failed verification')
+
+    totals_df = prr_io.read_totals(table_path)
+    if totals_df is not None:
+        totals_path = save_path.with_name(
+            save_path.name.replace('.csv', '_totals.csv', 1))
+        with checkpoint.atomic_path(totals_path) as temp_path:
+            totals_df.to_csv(temp_path, index=False, compression=codec)
 
 
 def combine_files_to_archive(file_paths, save_path):
@@ -29,17 +166,49 @@ def combine_files_to_archive(file_paths, save_path):
 
 def main():
     data_path = pathlib.Path('/data/')
+    meta_files_path = pathlib.Path('/data/meta/')
     tables_path = pathlib.Path('/data/tables/')
     output_archive_path = pathlib.Path('/data/output_archives/')
+    checkpoints_path = pathlib.Path('/data/checkpoints/')
     output_archive_path.mkdir(exist_ok=True)
 
-    # Combine OFFSIDES PRR files and save to a single table file
-    combine_prr_files(data_path.joinpath('prr/1/'),
-                      tables_path.joinpath('offsides.csv.xz'))
+    # Format of the PRR files written by 3.compute_prr.py ("npz" or "csv")
+    prr_format = 'npz'
+
+    # Whether to also export columnar tables as `.csv.xz`
+    export_csv = True
+
+    drug_id_vector = np.load(
+        meta_files_path.joinpath('drug_id_vector.npy')
+    ).astype(str)
+    outcome_id_vector = np.load(
+        meta_files_path.joinpath('outcome_id_vector.npy')
+    )
 
-    # Combine TWOSIDES PRR files and save to a single table file
-    combine_prr_files(data_path.joinpath('prr/2/'),
-                      tables_path.joinpath('twosides.csv.xz'))
+    # Tables combined (and exported) are recorded, so that a rerun does not
+    #  replace them (their input files are removed once combined)
+    with checkpoint.TaskManifest(
+            checkpoints_path.joinpath('4.tables.jsonl')) as manifest:
+        for prr_dir, table_name in [('prr/1/', 'offsides'),
+                                    ('prr/2/', 'twosides')]:
+            if prr_format == 'npz':
+                # Combine PRR files and save to a single columnar table
+                table_path = tables_path.joinpath(f'{table_name}/')
+                combine_prr_table(data_path.joinpath(prr_dir), table_path,
+                                  drug_id_vector, outcome_id_vector, manifest)
+                table_fingerprint = checkpoint.file_fingerprint(
+                    table_path.joinpath(prr_io.TABLE_MANIFEST))
+                if export_csv and not manifest.is_done(f'{table_name}.csv',
+                                                       table_fingerprint):
+                    export_table_csv(
+                        table_path,
+                        tables_path.joinpath(f'{table_name}.csv.xz'))
+                    manifest.mark_done(f'{table_name}.csv', table_fingerprint)
+            else:
+                # Combine PRR files and save to a single table file
+                combine_prr_files(data_path.joinpath(prr_dir),
+                                  tables_path.joinpath(f'{table_name}.csv.xz'),
+                                  drug_id_vector, outcome_id_vector, manifest)
 
     # Save OFFSIDES propensity score files
     combine_files_to_archive(
@@ -49,4 +218,6 @@ def main():
 
 
 if __name__ == "__main__":
+    profiling.start_stage('4.combine_prr_clean')
     main()
+    profiling.write_stage_report()
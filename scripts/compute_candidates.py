@@ -0,0 +1,62 @@
+import concurrent.futures
+import os
+import pathlib
+import sys
+
+import numpy as np
+
+sys.path.insert(0, '../src/')
+import candidates  # noqa:E402
+import matrices  # noqa:E402
+import shared_data  # noqa:E402
+
+
+def compute_candidates(meta_files_path, shared_matrices_path, max_size=4,
+                       min_support=10, n_shards=None):
+    """
+    Find drug combinations (pairs up to `max_size`) co-exposed in at least
+    `min_support` reports, and write a work list for each size,
+    `candidates_{k}.csv`, listing combinations from most to least supported.
+    """
+    report_exposure_matrix = matrices.load_exposure_matrix(
+        meta_files_path.joinpath('drug_exposure_matrix.npz')
+    )
+    n_reports = report_exposure_matrix.shape[0]
+
+    # The exposure matrix has duplicate columns for some drugs. Only the
+    #  first column of each drug is used (see README).
+    drug_id_vector = np.load(meta_files_path.joinpath('drug_id_vector.npy'))
+    _, drug_indices = np.unique(drug_id_vector, return_index=True)
+
+    matrix_specs = {
+        'exposures': shared_data.publish_sparse_matrix(
+            report_exposure_matrix, shared_matrices_path, 'exposures'),
+    }
+    del report_exposure_matrix
+
+    n_shards = n_shards or 4 * os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(
+            initializer=shared_data.init_worker,
+            initargs=(matrix_specs,)) as executor:
+        levels = candidates.frequent_combinations(
+            shared_data.SharedReference('exposures'), n_reports, drug_indices,
+            max_size, min_support, n_shards, executor
+        )
+        for k, combinations, support in levels:
+            print(f'{k} drugs: {len(combinations)} combinations with at least '
+                  f'{min_support} reports')
+            candidates.write_work_list(
+                meta_files_path.joinpath(f'candidates_{k}.csv'), combinations,
+                support
+            )
+
+
+def main():
+    meta_files_path = pathlib.Path('/data/meta/')
+    shared_matrices_path = pathlib.Path('/data/shared_matrices/')
+
+    compute_candidates(meta_files_path, shared_matrices_path)
+
+
+if __name__ == "__main__":
+    main()
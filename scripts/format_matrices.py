@@ -0,0 +1,30 @@
+import argparse
+import pathlib
+import sys
+
+sys.path.insert(0, '../src/')
+import format_matrices  # noqa:E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the report matrices and ID vectors of '
+                    'data/meta_formatted from the AEOLUS chunks and the '
+                    'outcomes table'
+    )
+    parser.add_argument('--unformatted', type=pathlib.Path,
+                        default=pathlib.Path('../data/meta_unformatted/'))
+    parser.add_argument('--aeolus', type=pathlib.Path,
+                        default=pathlib.Path('../data/aeolus/'))
+    parser.add_argument('--formatted', type=pathlib.Path,
+                        default=pathlib.Path('../data/meta_formatted/'))
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='Processes reading exposure chunks')
+    args = parser.parse_args()
+
+    format_matrices.format_matrices(args.unformatted, args.aeolus,
+                                    args.formatted, args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import pathlib
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, '../src/')
+import report_table  # noqa:E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the REPORT table (report year, age and sex) of '
+                    'the reports in report_id_vector.npy'
+    )
+    parser.add_argument('--unformatted', type=pathlib.Path,
+                        default=pathlib.Path('../data/meta_unformatted/'))
+    parser.add_argument('--formatted', type=pathlib.Path,
+                        default=pathlib.Path('../data/meta_formatted/'))
+    parser.add_argument('--tables', type=pathlib.Path,
+                        default=pathlib.Path('../data/tables/'))
+    parser.add_argument('--no-csv', action='store_true',
+                        help='Do not also write report.csv.xz')
+    parser.add_argument('--check-ages', action='store_true',
+                        help='Count ages that disagree with the FAERS '
+                             'demographics table')
+    args = parser.parse_args()
+
+    report_df = report_table.format_report_table(
+        args.unformatted, args.formatted, args.tables.joinpath('report/'),
+        csv_path=None if args.no_csv else args.tables.joinpath('report.csv.xz')
+    )
+    print(f'REPORT: {len(report_df)} reports, sexes '
+          f'{report_df["person_sex"].value_counts().to_dict()}')
+
+    if args.check_ages:
+        demographics_df = pd.read_csv(
+            args.unformatted.joinpath(report_table.DEMOGRAPHICS_FILE),
+            usecols=['isr_report_id', 'age', 'age_code'])
+        disagreements = report_table.age_disagreements(report_df,
+                                                       demographics_df)
+        print(f'{len(disagreements)} ages disagree with the demographics '
+              f'table (kept, as in effect_faers)')
+
+
+if __name__ == "__main__":
+    main()
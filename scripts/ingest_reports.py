@@ -0,0 +1,206 @@
+import argparse
+import importlib.util
+import os
+import pathlib
+import sys
+
+import numpy as np
+
+sys.path.insert(0, '../src/')
+import checkpoint  # noqa:E402
+import incremental  # noqa:E402
+import matrices  # noqa:E402
+import prr_io  # noqa:E402
+import score_store  # noqa:E402
+import shared_data  # noqa:E402
+
+
+def _load_script(file_name, module_name):
+    """Import a pipeline script, whose file name is not a module name"""
+    path = pathlib.Path(__file__).resolve().parent.joinpath(file_name)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+compute_prr = _load_script('3.compute_prr.py', 'compute_prr')
+combine_prr_clean = _load_script('4.combine_prr_clean.py', 'combine_prr_clean')
+
+
+def base_scores_path(data_path, n_drugs):
+    """Score store for `n_drugs`, or the directory of score files"""
+    scores_path = data_path.joinpath(f'score_store/{n_drugs}/')
+    if score_store.is_store(scores_path):
+        return scores_path
+    if n_drugs == 2:
+        raise FileNotFoundError(f'{scores_path} is not a score store. Repack '
+                                f'the TWOSIDES archives with repack_scores.py.')
+    return data_path.joinpath(f'scores/{n_drugs}/')
+
+
+def base_combinations(scores_path):
+    """Drug combinations (tuples of indices) with scores in `scores_path`"""
+    if score_store.is_store(scores_path):
+        keys = score_store.store_keys(score_store.open_store(scores_path))
+    else:
+        keys = [path.name.split('.')[0] for path in scores_path.glob('*.np[yz]')]
+    return sorted(tuple(map(int, key.split('_'))) for key in keys)
+
+
+def ingest_release(release, data_path, increments_path, checkpoints_path,
+                   export_csv=True):
+    """
+    Ingest a FAERS release without recomputing everything.
+
+    The release's reports (`{increments_path}/{release}/`, see
+    `incremental.INCREMENT_FILES`) are appended to the matrices in
+    `data/meta`. Only drugs exposed in a new report, and pairs co-exposed in
+    one, gain exposed reports (A and B), so only they are recomputed, with
+    their scores extended by the release's scores
+    (`{increments_path}/{release}/scores/{1,2}/`). Their rows in
+    `data/tables/offsides` and `data/tables/twosides` are replaced, and the
+    rows of every other drug and pair are carried forward.
+
+    Carried-forward rows keep the unexposed (C and D) counts matched among
+    the reports before the release. Affected drugs or pairs without scores
+    for every release keep their previous rows.
+
+    Every step can be resumed: the append is recorded in
+    `incremental.INCREMENTS_FILE`, and recomputed drugs and pairs in
+    `{checkpoints_path}/ingest_{release}.*.jsonl`.
+    """
+    meta_files_path = data_path.joinpath('meta/')
+    release_path = increments_path.joinpath(f'{release}/')
+
+    first_report = incremental.append_reports(meta_files_path, release_path,
+                                              release)
+    increments = incremental.read_increments(meta_files_path)
+    n_base_reports = int(increments['first_report'].iloc[0])
+    increment_releases = increments['release'].tolist()
+    increment_releases = increment_releases[:increment_releases.index(release) + 1]
+    new_exposures, _, new_report_ids = incremental.load_increment(release_path)
+    print(f'Release {release}: {len(new_report_ids)} reports appended after '
+          f'report {first_report}')
+
+    report_exposure_matrix = matrices.load_exposure_matrix(
+        meta_files_path.joinpath('drug_exposure_matrix.npz')
+    )
+    report_outcome_matrix = matrices.load_outcome_matrix(
+        meta_files_path.joinpath('outcome_matrix.npz')
+    )
+    matrix_specs = {
+        'exposures': shared_data.publish_sparse_matrix(
+            report_exposure_matrix, data_path.joinpath('shared_matrices/'),
+            'exposures'),
+        'outcomes': shared_data.publish_sparse_matrix(
+            report_outcome_matrix, data_path.joinpath('shared_matrices/'),
+            'outcomes'),
+    }
+    del report_exposure_matrix, report_outcome_matrix
+
+    drug_id_vector = np.load(
+        meta_files_path.joinpath('drug_id_vector.npy')
+    ).astype(str)
+    outcome_id_vector = np.load(
+        meta_files_path.joinpath('outcome_id_vector.npy')
+    )
+    run_fingerprint = checkpoint.file_fingerprint(*[
+        meta_files_path.joinpath(name)
+        for name in ('drug_exposure_matrix.npz', 'outcome_matrix.npz',
+                     'drug_id_vector.npy', 'outcome_id_vector.npy')
+    ])
+
+    exposed_drugs = set(incremental.affected_drugs(new_exposures).tolist())
+    for n_drugs, table_name in [(1, 'offsides'), (2, 'twosides')]:
+        with checkpoint.TaskManifest(checkpoints_path.joinpath(
+                f'ingest_{release}.{table_name}.jsonl')) as manifest:
+            if manifest.is_done('table', run_fingerprint):
+                print(f'{table_name}: already updated')
+                continue
+            update_table(release_path, increments_path, increment_releases,
+                         n_base_reports, data_path, n_drugs, table_name,
+                         exposed_drugs, new_exposures, matrix_specs,
+                         drug_id_vector, outcome_id_vector, manifest,
+                         run_fingerprint, export_csv)
+
+
+def update_table(release_path, increments_path, increment_releases,
+                 n_base_reports, data_path, n_drugs, table_name, exposed_drugs,
+                 new_exposures, matrix_specs, drug_id_vector, outcome_id_vector,
+                 manifest, run_fingerprint, export_csv):
+    """
+    Recompute the drugs (or pairs) affected by a release and replace their
+    rows in the table. Completion is recorded in `manifest` as `"table"`.
+    """
+    scores_path = base_scores_path(data_path, n_drugs)
+    combinations = base_combinations(scores_path)
+    if n_drugs == 1:
+        affected = [combination for combination in combinations
+                    if combination[0] in exposed_drugs]
+    else:
+        affected = incremental.affected_combinations(
+            combinations, new_exposures, len(drug_id_vector))
+
+    # Scores of the affected drugs (or pairs) for every report
+    extended_store_path = release_path.joinpath(f'score_store/{n_drugs}/')
+    if not score_store.is_store(extended_store_path):
+        incremental.write_extended_store(
+            extended_store_path, affected, scores_path, n_base_reports,
+            [increments_path.joinpath(f'{name}/scores/{n_drugs}/')
+             for name in increment_releases]
+        )
+    n_extended = len(score_store.store_keys(
+        score_store.open_store(extended_store_path)))
+    print(f'{table_name}: {len(affected)} of {len(combinations)} affected, '
+          f'{n_extended} with scores for the new reports')
+
+    prr_save_path = release_path.joinpath(f'prr/{n_drugs}/')
+    prr_save_path.mkdir(parents=True, exist_ok=True)
+    if n_drugs == 1:
+        compute_prr.compute_prr_offsides(
+            extended_store_path, prr_save_path, matrix_specs, drug_id_vector,
+            outcome_id_vector, manifest=manifest,
+            run_fingerprint=run_fingerprint)
+    else:
+        compute_prr.compute_prr_twosides_store(
+            extended_store_path, matrix_specs, drug_id_vector,
+            outcome_id_vector, prr_save_path, manifest=manifest,
+            run_fingerprint=run_fingerprint)
+
+    # Replace the affected rows, carrying the rest forward
+    table_path = data_path.joinpath(f'tables/{table_name}/')
+    files = sorted(prr_save_path.glob('*.npz'))
+    n_rows = prr_io.update_prr_table(table_path, files)
+    print(f'{table_name}: {n_rows} rows, {len(files)} files replaced')
+    if export_csv:
+        combine_prr_clean.export_table_csv(
+            table_path, data_path.joinpath(f'tables/{table_name}.csv.xz'))
+    manifest.mark_done('table', run_fingerprint)
+    for file_path in files:
+        os.remove(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Append a FAERS release and recompute only what it changes'
+    )
+    parser.add_argument('release',
+                        help='Name of the release directory in --increments')
+    parser.add_argument('--data', type=pathlib.Path,
+                        default=pathlib.Path('/data/'))
+    parser.add_argument('--increments', type=pathlib.Path,
+                        default=pathlib.Path('/data/increments/'))
+    parser.add_argument('--checkpoints', type=pathlib.Path,
+                        default=pathlib.Path('/data/checkpoints/'))
+    parser.add_argument('--no-csv', action='store_true',
+                        help='Do not re-export the updated tables as .csv.xz')
+    args = parser.parse_args()
+
+    ingest_release(args.release, args.data, args.increments, args.checkpoints,
+                   export_csv=not args.no_csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import pathlib
+import sys
+
+sys.path.insert(0, '../src/')
+import db_loader  # noqa:E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load the OFFSIDES and TWOSIDES tables into a database, '
+                    'creating indexes after the rows are loaded'
+    )
+    parser.add_argument('tables', nargs='+', choices=list(db_loader.SCHEMAS))
+    parser.add_argument('--tables-path', type=pathlib.Path,
+                        default=pathlib.Path('../data/tables/'),
+                        help='Columnar tables (eg. offsides/) or their '
+                             '.csv.xz exports, and drug_concept.csv.xz')
+    parser.add_argument('--sqlite', type=pathlib.Path, default=None,
+                        help='SQLite database file, instead of MySQL')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='mnz2108')
+    parser.add_argument('--database', default='effect_nsides')
+    parser.add_argument('--password-file', type=pathlib.Path,
+                        default=pathlib.Path('../mysql_password.txt'))
+    parser.add_argument('--load-data', action='store_true',
+                        help='Load MySQL batches with LOAD DATA LOCAL INFILE')
+    parser.add_argument('--no-indexes', action='store_true')
+    parser.add_argument('--rows-per-block', type=int, default=1_000_000)
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.sqlite is not None:
+        backend = db_loader.SQLiteBackend(args.sqlite)
+    else:
+        with open(args.password_file) as f:
+            password = f.readline().strip()
+        backend = db_loader.MySQLBackend(args.host, args.user, password,
+                                         args.database, args.load_data)
+
+    drug_concepts = db_loader.load_drug_concepts(
+        args.tables_path.joinpath('drug_concept.csv.xz'))
+    try:
+        for table_name in args.tables:
+            source_path = args.tables_path.joinpath(f'{table_name.lower()}/')
+            if not source_path.is_dir():
+                source_path = args.tables_path.joinpath(
+                    f'{table_name.lower()}.csv.xz')
+            db_loader.load_prr_table(
+                backend, table_name, source_path, drug_concepts,
+                rows_per_block=args.rows_per_block,
+                max_workers=args.max_workers,
+                create_indexes=not args.no_indexes)
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, '../src/')
+import calculate_prr  # noqa:E402
+import query_engine  # noqa:E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query an OFFSIDES or TWOSIDES table by drug and '
+                    'condition. Results are written to stdout as CSV.'
+    )
+    parser.add_argument('table', type=pathlib.Path,
+                        help='Columnar table, eg. ../data/tables/twosides/')
+    subparsers = parser.add_subparsers(dest='query', required=True)
+
+    subparsers.add_parser('index', help='Build the query index of the table')
+
+    drug_parser = subparsers.add_parser(
+        'drug', help="Rows of a drug (TWOSIDES: pairs with the drug)")
+    drug_parser.add_argument('drug_id')
+    drug_parser.add_argument('--condition', default=None)
+    drug_parser.add_argument('--signals', action='store_true',
+                             help='Only rows meeting the signal rule')
+    drug_parser.add_argument('--z', type=float,
+                             default=calculate_prr.SignalRule().z)
+    drug_parser.add_argument('--min-prr', type=float,
+                             default=calculate_prr.SignalRule().min_prr)
+
+    pair_parser = subparsers.add_parser('pair', help='Rows of a drug pair')
+    pair_parser.add_argument('drug_id_1')
+    pair_parser.add_argument('drug_id_2')
+    pair_parser.add_argument('--condition', default=None)
+
+    condition_parser = subparsers.add_parser(
+        'condition', help='Rows of a condition, by decreasing PRR')
+    condition_parser.add_argument('condition_id')
+
+    top_parser = subparsers.add_parser(
+        'top', help='Rows of a condition with the highest PRR')
+    top_parser.add_argument('condition_id')
+    top_parser.add_argument('-k', type=int, default=10)
+    top_parser.add_argument('--min-a', type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.query == 'index':
+        n_rows = query_engine.build_query_index(args.table)
+        print(f'Indexed {n_rows} rows in {time.perf_counter() - start:.1f} s',
+              file=sys.stderr)
+        return
+
+    table = query_engine.PRRTable(args.table)
+    if args.query == 'drug' and args.signals:
+        df = table.signals(args.drug_id, calculate_prr.SignalRule(
+            args.z, args.min_prr), args.condition)
+    elif args.query == 'drug':
+        df = table.drug_rows(args.drug_id, args.condition)
+    elif args.query == 'pair':
+        df = table.pair_rows(args.drug_id_1, args.drug_id_2, args.condition)
+    elif args.query == 'condition':
+        df = table.condition_rows(args.condition_id)
+    else:
+        df = table.top_prr(args.condition_id, args.k, args.min_a)
+    df.to_csv(sys.stdout, index=False)
+    print(f'{len(df)} rows in {1000 * (time.perf_counter() - start):.1f} ms',
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
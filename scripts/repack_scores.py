@@ -0,0 +1,119 @@
+import concurrent.futures
+import functools
+import pathlib
+import sys
+import tarfile
+
+import numpy as np
+import tqdm
+
+sys.path.insert(0, '../src/')
+import score_store  # noqa:E402
+import utils  # noqa:E402
+
+
+def _offsides_score_paths(computed_scores_path):
+    return sorted(computed_scores_path.glob('*.npz'),
+                  key=lambda path: int(path.stem))
+
+
+def _load_offsides_scores(path):
+    with np.load(path) as scores_item:
+        return scores_item['scores']
+
+
+def repack_offsides(computed_scores_path, store_path, codec='raw',
+                    quantization='float64'):
+    """
+    Repack averaged OFFSIDES scores (`{drug}.npz` files, from
+    2.compute_propensity_scores.py) into a single shard keyed by drug index.
+    Uncompressed by default, so that scores are memory-mapped on reading.
+    """
+    score_paths = _offsides_score_paths(computed_scores_path)
+    items = ((path.stem, _load_offsides_scores(path))
+             for path in tqdm.tqdm(score_paths))
+    score_store.create_store(store_path, quantization=quantization)
+    return score_store.write_shard(store_path, 'offsides', items, codec=codec)
+
+
+def repack_offsides_matrix(computed_scores_path, store_path,
+                           quantization='bins'):
+    """
+    Repack averaged OFFSIDES scores into a dense (n_drugs x n_reports)
+    matrix, by default of uint8 bin codes (see `score_store.QUANTIZATIONS`).
+    """
+    score_paths = _offsides_score_paths(computed_scores_path)
+    arrays = (_load_offsides_scores(path) for path in tqdm.tqdm(score_paths))
+    return score_store.write_score_matrix(
+        store_path, [path.stem for path in score_paths], arrays,
+        quantization=quantization)
+
+
+def repack_archive_twosides(archive_path, store_path, codec='zlib'):
+    """
+    Repack the pair scores of one TWOSIDES archive into a shard named after
+    the archive, keyed like `"1001_1888"`. The archive is streamed once.
+    """
+    def items():
+        archive_arrays = utils.iter_archive_arrays(
+            archive_path, member_filter=lambda name: 'score' in name)
+        for name, array in archive_arrays:
+            if array is None:
+                continue
+            drug_indices = utils.extract_indices_twosides(name)
+            yield '_'.join(map(str, drug_indices)), array
+
+    shard_name = archive_path.name.split('.')[0]
+    try:
+        return score_store.write_shard(store_path, shard_name, items(),
+                                       codec=codec)
+    except (tarfile.ReadError, EOFError):
+        print(f'Could not read {archive_path.name}')
+        return 0
+
+
+def repack_twosides(archives_path, store_path, codec='zlib',
+                    quantization='float64', max_workers=None):
+    """Repack every TWOSIDES archive in parallel, one shard per archive"""
+    archive_paths = sorted(archives_path.glob('scores_*.tgz'))
+    score_store.create_store(store_path, quantization=quantization)
+    repack_one = functools.partial(repack_archive_twosides,
+                                   store_path=store_path, codec=codec)
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        n_arrays = list(
+            tqdm.tqdm(executor.map(repack_one, archive_paths),
+                      total=len(archive_paths))
+        )
+    return sum(n_arrays)
+
+
+def main():
+    computed_scores_path = pathlib.Path('/data/scores/1/')
+    twosides_archives_path = pathlib.Path('/data/archives/2/')
+    store_path = pathlib.Path('/data/score_store/')
+
+    # Keep full scores ("float64"), or only what PRR computation needs:
+    #  "bins" (uint8 bin codes, 8x smaller) or "float16" scores
+    quantization = 'bins'
+
+    # Store OFFSIDES scores as a dense, memory-mapped (drugs x reports) matrix
+    offsides_matrix = True
+
+    if offsides_matrix:
+        n_offsides = repack_offsides_matrix(computed_scores_path,
+                                            store_path.joinpath('1/'),
+                                            quantization=quantization)
+    else:
+        n_offsides = repack_offsides(computed_scores_path,
+                                     store_path.joinpath('1/'),
+                                     quantization=quantization)
+    print(f'OFFSIDES: {n_offsides} drugs')
+
+    n_twosides = repack_twosides(twosides_archives_path,
+                                 store_path.joinpath('2/'),
+                                 quantization=quantization)
+    print(f'TWOSIDES: {n_twosides} pairs')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import ast
+import pathlib
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, '../src/')
+import checkpoint  # noqa:E402
+
+STAGES = [
+    '1.compute_file_maps.py',
+    '2.compute_propensity_scores.py',
+    '3.compute_prr.py',
+    '4.combine_prr_clean.py',
+]
+
+# Inputs of each stage (globs in the data directory) that are not written by
+#  an earlier stage, such as the archives and the report matrices. Outputs of
+#  earlier stages are covered by rerunning every stage after one that runs.
+STAGE_INPUTS = {
+    '1.compute_file_maps.py': ['archives/1/scores_*.tgz',
+                               'archives/2/scores_*.tgz'],
+    '2.compute_propensity_scores.py': ['archives/1/scores_*.tgz'],
+    '3.compute_prr.py': ['meta/drug_exposure_matrix.npz',
+                         'meta/outcome_matrix.npz', 'meta/drug_id_vector.npy',
+                         'meta/outcome_id_vector.npy', 'meta/candidates_*.csv',
+                         'archives/2/scores_*.tgz', 'scores/[34]/*.np[yz]',
+                         'score_store/*/*.json', 'score_store/*/*.index.csv',
+                         'score_store/*/*.npy'],
+    '4.combine_prr_clean.py': ['meta/drug_id_vector.npy',
+                               'meta/outcome_id_vector.npy'],
+}
+
+
+def imported_modules(path, src_path, modules=None):
+    """
+    Modules of `src_path` that a script imports, directly or through other
+    modules of `src_path`
+    """
+    modules = set() if modules is None else modules
+    for node in ast.walk(ast.parse(path.read_text())):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module_path = src_path.joinpath(f'{name.split(".")[0]}.py')
+            if module_path.is_file() and module_path not in modules:
+                modules.add(module_path)
+                imported_modules(module_path, src_path, modules)
+    return modules
+
+
+def stage_fingerprint(script_path, src_path, data_path):
+    """
+    Fingerprint of a stage's script, the modules it imports, and its inputs
+    (see `STAGE_INPUTS`)
+    """
+    inputs = sorted(path for pattern in STAGE_INPUTS[script_path.name]
+                    for path in data_path.glob(pattern))
+    return checkpoint.fingerprint(
+        checkpoint.file_fingerprint(
+            script_path, *sorted(imported_modules(script_path, src_path))),
+        [str(path.relative_to(data_path)) for path in inputs],
+        checkpoint.file_fingerprint(*inputs)
+    )
+
+
+def run_pipeline(checkpoints_path, data_path=pathlib.Path('/data/'),
+                 from_stage=None, to_stage=len(STAGES), reset=False):
+    """
+    Run the pipeline scripts in order, skipping stages that completed with
+    the same code and inputs (see `stage_fingerprint`), as did the stages
+    before them. Each completed stage is recorded in `pipeline.jsonl`. Once
+    a stage runs, every later stage runs too.
+
+    Within stages, completed units of work (archives, drugs, pairs) are
+    recorded in `{stage}.*.jsonl` (see `checkpoint.TaskManifest`), so a stage
+    that is rerun or was interrupted resumes from its last checkpoint.
+
+    Parameters
+    ----------
+    checkpoints_path : pathlib.Path
+    data_path : pathlib.Path
+        Data directory the stages read from, for the inputs' fingerprints
+    from_stage : int
+        Rerun stages from this one (1-based), even if they completed. By
+        default only incomplete stages are run.
+    to_stage : int
+        Last stage to run
+    reset : bool
+        Also forget the completed units of the rerun stages, so that they
+        are recomputed from scratch
+    """
+    scripts_path = pathlib.Path(__file__).resolve().parent
+    src_path = scripts_path.parent.joinpath('src')
+    with checkpoint.TaskManifest(
+            checkpoints_path.joinpath('pipeline.jsonl')) as manifest:
+        pipeline_fingerprint = None
+        upstream_ran = False
+        for stage, script in enumerate(STAGES, start=1):
+            if stage > to_stage:
+                break
+            pipeline_fingerprint = checkpoint.fingerprint(
+                pipeline_fingerprint,
+                stage_fingerprint(scripts_path.joinpath(script), src_path,
+                                  data_path)
+            )
+            rerun = from_stage is not None and stage >= from_stage
+            if (not (rerun or upstream_ran)
+                    and manifest.is_done(script, pipeline_fingerprint)):
+                print(f'Stage {stage} ({script}) already complete')
+                continue
+
+            if rerun and reset:
+                for unit_manifest in checkpoints_path.glob(f'{stage}.*.jsonl'):
+                    unit_manifest.unlink()
+
+            print(f'Starting stage {stage} / {len(STAGES)} ({script})')
+            start_time = time.time()
+            subprocess.run([sys.executable, script], cwd=scripts_path,
+                           check=True)
+            manifest.mark_done(script, pipeline_fingerprint)
+            manifest.sync()
+            upstream_ran = True
+            print(f'Finished stage {stage} in {time.time() - start_time:.0f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the pipeline, resuming from the last checkpoint'
+    )
+    parser.add_argument('--from-stage', type=int, default=None,
+                        help='Rerun stages from this one, even if complete')
+    parser.add_argument('--to-stage', type=int, default=len(STAGES))
+    parser.add_argument('--reset', action='store_true',
+                        help='Recompute rerun stages from scratch, instead of '
+                             'resuming them from their checkpoints')
+    parser.add_argument('--checkpoints', type=pathlib.Path,
+                        default=pathlib.Path('/data/checkpoints/'))
+    parser.add_argument('--data', type=pathlib.Path,
+                        default=pathlib.Path('/data/'))
+    args = parser.parse_args()
+
+    run_pipeline(args.checkpoints, args.data, from_stage=args.from_stage,
+                 to_stage=args.to_stage, reset=args.reset)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,44 @@
 import collections
+import warnings
 
 import numpy as np
+import scipy.sparse
+
+import profiling
+
+# Default propensity score bins, [0, 0.2, 0.4, 0.6, 0.8, 1]
+DEFAULT_BINS = np.arange(0, 1.2, 0.2)
+
+# Significance rule of the "signals" output rows: the lower bound of the
+#  `z` confidence interval of PRR is above `min_prr`, ie.
+#  log(PRR) - z * PRR_error > log(min_prr)
+SignalRule = collections.namedtuple('SignalRule', ['z', 'min_prr'],
+                                    defaults=[1.96, 2.0])
+
+# Which outcomes' rows are kept in the results of a drug (see
+#  `compute_prr_rows`). A `SignalRule` may also be given.
+OUTPUT_ROWS = ('all', 'exposed', 'signals')
+
+# How unexposed reports are matched to the exposed reports of a drug:
+#  sampled 10 per exposed report in the same bin (`match_unexposed_by_bin`),
+#  or the expected outcome counts of that sample (`expected_unexposed_by_bin`).
+#  A `QuantileBins` or `Caliper` may also be given.
+MATCHING = ('sampled', 'expected')
+
+# Matching in `n_bins` bins between quantiles of the exposed reports' scores
+#  in the region of common support (see `quantile_bin_scores`), sampled or,
+#  with `expected`, as expected counts. The paper uses 20 bins.
+QuantileBins = collections.namedtuple('QuantileBins', ['n_bins', 'expected'],
+                                      defaults=[20, False])
+
+# Matching to the `n_neighbors` unexposed reports with the nearest scores,
+#  within `width` (see `match_nearest_unexposed`)
+Caliper = collections.namedtuple('Caliper', ['width', 'n_neighbors'],
+                                 defaults=[0.01, 10])
 
 
 def compute_ABCD_one_drug(drug_exposures, drug_propensity_scores, all_outcomes,
-                          bins=np.arange(0, 1.2, 0.2), seed=0):
+                          bins=DEFAULT_BINS, seed=0, matching='sampled'):
     """
     Compute the propensity-score-matched numbers of reports with combinations
     of drug exposure and outcome occurrence.
@@ -12,7 +46,9 @@ def compute_ABCD_one_drug(drug_exposures, drug_propensity_scores, all_outcomes,
     This procedure splits the range of potential propensity scores into `bins`.
     Controls (unexposed reports) are sampled to give 10 times the number of
     controls as cases (exposed reports), in each bin. If a bin contains only
-    controls or only cases, then no reports are added from the bin.
+    controls or only cases, then no reports are added from the bin. With
+    `matching="expected"`, C is instead the expected value of this sample,
+    which is deterministic (see `expected_unexposed_by_bin`).
 
     Note that for simplicity, "drug" refers to a specific single drug or a
     specific combination of drugs. When computing PRR for drug pairs
@@ -24,7 +60,8 @@ def compute_ABCD_one_drug(drug_exposures, drug_propensity_scores, all_outcomes,
     drug_exposures : scipy.sparse.csc_matrix
         Binary vector of exposures to the given drug. Shape is (n_reports x 1)
     drug_propensity_scores : numpy.ndarray
-        Vector of propensity scores for exposure to the given drug. Shape is
+        Vector of propensity scores for exposure to the given drug, or their
+        `uint8` bin codes for these `bins` (see `bin_scores`). Shape is
         (n_reports x 1)
     all_outcomes : scipy.sparse.csc_matrix
         Matrix of reports (rows) by outcomes (columns). Shape is
@@ -33,11 +70,15 @@ def compute_ABCD_one_drug(drug_exposures, drug_propensity_scores, all_outcomes,
         Default is [0, 0.2, 0.4, 0.6, 0.8, 1]
     seed : int
         Random seed for sampling unexposed controls for each PSM bin
+    matching : str, QuantileBins or Caliper
+        `"sampled"` (default) or `"expected"` with `bins`, or finer matching
+        strategies (see `MATCHING`), which need scores rather than bin codes
 
     Returns
     -------
     Tuple[numpy.ndarray, int, numpy.ndarray, int]
-        A, A + B, C, C + D.
+        A, A + B, C, C + D. C is a float vector of expected counts with
+        `matching="expected"`.
 
         A is a vector of outcomes, where each value is the number of reports
         with that exposure having the outcome.
@@ -47,44 +88,31 @@ def compute_ABCD_one_drug(drug_exposures, drug_propensity_scores, all_outcomes,
         C + D is the total number of the non-drug-exposed reports.
     """
     # Find the (row) indices of reports exposed to the drug
+    _check_matching(matching)
     exposed_indices, _ = drug_exposures.nonzero()
 
     # Default bins and this binning procedure were found in Rami's work.
     #  Unlike the paper, this method does not divide the region of overlap
     #  into 20 bins, though this method may be more appropriate for drug
     #  combinations, where we don't expect many people to have been exposed.
-    binned_scores = np.digitize(drug_propensity_scores, bins=bins)
-    exposed_bin_freq = collections.Counter(binned_scores[exposed_indices])
-
-    # Set random seed for reproducible sampling
-    np.random.seed(seed)
-
-    # Sample (with replacement) 10x unexposed for each exposed (bin-wise)
-    matched_exposed_indices = list()
-    matched_unexposed_indices = list()
-    for bin_number, num_exposed_bin in exposed_bin_freq.items():
-        if num_exposed_bin == 0:
-            continue
+    #  The paper's binning is `matching=QuantileBins(20)`.
+    if _is_expected(matching):
+        binned_scores, exposed_indices = _bin_drug_scores(
+            exposed_indices, drug_propensity_scores, bins, matching)
+        with profiling.timer('matching'):
+            matched_exposed_indices, unexposed_bins, bin_weights = \
+                expected_unexposed_by_bin(exposed_indices, binned_scores)
+        with profiling.timer('outcome_sums'):
+            exposed_with_outcome = all_outcomes[matched_exposed_indices].sum(axis=0)
+            exposed_with_outcome = np.array(exposed_with_outcome).flatten()
+            unexposed_with_outcome = expected_outcome_counts(
+                unexposed_bins, bin_weights, all_outcomes)
+        return (exposed_with_outcome, len(matched_exposed_indices),
+                unexposed_with_outcome, 10 * len(matched_exposed_indices))
 
-        # Indices of all reports in this bin
-        reports_in_bin = np.where(binned_scores == bin_number)[0]
-        reports_in_bin = set(reports_in_bin.tolist())
-
-        # Indices of unexposed reports in this bin
-        available_unexposed_indices = reports_in_bin - set(exposed_indices)
-        if len(available_unexposed_indices) == 0:
-            continue
-
-        # Indices of exposed reports in this bin
-        bin_exposed_indices = reports_in_bin.intersection(set(exposed_indices))
-        matched_exposed_indices.extend(list(bin_exposed_indices))
-
-        # The number of unexposed to sample
-        num_unexposed = 10 * num_exposed_bin
-        # Sample with replacement from unexposed indices
-        unexposed_sample = np.random.choice(list(available_unexposed_indices),
-                                            size=num_unexposed, replace=True)
-        matched_unexposed_indices.extend(unexposed_sample)
+    matched_exposed_indices, matched_unexposed_indices, unexposed_counts = \
+        _match_drug(exposed_indices, drug_propensity_scores, bins, seed,
+                    matching)
 
     # A + B is the number exposed to the given drug
     n_exposed = len(matched_exposed_indices)
@@ -93,21 +121,597 @@ def compute_ABCD_one_drug(drug_exposures, drug_propensity_scores, all_outcomes,
     #  Here computing A for all outcomes simultaneously, so exposed_with_outcome
     #  is a vector where each index is an outcome and the value is the number
     # drug exposed with the outcome.
-    exposed_with_outcome = all_outcomes[matched_exposed_indices].sum(axis=0)
-    exposed_with_outcome = np.array(exposed_with_outcome).flatten()
+    with profiling.timer('outcome_sums'):
+        exposed_with_outcome = all_outcomes[matched_exposed_indices].sum(axis=0)
+        exposed_with_outcome = np.array(exposed_with_outcome).flatten()
 
     # C + D is the number of propensity matched reports unexposed to the drug
-    # Should always be 10 * n_exposed, but re-compute to be safe
-    n_unexposed = len(matched_unexposed_indices)
+    # Should always be 10 * n_exposed (except with a `Caliper`), but
+    #  re-compute to be safe
+    n_unexposed = int(unexposed_counts.sum())
 
-    # C is the number unexposed with the outcome
-    unexposed_with_outcome = all_outcomes[matched_unexposed_indices].sum(axis=0)
-    unexposed_with_outcome = np.array(unexposed_with_outcome).flatten()
+    # C is the number unexposed with the outcome. Reports sampled more than
+    #  once are gathered a single time and weighted by their sample count.
+    with profiling.timer('outcome_sums'):
+        unexposed_with_outcome = (
+            all_outcomes[matched_unexposed_indices].T.dot(unexposed_counts)
+        )
+        unexposed_with_outcome = np.asarray(unexposed_with_outcome).flatten()
 
     # Return A, A+B, C, C+D
     return exposed_with_outcome, n_exposed, unexposed_with_outcome, n_unexposed
 
 
+def bin_scores(drug_propensity_scores, bins=DEFAULT_BINS):
+    """
+    Bin codes (`numpy.digitize`) of propensity scores, as `uint8`. Scores that
+    are already `uint8` bin codes (eg. from a quantized score store, see
+    `score_store.quantize_scores`) are returned unchanged, so that they need
+    not be digitized again.
+    """
+    if drug_propensity_scores.dtype == np.uint8:
+        return drug_propensity_scores
+    if len(bins) >= np.iinfo(np.uint8).max:
+        return np.digitize(drug_propensity_scores, bins=bins)
+    return np.digitize(drug_propensity_scores, bins=bins).astype(np.uint8)
+
+
+def quantile_bin_scores(drug_propensity_scores, exposed_indices, n_bins=20):
+    """
+    Bin codes for `n_bins` bins over the region of common support, the range
+    of scores shared by exposed and unexposed reports, with edges at
+    quantiles of the exposed reports' scores in the region, so that bins
+    hold about equal numbers of exposed reports. Reports are binned with one
+    `numpy.searchsorted` over the edges, so the cost hardly depends on
+    `n_bins`.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        Bin codes 1 to `n_bins` (0 outside the region of common support),
+        and the exposed indices inside the region, the only ones matched
+    """
+    if drug_propensity_scores.dtype == np.uint8:
+        raise ValueError('Quantile bins need propensity scores, not the bin '
+                         'codes of a quantized score store')
+    scores = np.asarray(drug_propensity_scores).ravel()
+    exposed_indices = np.asarray(exposed_indices, dtype=np.int64)
+    is_exposed = np.zeros(scores.shape[0], dtype=bool)
+    is_exposed[exposed_indices] = True
+    exposed_scores = scores[exposed_indices]
+    unexposed_scores = scores[~is_exposed]
+    if len(exposed_scores) == 0 or len(unexposed_scores) == 0:
+        return (np.zeros(scores.shape[0], dtype=np.uint16),
+                exposed_indices[:0])
+
+    low = max(exposed_scores.min(), unexposed_scores.min())
+    high = min(exposed_scores.max(), unexposed_scores.max())
+    in_support = (exposed_scores >= low) & (exposed_scores <= high)
+    if not in_support.any():
+        return (np.zeros(scores.shape[0], dtype=np.uint16),
+                exposed_indices[:0])
+
+    edges = np.quantile(exposed_scores[in_support],
+                        np.linspace(0, 1, n_bins + 1)[1:-1])
+    binned_scores = np.searchsorted(edges, scores, side='right') + 1
+    binned_scores[(scores < low) | (scores > high)] = 0
+    return (binned_scores.astype(np.min_scalar_type(n_bins)),
+            exposed_indices[in_support])
+
+
+def match_nearest_unexposed(exposed_indices, drug_propensity_scores,
+                            width=0.01, n_neighbors=10):
+    """
+    Match each exposed report to the `n_neighbors` unexposed reports with the
+    nearest propensity scores (with replacement across exposed reports),
+    leaving out neighbors further than `width` away. Exposed reports without
+    any unexposed report within `width` are not matched. The unexposed scores
+    are sorted once, and the nearest neighbors of every exposed report are
+    among the `n_neighbors` sorted scores on either side of its position
+    (`numpy.searchsorted`), so matching is deterministic and takes
+    O(n_reports log n_reports + n_exposed * n_neighbors).
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        As for `match_unexposed_by_bin`: matched exposed indices, the
+        distinct matched unexposed indices, and the number of times each of
+        those was matched
+    """
+    if drug_propensity_scores.dtype == np.uint8:
+        raise ValueError('Caliper matching needs propensity scores, not the '
+                         'bin codes of a quantized score store')
+    scores = np.asarray(drug_propensity_scores).ravel()
+    exposed_indices = np.asarray(exposed_indices, dtype=np.int64)
+    is_exposed = np.zeros(scores.shape[0], dtype=bool)
+    is_exposed[exposed_indices] = True
+    unexposed_indices = np.flatnonzero(~is_exposed)
+    unexposed_indices = unexposed_indices[
+        np.argsort(scores[unexposed_indices], kind='stable')]
+    sorted_scores = scores[unexposed_indices]
+    exposed_scores = scores[exposed_indices]
+
+    # Candidate positions (n_exposed x 2 * n_neighbors) around each exposed
+    #  report's position in the sorted unexposed scores
+    positions = (np.searchsorted(sorted_scores, exposed_scores)[:, np.newaxis]
+                 + np.arange(-n_neighbors, n_neighbors))
+    is_valid = (positions >= 0) & (positions < len(sorted_scores))
+    positions = np.clip(positions, 0, max(len(sorted_scores) - 1, 0))
+    distances = np.full(positions.shape, np.inf)
+    if len(sorted_scores) > 0:
+        distances = np.where(
+            is_valid,
+            np.abs(sorted_scores[positions] - exposed_scores[:, np.newaxis]),
+            np.inf)
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbors]
+    is_match = np.take_along_axis(distances, nearest, axis=1) <= width
+
+    matched_exposed_indices = exposed_indices[is_match.any(axis=1)]
+    match_counts = np.bincount(
+        np.take_along_axis(positions, nearest, axis=1)[is_match],
+        minlength=len(unexposed_indices))
+    matched = np.flatnonzero(match_counts)
+    return (matched_exposed_indices, unexposed_indices[matched],
+            match_counts[matched])
+
+
+def match_unexposed_by_bin(exposed_indices, binned_scores, seed=0):
+    """
+    Propensity-score-match unexposed reports to the exposed reports of a
+    drug, sampling (with replacement) 10 unexposed reports for each exposed
+    report in the same bin.
+
+    Bins are visited in the order in which they first occur among the exposed
+    reports, and within a bin the unexposed candidates are in ascending
+    report order. Samples are drawn from the global NumPy random state, which
+    is seeded with `seed`, with one draw of `10 * n_exposed_in_bin` integers
+    per bin.
+
+    Parameters
+    ----------
+    exposed_indices : numpy.ndarray
+        Row indices of the reports exposed to the drug
+    binned_scores : numpy.ndarray
+        Propensity score bin of each report, eg. from `numpy.digitize`. Shape
+        is (n_reports,)
+    seed : int
+        Random seed for sampling unexposed controls for each PSM bin
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        Matched exposed indices, the distinct sampled unexposed indices, and
+        the number of times each of those unexposed reports was sampled.
+    """
+    binned_scores = np.asarray(binned_scores).ravel()
+    exposed_indices = np.asarray(exposed_indices, dtype=np.int64)
+    n_bins = int(binned_scores.max()) + 1 if binned_scores.size else 0
+
+    is_exposed = np.zeros(binned_scores.shape[0], dtype=bool)
+    is_exposed[exposed_indices] = True
+    exposed_bins = binned_scores[exposed_indices]
+
+    # Group unexposed reports by bin (stable, so ascending within each bin).
+    #  A narrow integer type lets NumPy use a radix sort for the grouping.
+    unexposed_indices = np.flatnonzero(~is_exposed)
+    unexposed_bins = binned_scores[unexposed_indices]
+    if n_bins <= np.iinfo(np.uint16).max:
+        unexposed_bins = unexposed_bins.astype(np.uint16)
+    unexposed_indices = unexposed_indices[np.argsort(unexposed_bins, kind='stable')]
+    n_unexposed_bin = np.bincount(unexposed_bins, minlength=n_bins)
+    bin_starts = np.concatenate([[0], np.cumsum(n_unexposed_bin)[:-1]])
+    n_exposed_bin = np.bincount(exposed_bins, minlength=n_bins)
+
+    # Bins in order of first occurrence among exposed reports
+    unique_bins, first_position = np.unique(exposed_bins, return_index=True)
+    bin_order = unique_bins[np.argsort(first_position)]
+
+    # Seeded local generator for reproducible sampling (the same stream as
+    #  seeding the global one, but safe to use from several threads)
+    random_state = np.random.RandomState(seed)
+
+    # Sample (with replacement) 10x unexposed for each exposed (bin-wise)
+    keep_bins = list()
+    sampled_positions = list()
+    for bin_number in bin_order:
+        n_available = n_unexposed_bin[bin_number]
+        if n_available == 0:
+            continue
+        keep_bins.append(bin_number)
+        draws = random_state.randint(0, n_available,
+                                     size=10 * n_exposed_bin[bin_number])
+        sampled_positions.append(bin_starts[bin_number] + draws)
+
+    matched_exposed_indices = exposed_indices[np.isin(exposed_bins, keep_bins)]
+    if len(sampled_positions) == 0:
+        empty = np.array([], dtype=np.int64)
+        return matched_exposed_indices, empty, empty
+
+    # Count how many times each unexposed report was sampled
+    sample_counts = np.bincount(np.concatenate(sampled_positions),
+                                minlength=unexposed_indices.shape[0])
+    sampled = np.flatnonzero(sample_counts)
+    return (matched_exposed_indices, unexposed_indices[sampled],
+            sample_counts[sampled])
+
+
+def expected_unexposed_by_bin(exposed_indices, binned_scores):
+    """
+    The expected value of `match_unexposed_by_bin`, without sampling. Within
+    a bin, sampling 10 unexposed reports per exposed report gives each
+    unexposed report of the bin an expected weight of
+    `10 * n_exposed_in_bin / n_unexposed_in_bin`, so the expected C is the
+    sum of the bin's unexposed outcome rows times that weight, for every bin
+    with both exposed and unexposed reports.
+
+    Parameters
+    ----------
+    exposed_indices : numpy.ndarray
+        Row indices of the reports exposed to the drug
+    binned_scores : numpy.ndarray
+        Propensity score bin of each report, eg. from `numpy.digitize`. Shape
+        is (n_reports,)
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, scipy.sparse.csc_matrix, numpy.ndarray]
+        Matched exposed indices (those in bins with unexposed reports), a
+        one-hot (n_reports x n_bins) matrix of the bins of the unexposed
+        reports in matched bins, and the expected weight of an unexposed
+        report in each bin. See `expected_outcome_counts`.
+    """
+    binned_scores = np.asarray(binned_scores).ravel()
+    exposed_indices = np.asarray(exposed_indices, dtype=np.int64)
+    n_reports = binned_scores.shape[0]
+    n_bins = int(binned_scores.max()) + 1 if binned_scores.size else 0
+
+    is_exposed = np.zeros(n_reports, dtype=bool)
+    is_exposed[exposed_indices] = True
+    exposed_bins = binned_scores[exposed_indices]
+    n_exposed_bin = np.bincount(exposed_bins, minlength=n_bins)
+    n_unexposed_bin = np.bincount(binned_scores, minlength=n_bins) - n_exposed_bin
+
+    is_matched_bin = (n_exposed_bin > 0) & (n_unexposed_bin > 0)
+    bin_weights = np.zeros(n_bins)
+    bin_weights[is_matched_bin] = (10 * n_exposed_bin[is_matched_bin]
+                                   / n_unexposed_bin[is_matched_bin])
+
+    matched_exposed_indices = exposed_indices[is_matched_bin[exposed_bins]]
+    unexposed_indices = np.flatnonzero(~is_exposed
+                                       & is_matched_bin[binned_scores])
+    unexposed_bins = scipy.sparse.csc_matrix(
+        (np.ones(len(unexposed_indices), dtype=np.int64),
+         (unexposed_indices, binned_scores[unexposed_indices])),
+        shape=(n_reports, n_bins)
+    )
+    return matched_exposed_indices, unexposed_bins, bin_weights
+
+
+def expected_outcome_counts(unexposed_bins, bin_weights, all_outcomes):
+    """
+    Expected C of each outcome, the outcome counts of the unexposed reports
+    in each bin, `all_outcomes.T @ unexposed_bins`, weighted by
+    `bin_weights` (see `expected_unexposed_by_bin`). This is evaluated as
+    `all_outcomes.T @ (unexposed_bins @ bin_weights)`, a single
+    matrix-vector product, which is about 3x faster than the per-bin counts.
+    Outcomes that no matched unexposed report has are exactly 0.
+    """
+    report_weights = unexposed_bins.dot(bin_weights)
+    return np.asarray(all_outcomes.T.dot(report_weights)).ravel()
+
+
+def _check_matching(matching):
+    if isinstance(matching, (QuantileBins, Caliper)):
+        return
+    if matching not in MATCHING:
+        raise ValueError(f'Unknown matching {matching}. Options are '
+                         f'{list(MATCHING)}, QuantileBins or Caliper')
+
+
+def _is_expected(matching):
+    if isinstance(matching, QuantileBins):
+        return matching.expected
+    return matching == 'expected'
+
+
+def _bin_drug_scores(exposed_indices, drug_propensity_scores, bins, matching):
+    """Bin codes of a drug's reports, and the exposed reports to match"""
+    with profiling.timer('binning'):
+        if isinstance(matching, QuantileBins):
+            return quantile_bin_scores(drug_propensity_scores,
+                                       exposed_indices, matching.n_bins)
+        return bin_scores(drug_propensity_scores, bins=bins), exposed_indices
+
+
+def _match_drug(exposed_indices, drug_propensity_scores, bins, seed,
+                matching):
+    """
+    Matched exposed indices, sampled (or nearest) unexposed indices and
+    their counts, for any `matching` but expected counts
+    """
+    if isinstance(matching, Caliper):
+        with profiling.timer('matching'):
+            return match_nearest_unexposed(exposed_indices,
+                                           drug_propensity_scores,
+                                           matching.width,
+                                           matching.n_neighbors)
+    binned_scores, exposed_indices = _bin_drug_scores(
+        exposed_indices, drug_propensity_scores, bins, matching)
+    with profiling.timer('matching'):
+        return match_unexposed_by_bin(exposed_indices, binned_scores,
+                                      seed=seed)
+
+
+def compute_ABCD_drug_block(drug_exposures_and_scores, all_outcomes,
+                            bins=DEFAULT_BINS, seed=0, matching='sampled'):
+    """
+    Compute A, A + B, C and C + D for a block of drugs at once. Each drug is
+    matched exactly as in `compute_ABCD_one_drug` (so results are identical
+    for the same seed), but instead of gathering outcome rows for each drug,
+    the matched reports of all drugs in the block are written as columns of a
+    sparse weight matrix W (n_reports x 2k). A and C for every drug then come
+    from a single sparse product of the outcome matrix with W.
+
+    Exposed reports get weight 1 in their drug's exposed column. Unexposed
+    reports get weight equal to the number of times they were sampled (with
+    replacement) in their drug's unexposed column. With
+    `matching="expected"`, the unexposed columns are empty and C is instead
+    computed for each drug from its per-bin outcome counts (see
+    `expected_unexposed_by_bin`).
+
+    Parameters
+    ----------
+    drug_exposures_and_scores : Iterable[Tuple[scipy.sparse.csc_matrix, numpy.ndarray]]
+        (drug_exposures, drug_propensity_scores) for each drug in the block,
+        as for `compute_ABCD_one_drug`. This is consumed lazily, so a
+        generator can be used to hold only one drug's scores in memory.
+    all_outcomes : scipy.sparse.csc_matrix
+        Matrix of reports (rows) by outcomes (columns). Shape is
+        (n_reports x n_outcomes)
+    bins : numpy.ndarray
+        Default is [0, 0.2, 0.4, 0.6, 0.8, 1]
+    seed : int
+        Random seed for sampling unexposed controls, used for every drug
+    matching : str, QuantileBins or Caliper
+        See `compute_ABCD_one_drug`
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        A, A + B, C, C + D. A and C have shape (k x n_outcomes), while A + B
+        and C + D have shape (k,).
+    """
+    _check_matching(matching)
+    rows = list()
+    columns = list()
+    weights = list()
+    n_exposed = list()
+    n_unexposed = list()
+    expected_unexposed = list()
+    for drug_exposures, drug_propensity_scores in drug_exposures_and_scores:
+        exposed_indices, _ = drug_exposures.nonzero()
+        if _is_expected(matching):
+            binned_scores, exposed_indices = _bin_drug_scores(
+                exposed_indices, drug_propensity_scores, bins, matching)
+            with profiling.timer('matching'):
+                matched_exposed_indices, unexposed_bins, bin_weights = \
+                    expected_unexposed_by_bin(exposed_indices, binned_scores)
+            with profiling.timer('outcome_sums'):
+                expected_unexposed.append(expected_outcome_counts(
+                    unexposed_bins, bin_weights, all_outcomes))
+            # No sampled unexposed reports, so the unexposed column is empty
+            matched_unexposed_indices = np.array([], dtype=np.int64)
+            unexposed_counts = np.array([], dtype=np.int64)
+            n_matched_unexposed = 10 * len(matched_exposed_indices)
+        else:
+            matched_exposed_indices, matched_unexposed_indices, unexposed_counts = \
+                _match_drug(exposed_indices, drug_propensity_scores, bins,
+                            seed, matching)
+            n_matched_unexposed = int(unexposed_counts.sum())
+
+        # Columns 2i and 2i + 1 hold the exposed and unexposed weights of drug i
+        drug_number = len(n_exposed)
+        rows.extend([matched_exposed_indices, matched_unexposed_indices])
+        columns.extend([np.full(len(matched_exposed_indices), 2 * drug_number),
+                        np.full(len(matched_unexposed_indices), 2 * drug_number + 1)])
+        weights.extend([np.ones(len(matched_exposed_indices), dtype=np.int64),
+                        unexposed_counts])
+        n_exposed.append(len(matched_exposed_indices))
+        n_unexposed.append(n_matched_unexposed)
+
+    n_drugs = len(n_exposed)
+    if n_drugs == 0:
+        empty = np.zeros((0, all_outcomes.shape[1]))
+        return empty, np.array([], dtype=int), empty, np.array([], dtype=int)
+
+    weight_matrix = scipy.sparse.csc_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(all_outcomes.shape[0], 2 * n_drugs)
+    )
+
+    # (n_outcomes x n_reports) @ (n_reports x 2k), one pass over all outcomes
+    with profiling.timer('outcome_sums'):
+        outcome_counts = all_outcomes.T.dot(weight_matrix).toarray().T
+    exposed_with_outcome = outcome_counts[0::2]
+    unexposed_with_outcome = outcome_counts[1::2]
+    if _is_expected(matching):
+        unexposed_with_outcome = np.array(expected_unexposed)
+    return (exposed_with_outcome, np.array(n_exposed),
+            unexposed_with_outcome, np.array(n_unexposed))
+
+
+def resample_unexposed_by_bin(exposed_indices, binned_scores, n_resamples,
+                              seed=0):
+    """
+    Draw `n_resamples` independent samples of unexposed controls at once,
+    each matched as in `match_unexposed_by_bin` (10 unexposed reports per
+    exposed report in the same bin, with replacement). Within a bin, the
+    number of times each unexposed report is drawn in a resample is
+    multinomial, and the counts of all resamples are kept as the columns of
+    one sparse matrix. In bins with fewer unexposed reports than draws, the
+    draws are counted into these multinomial counts. In other bins each draw
+    is kept as an entry, and reports drawn more than once have repeated
+    entries in a column (summed by sparse products), which avoids a sort.
+
+    Parameters
+    ----------
+    exposed_indices : numpy.ndarray
+        Row indices of the reports exposed to the drug
+    binned_scores : numpy.ndarray
+        Propensity score bin of each report. Shape is (n_reports,)
+    n_resamples : int
+    seed : int
+        Seed of the random state used for every resample
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, scipy.sparse.csc_matrix]
+        Matched exposed indices, and the number of times each report was
+        drawn in each resample, shape (n_reports x n_resamples)
+    """
+    binned_scores = np.asarray(binned_scores).ravel()
+    exposed_indices = np.asarray(exposed_indices, dtype=np.int64)
+    n_reports = binned_scores.shape[0]
+    n_bins = int(binned_scores.max()) + 1 if binned_scores.size else 0
+
+    is_exposed = np.zeros(n_reports, dtype=bool)
+    is_exposed[exposed_indices] = True
+    exposed_bins = binned_scores[exposed_indices]
+    n_exposed_bin = np.bincount(exposed_bins, minlength=n_bins)
+
+    # Group unexposed reports by bin, as in `match_unexposed_by_bin`
+    unexposed_indices = np.flatnonzero(~is_exposed)
+    unexposed_bins = binned_scores[unexposed_indices]
+    if n_bins <= np.iinfo(np.uint16).max:
+        unexposed_bins = unexposed_bins.astype(np.uint16)
+    unexposed_indices = unexposed_indices[np.argsort(unexposed_bins, kind='stable')]
+    n_unexposed_bin = np.bincount(unexposed_bins, minlength=n_bins)
+    bin_starts = np.concatenate([[0], np.cumsum(n_unexposed_bin)[:-1]])
+
+    random_state = np.random.RandomState(seed)
+    rows = list()
+    columns = list()
+    counts = list()
+    keep_bins = list()
+    for bin_number in np.flatnonzero(n_exposed_bin):
+        n_available = n_unexposed_bin[bin_number]
+        bin_unexposed = unexposed_indices[
+            bin_starts[bin_number]:bin_starts[bin_number] + n_available]
+        if n_available == 0:
+            continue
+        keep_bins.append(bin_number)
+        n_draws = 10 * n_exposed_bin[bin_number]
+        position = random_state.randint(0, n_available,
+                                        size=n_resamples * n_draws)
+        resample = np.repeat(np.arange(n_resamples), n_draws)
+        if n_available <= n_draws:
+            # (n_resamples x n_available) multinomial counts
+            bin_counts = np.bincount(resample * n_available + position,
+                                     minlength=n_resamples * n_available)
+            drawn = np.flatnonzero(bin_counts)
+            resample, position = np.divmod(drawn, n_available)
+            counts.append(bin_counts[drawn])
+        else:
+            counts.append(np.ones(len(position), dtype=np.int64))
+        rows.append(bin_unexposed[position])
+        columns.append(resample)
+
+    matched_exposed_indices = exposed_indices[np.isin(exposed_bins, keep_bins)]
+    if len(rows) == 0:
+        return (matched_exposed_indices,
+                scipy.sparse.csc_matrix((n_reports, n_resamples),
+                                        dtype=np.int64))
+    # Order entries by resample (column). A narrow integer type lets NumPy
+    #  use a radix sort.
+    columns = np.concatenate(columns).astype(np.min_scalar_type(n_resamples))
+    order = np.argsort(columns, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(columns,
+                                                        minlength=n_resamples))])
+    resample_counts = scipy.sparse.csc_matrix(
+        (np.concatenate(counts)[order], np.concatenate(rows)[order], indptr),
+        shape=(n_reports, n_resamples)
+    )
+    return matched_exposed_indices, resample_counts
+
+
+def compute_ABCD_resampled(drug_exposures, drug_propensity_scores,
+                           all_outcomes, n_resamples=50, bins=DEFAULT_BINS,
+                           seed=0):
+    """
+    A, A + B, C and C + D (see `compute_ABCD_one_drug`) for `n_resamples`
+    samples of unexposed controls, drawn together (see
+    `resample_unexposed_by_bin`). C for every resample comes from a single
+    sparse product of the outcome matrix with the matrix of resample counts,
+    so that 50 resamples cost about as much as a few single samples. A, A + B
+    and C + D are the same for every resample.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, int, numpy.ndarray, int]
+        A, A + B, C, C + D. C has shape (n_resamples x n_outcomes).
+    """
+    exposed_indices, _ = drug_exposures.nonzero()
+    with profiling.timer('binning'):
+        binned_scores = bin_scores(drug_propensity_scores, bins=bins)
+    with profiling.timer('matching'):
+        matched_exposed_indices, resample_counts = resample_unexposed_by_bin(
+            exposed_indices, binned_scores, n_resamples, seed=seed)
+
+    with profiling.timer('outcome_sums'):
+        exposed_with_outcome = all_outcomes[matched_exposed_indices].sum(axis=0)
+        exposed_with_outcome = np.array(exposed_with_outcome).flatten()
+        # (n_resamples x n_reports) @ (n_reports x n_outcomes). With more
+        #  draws than outcome entries, converting the outcome matrix to CSR
+        #  is cheaper than converting the draws.
+        if resample_counts.nnz > all_outcomes.nnz:
+            unexposed_with_outcome = resample_counts.T.dot(all_outcomes).toarray()
+        else:
+            unexposed_with_outcome = all_outcomes.T.dot(resample_counts).toarray().T
+    n_unexposed = 10 * len(matched_exposed_indices)
+    return (exposed_with_outcome, len(matched_exposed_indices),
+            unexposed_with_outcome, n_unexposed)
+
+
+def summarize_prr_resamples(exposed_with_outcome, n_exposed,
+                            unexposed_with_outcome, n_unexposed,
+                            interval=95):
+    """
+    Mean, standard deviation and percentile interval of PRR across resamples
+    of unexposed controls (see `compute_ABCD_resampled`), for each outcome.
+    Resamples in which an outcome's PRR is not finite (C = 0) are left out of
+    its summary, and outcomes without any finite PRR are NaN.
+
+    Parameters
+    ----------
+    exposed_with_outcome, n_exposed, n_unexposed
+        As for `compute_prr`
+    unexposed_with_outcome : numpy.ndarray
+        C of each resample, shape (n_resamples x n_outcomes)
+    interval : float
+        Width of the percentile interval, in percent
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        `PRR_mean`, `PRR_sd`, `PRR_lower` and `PRR_upper`, each a vector of
+        outcomes
+    """
+    PRR, _ = compute_prr(exposed_with_outcome, n_exposed,
+                         np.asarray(unexposed_with_outcome), n_unexposed)
+    PRR = np.where(np.isfinite(PRR), PRR, np.nan)
+    tail = (100 - interval) / 2
+    # Outcomes with no finite PRR give (expected) all-NaN warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanpercentile(PRR, [tail, 100 - tail], axis=0)
+        return {
+            'PRR_mean': np.nanmean(PRR, axis=0),
+            'PRR_sd': np.nanstd(PRR, axis=0, ddof=1),
+            'PRR_lower': lower,
+            'PRR_upper': upper,
+        }
+
+
 def compute_prr(exposed_with_outcome, n_exposed, unexposed_with_outcome, n_unexposed):
     """
     Compute PRR and PRR_error for a single drug. Uses A, B, C, and D as
@@ -143,3 +747,54 @@ def compute_prr(exposed_with_outcome, n_exposed, unexposed_with_outcome, n_unexp
         PRR_error = np.sqrt((1 / exposed_with_outcome) + (1 / unexposed_with_outcome)
                             - (1 / n_exposed) - (1 / n_unexposed))
     return PRR, PRR_error
+
+
+def compute_prr_rows(exposed_with_outcome, n_exposed, unexposed_with_outcome,
+                     n_unexposed, rows='all'):
+    """
+    Compute PRR and PRR_error (see `compute_prr`) for only the outcomes whose
+    rows are kept in the results. Most outcomes of a drug have A = 0, so
+    keeping only exposed outcomes (or only signals) shrinks the results
+    many times over.
+
+    Parameters
+    ----------
+    exposed_with_outcome, n_exposed, unexposed_with_outcome, n_unexposed
+        As for `compute_prr`
+    rows : str or SignalRule
+        `"all"` outcomes, outcomes with A > 0 (`"exposed"`), or exposed
+        outcomes meeting a significance rule (`"signals"` for the default
+        `SignalRule()`, or a `SignalRule`)
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        Indices of the kept outcomes, and their PRR and PRR_error
+    """
+    if isinstance(rows, str) and rows not in OUTPUT_ROWS:
+        raise ValueError(f'Unknown output rows {rows}. '
+                         f'Options are {list(OUTPUT_ROWS)} or a SignalRule')
+    if rows == 'all':
+        outcome_indices = np.arange(len(exposed_with_outcome))
+    else:
+        outcome_indices = np.flatnonzero(exposed_with_outcome > 0)
+    PRR, PRR_error = compute_prr(exposed_with_outcome[outcome_indices],
+                                 n_exposed,
+                                 unexposed_with_outcome[outcome_indices],
+                                 n_unexposed)
+
+    rule = SignalRule() if rows == 'signals' else rows
+    if isinstance(rule, SignalRule):
+        signals = is_signal(PRR, PRR_error, rule)
+        outcome_indices = outcome_indices[signals]
+        PRR, PRR_error = PRR[signals], PRR_error[signals]
+    return outcome_indices, PRR, PRR_error
+
+
+def is_signal(PRR, PRR_error, rule=SignalRule()):
+    """
+    Whether each PRR meets a `SignalRule`: the lower bound of its confidence
+    interval, log(PRR) - z * PRR_error, is above log(min_prr)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(PRR) - rule.z * PRR_error > np.log(rule.min_prr)
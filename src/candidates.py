@@ -0,0 +1,223 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+import coexposure
+import prr_io
+import shared_data
+
+# Candidates joined at a time by `generate_candidates`
+JOIN_BATCH_ROWS = 1_000_000
+
+
+def report_shards(n_reports, n_shards):
+    """(start, stop) rows of `n_shards` roughly equal shards of reports"""
+    bounds = np.linspace(0, n_reports, n_shards + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _prefix_groups(candidates):
+    """Start and stop rows of runs of candidates sharing all but the last drug"""
+    if candidates.shape[0] == 0:
+        return list()
+    prefixes = candidates[:, :-1]
+    changes = np.flatnonzero(np.any(prefixes[1:] != prefixes[:-1], axis=1)) + 1
+    starts = np.concatenate([[0], changes])
+    stops = np.concatenate([changes, [candidates.shape[0]]])
+    return list(zip(starts, stops))
+
+
+def count_support_shard(start, stop, candidates, all_exposures):
+    """
+    Count, within reports `start:stop`, the reports exposed to every drug of
+    each candidate combination.
+
+    Candidates sharing a prefix (all but their last drug) are counted
+    together: the reports exposed to the prefix are found once, by
+    intersecting sorted report indices, and the drugs of those reports are
+    counted with one `bincount`, giving the support of every extension.
+
+    Parameters
+    ----------
+    start, stop : int
+        Rows of the report shard
+    candidates : numpy.ndarray
+        (n_candidates x k) drug indices, sorted lexicographically, with the
+        drugs of each combination in ascending order
+    all_exposures : scipy.sparse.csc_matrix or shared_data.SharedReference
+
+    Returns
+    -------
+    numpy.ndarray
+        Support of each candidate within the shard
+    """
+    all_exposures = shared_data.resolve(all_exposures)
+    shard_rows = all_exposures[start:stop].tocsr()
+    shard_columns = shard_rows.tocsc()
+    shard_columns.sort_indices()
+
+    # Single drugs, the number of reports exposed to each
+    if candidates.shape[1] == 1:
+        drug_counts = np.bincount(shard_rows.indices[shard_rows.data != 0],
+                                  minlength=shard_rows.shape[1])
+        return drug_counts[candidates[:, 0]].astype(np.int64)
+
+    support = np.zeros(candidates.shape[0], dtype=np.int64)
+    for group_start, group_stop in _prefix_groups(candidates):
+        prefix = candidates[group_start, :-1]
+        prefix_reports = coexposure.multi_exposure_indices(prefix, shard_columns)
+        if len(prefix_reports) == 0:
+            continue
+        prefix_rows = shard_rows[prefix_reports]
+        drug_counts = np.bincount(prefix_rows.indices[prefix_rows.data != 0],
+                                  minlength=shard_rows.shape[1])
+        support[group_start:group_stop] = \
+            drug_counts[candidates[group_start:group_stop, -1]]
+    return support
+
+
+def count_support(candidates, all_exposures, n_reports, n_shards, executor):
+    """Total support of each candidate, counted over report shards in parallel"""
+    count_one_shard = functools.partial(count_support_shard,
+                                        candidates=candidates,
+                                        all_exposures=all_exposures)
+    starts, stops = zip(*report_shards(n_reports, n_shards))
+    return sum(executor.map(count_one_shard, starts, stops))
+
+
+def _is_frequent(subsets, frequent_keys, n_drug_ids):
+    """Whether each row of `subsets` has a key in sorted `frequent_keys`"""
+    keys = prr_io.combination_keys(subsets.T, n_drug_ids)
+    positions = np.searchsorted(frequent_keys, keys)
+    positions[positions == len(frequent_keys)] = 0
+    return frequent_keys[positions] == keys
+
+
+def generate_candidates(frequent, batch_rows=JOIN_BATCH_ROWS):
+    """
+    Apriori candidate generation. Joins frequent (k-1)-combinations that share
+    their first k-2 drugs, keeping only k-combinations all of whose
+    (k-1)-subsets are frequent.
+
+    The join is vectorized: each combination is paired with every later
+    combination of its prefix group, for about `batch_rows` candidates at a
+    time. Subsets are looked up by their integer key (see
+    `prr_io.combination_keys`) among the sorted keys of `frequent`.
+
+    Parameters
+    ----------
+    frequent : numpy.ndarray
+        (n x k-1) frequent combinations, sorted lexicographically, with the
+        drugs of each combination in ascending order
+    batch_rows : int
+
+    Returns
+    -------
+    numpy.ndarray
+        (n_candidates x k) candidates, in the same order and layout
+    """
+    n_frequent, k_minus_1 = frequent.shape
+    frequent = frequent.astype(np.int64)
+    n_drug_ids = int(frequent.max()) + 1 if n_frequent else 1
+    if n_drug_ids ** k_minus_1 > np.iinfo(np.int64).max:
+        raise ValueError(f'Combinations of {k_minus_1} of {n_drug_ids} drugs '
+                         f'have keys past int64')
+    # Sorted, as `frequent` is sorted lexicographically
+    frequent_keys = prr_io.combination_keys(frequent.T, n_drug_ids)
+
+    # Number of later combinations in each combination's prefix group
+    groups = np.array(_prefix_groups(frequent), dtype=np.int64).reshape(-1, 2)
+    group_stops = np.repeat(groups[:, 1], groups[:, 1] - groups[:, 0])
+    n_partners = group_stops - np.arange(n_frequent) - 1
+    pair_stops = np.cumsum(n_partners)
+
+    candidates = list()
+    row_start = 0
+    while row_start < n_frequent:
+        pairs_before = pair_stops[row_start] - n_partners[row_start]
+        row_stop = max(row_start + 1, int(np.searchsorted(
+            pair_stops, pairs_before + batch_rows, side='right')))
+        counts = n_partners[row_start:row_stop]
+        first = np.repeat(np.arange(row_start, row_stop), counts)
+        second = (first + 1 + np.arange(len(first))
+                  - np.repeat(np.cumsum(counts) - counts, counts))
+        joined = np.column_stack([frequent[first], frequent[second, -1]])
+
+        # Subsets dropping either of the last two drugs are frequent by
+        #  construction. Check those dropping a prefix drug.
+        keep = np.ones(len(joined), dtype=bool)
+        for j in range(k_minus_1 - 1):
+            keep[keep] = _is_frequent(np.delete(joined[keep], j, axis=1),
+                                      frequent_keys, n_drug_ids)
+        candidates.append(joined[keep])
+        row_start = row_stop
+    return np.concatenate(
+        [np.zeros((0, k_minus_1 + 1), dtype=np.int64), *candidates])
+
+
+def frequent_combinations(all_exposures, n_reports, drug_indices, max_size,
+                          min_support, n_shards, executor):
+    """
+    Find drug combinations of 2 to `max_size` drugs with at least
+    `min_support` co-exposed reports, level by level (Apriori). Support is
+    counted over report shards in parallel.
+
+    Parameters
+    ----------
+    all_exposures : scipy.sparse.csc_matrix or shared_data.SharedReference
+        Reference if `executor` workers have the matrix attached
+    n_reports : int
+    drug_indices : List[int]
+        Drugs to combine (eg. one column per distinct drug)
+    max_size : int
+    min_support : int
+    n_shards : int
+    executor : concurrent.futures.Executor
+
+    Yields
+    ------
+    Tuple[int, numpy.ndarray, numpy.ndarray]
+        Size k, (n x k) frequent combinations and their support
+    """
+    frequent = np.unique(np.asarray(drug_indices, dtype=np.int64)).reshape(-1, 1)
+    for k in range(1, max_size + 1):
+        candidates = frequent if k == 1 else generate_candidates(frequent)
+        if candidates.shape[0] == 0:
+            return
+        support = count_support(candidates, all_exposures, n_reports, n_shards,
+                                executor)
+        keep = support >= min_support
+        frequent = candidates[keep]
+        if k > 1:
+            yield k, frequent, support[keep]
+
+
+def write_work_list(save_path, combinations, support, chunksize=1_000_000):
+    """
+    Write combinations and their support as a CSV work list, from most to
+    least supported, in chunks of `chunksize` rows.
+    """
+    order = np.argsort(-support, kind='stable')
+    columns = prr_io.drug_index_columns(combinations.shape[1])
+    for chunk_start in range(0, max(len(order), 1), chunksize):
+        rows = order[chunk_start:chunk_start + chunksize]
+        chunk_df = pd.DataFrame(combinations[rows], columns=columns)
+        chunk_df['support'] = support[rows]
+        chunk_df.to_csv(save_path, index=False, header=chunk_start == 0,
+                        mode='w' if chunk_start == 0 else 'a')
+
+
+def iter_work_list(work_list_path, chunksize=100_000):
+    """
+    Read a work list written by `write_work_list`, in order.
+
+    Yields
+    ------
+    Tuple[int, ...]
+        Drug indices of each combination
+    """
+    for chunk_df in pd.read_csv(work_list_path, chunksize=chunksize):
+        drug_columns = [column for column in chunk_df.columns
+                        if column.startswith('drug_index')]
+        yield from map(tuple, chunk_df[drug_columns].values.tolist())
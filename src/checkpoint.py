@@ -0,0 +1,161 @@
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+
+# Outputs are written here (next to their final location, so on the same
+#  file system) and renamed into place once complete. Globs for outputs (eg.
+#  `*.npz`) do not look inside it, so partial outputs are never read.
+PARTIAL_DIR = '.partial'
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """
+    Context manager giving a temporary path to write in place of `path`. If
+    the block completes, the temporary file (or directory) replaces `path`
+    with `os.replace`, so `path` is never seen partially written. Otherwise
+    it is removed. The temporary path has the same name (and extension) as
+    `path`, so writers that add extensions keep working.
+
+    Replacing a directory removes the old one first, so for a directory there
+    is a short window in which neither exists.
+    """
+    path = pathlib.Path(path)
+    partial_dir = path.parent.joinpath(PARTIAL_DIR)
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = partial_dir.joinpath(f'{os.getpid()}-{path.name}')
+    try:
+        yield temp_path
+        if temp_path.is_dir() and path.is_dir():
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.is_dir():
+            shutil.rmtree(temp_path)
+        elif temp_path.exists():
+            os.remove(temp_path)
+
+
+def fingerprint(*values):
+    """Short hash of any JSON-serializable values (others by their `str`)"""
+    encoded = json.dumps(values, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def file_fingerprint(*paths):
+    """
+    Fingerprint of files by name, size and modification time (not contents,
+    which would mean reading every input). Missing files are fingerprinted
+    as missing.
+    """
+    stats = list()
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.exists():
+            stat = path.stat()
+            stats.append([path.name, stat.st_size, stat.st_mtime_ns])
+        else:
+            stats.append([path.name, None, None])
+    return fingerprint(stats)
+
+
+class TaskManifest:
+    """
+    Record of completed units of work (eg. archives, drugs or pairs) and the
+    fingerprints of their inputs, kept as an append-only JSON lines file.
+    A unit is done if it was recorded with the same fingerprint, so changed
+    inputs are recomputed. Lines are appended as units complete, so after an
+    interruption only the units in progress are lost.
+
+    Units should be recorded by a single process (eg. the parent of a pool,
+    as results arrive).
+
+    Parameters
+    ----------
+    path : pathlib.Path
+    sync_every : int
+        Records are written as they are made (so they survive the process
+        being killed), and synced to disk (to survive the machine stopping)
+        after this many records
+    """
+
+    def __init__(self, path, sync_every=1000):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.sync_every = sync_every
+        self._done = dict()
+        if self.path.is_file():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line may be cut short by an interruption
+                        continue
+                    self._done[record['unit']] = record['fingerprint']
+        self._file = open(self.path, 'a')
+        self._unsynced = 0
+
+    def is_done(self, unit, unit_fingerprint):
+        return self._done.get(str(unit)) == unit_fingerprint
+
+    def done_units(self):
+        return list(self._done)
+
+    def pending(self, units, fingerprints, output_paths=None):
+        """
+        Units that are not done, or (with `output_paths`) whose output is
+        missing
+
+        Parameters
+        ----------
+        units : List
+        fingerprints : List[str]
+            Fingerprint of each unit's inputs
+        output_paths : List[pathlib.Path]
+            Output of each unit
+
+        Returns
+        -------
+        List
+        """
+        if output_paths is None:
+            output_paths = [None] * len(units)
+        return [unit for unit, unit_fingerprint, output_path
+                in zip(units, fingerprints, output_paths)
+                if not self.is_done(unit, unit_fingerprint)
+                or (output_path is not None and not output_path.exists())]
+
+    def mark_done(self, unit, unit_fingerprint):
+        self._done[str(unit)] = unit_fingerprint
+        self._file.write(json.dumps({'unit': str(unit),
+                                     'fingerprint': unit_fingerprint}) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def reset(self):
+        """Forget every completed unit"""
+        self._done.clear()
+        self._file.close()
+        self._file = open(self.path, 'w')
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
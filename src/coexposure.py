@@ -0,0 +1,133 @@
+import functools
+import itertools
+import pathlib
+
+import numpy as np
+import scipy.sparse
+
+import checkpoint
+
+
+def coexposure_counts(all_exposures):
+    """
+    Number of reports exposed to each pair of drugs, `X.T @ X` for the binary
+    (reports x drugs) exposure matrix X. The diagonal is the number of
+    reports exposed to each drug.
+
+    Parameters
+    ----------
+    all_exposures : scipy.sparse.csc_matrix
+        Matrix of reports (rows) by drugs (columns)
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Symmetric (n_drugs x n_drugs) matrix of counts, as int32
+    """
+    binary = all_exposures.astype(bool).astype(np.int32)
+    return scipy.sparse.csr_matrix(binary.T.dot(binary))
+
+
+def load_coexposure_counts(counts_path, exposures_path, all_exposures):
+    """
+    Co-exposure counts of the exposure matrix saved at `exposures_path`
+    (loaded as `all_exposures`), read from `counts_path` if they were built
+    from that same file. Otherwise (eg. the matrix was rebuilt or appended
+    to) they are recomputed and saved, along with the matrix's fingerprint
+    (see `checkpoint.file_fingerprint`) in `{counts_path}.fingerprint`.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    counts_path = pathlib.Path(counts_path)
+    fingerprint_path = counts_path.with_name(f'{counts_path.name}.fingerprint')
+    exposures_fingerprint = checkpoint.file_fingerprint(exposures_path)
+    if (counts_path.is_file() and fingerprint_path.is_file()
+            and fingerprint_path.read_text().strip() == exposures_fingerprint):
+        return scipy.sparse.load_npz(counts_path).tocsr()
+
+    # The old fingerprint goes first, so counts are never paired with the
+    #  fingerprint of another matrix
+    if fingerprint_path.is_file():
+        fingerprint_path.unlink()
+    counts = coexposure_counts(all_exposures)
+    with checkpoint.atomic_path(counts_path) as temp_path:
+        scipy.sparse.save_npz(temp_path, counts)
+    with checkpoint.atomic_path(fingerprint_path) as temp_path:
+        temp_path.write_text(exposures_fingerprint + '\n')
+    return counts
+
+
+def drug_report_indices(all_exposures, drug_index):
+    """
+    Sorted indices of the reports exposed to a drug, read directly from the
+    CSC buffers (no copy of the column is made).
+    """
+    start, stop = all_exposures.indptr[drug_index:drug_index + 2]
+    report_indices = np.asarray(all_exposures.indices[start:stop])
+    nonzero = np.asarray(all_exposures.data[start:stop]) != 0
+    if not nonzero.all():
+        report_indices = report_indices[nonzero]
+    if not all_exposures.has_sorted_indices:
+        report_indices = np.sort(report_indices)
+    return report_indices
+
+
+def multi_exposure_indices(drug_indices, all_exposures):
+    """
+    Sorted indices of the reports exposed to every drug in `drug_indices`,
+    by intersecting the drugs' sorted report index arrays, smallest first.
+    """
+    report_indices = sorted(
+        (drug_report_indices(all_exposures, drug_index)
+         for drug_index in drug_indices),
+        key=len
+    )
+    return functools.reduce(
+        lambda a, b: np.intersect1d(a, b, assume_unique=True), report_indices
+    )
+
+
+def combination_coexposure(counts, drug_indices):
+    """
+    Number of reports exposed to every drug in a combination. Exact for
+    single drugs and pairs. For larger combinations this is an upper bound,
+    the smallest count among the pairs in the combination.
+    """
+    if len(drug_indices) == 1:
+        return counts[drug_indices[0], drug_indices[0]]
+    return min(counts[a, b]
+               for a, b in itertools.combinations(drug_indices, 2))
+
+
+def filter_combinations(combinations, counts, min_coexposure=1):
+    """
+    Drop drug combinations with fewer than `min_coexposure` co-exposed
+    reports (see `combination_coexposure`), and order the rest from most to
+    least co-exposed, so that the most expensive combinations start first.
+
+    Parameters
+    ----------
+    combinations : List[Tuple[int, ...]]
+        Combinations, all with the same number of drugs
+    counts : scipy.sparse.csr_matrix
+        From `coexposure_counts`
+    min_coexposure : int
+
+    Returns
+    -------
+    List[Tuple[int, ...]]
+    """
+    if len(combinations) == 0:
+        return list()
+    drug_arrays = np.asarray(combinations, dtype=np.int64)
+    if drug_arrays.shape[1] == 1:
+        drug_arrays = np.concatenate([drug_arrays, drug_arrays], axis=1)
+    n_coexposed = np.min([
+        np.asarray(counts[drug_arrays[:, a], drug_arrays[:, b]]).ravel()
+        for a, b in itertools.combinations(range(drug_arrays.shape[1]), 2)
+    ], axis=0)
+    kept = np.flatnonzero(n_coexposed >= min_coexposure)
+    kept = kept[np.argsort(-n_coexposed[kept], kind='stable')]
+    return [tuple(combinations[i]) for i in kept]
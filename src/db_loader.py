@@ -0,0 +1,344 @@
+import collections
+import concurrent.futures
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tqdm
+
+import profiling
+import prr_io
+
+# Tables of the `effect_nsides` database loaded from PRR tables, with their
+#  SQL column types (as created by `nb/4.insert_tables/`)
+_STAT_SCHEMA = [('A', 'int'), ('B', 'int'), ('C', 'int'), ('D', 'int'),
+                ('PRR', 'float'), ('PRR_error', 'float'),
+                ('mean_reporting_frequency', 'float')]
+SCHEMAS = {
+    'OFFSIDES': [('drug_concept_id', 'int'), ('condition_concept_id', 'int'),
+                 *_STAT_SCHEMA],
+    'TWOSIDES': [('drug_concept_id_1', 'int'), ('drug_concept_id_2', 'int'),
+                 ('condition_concept_id', 'int'), *_STAT_SCHEMA],
+}
+
+# Number of drugs in each row of each table
+TABLE_DRUGS = {'OFFSIDES': 1, 'TWOSIDES': 2}
+
+# Columns indexed once a table is loaded (as `index_archive_databases.ipynb`
+#  does by hand). Index names are prefixed by the table, as SQLite index
+#  names are per database.
+INDEXES = {
+    'OFFSIDES': ['drug_concept_id', 'condition_concept_id'],
+    'TWOSIDES': ['drug_concept_id_1', 'drug_concept_id_2',
+                 'condition_concept_id'],
+}
+
+# Rows per statement of a multi-row insert
+INSERT_BATCH_ROWS = 10_000
+
+
+def concept_columns(n_drugs):
+    """Names of the drug concept columns of a table with `n_drugs` drugs"""
+    if n_drugs == 1:
+        return ['drug_concept_id']
+    return [f'drug_concept_id_{i + 1}' for i in range(n_drugs)]
+
+
+def load_drug_concepts(path):
+    """
+    Map from RxNorm ID to OMOP concept ID (`drug_concept.csv.xz`), as
+    sorted RxNorm IDs and their concept IDs
+    """
+    drug_concept = pd.read_csv(path, usecols=['rxnorm_concept_id',
+                                              'concept_id'])
+    drug_concept = drug_concept.sort_values('rxnorm_concept_id',
+                                            kind='mergesort')
+    return (drug_concept['rxnorm_concept_id'].values.astype(np.int64),
+            drug_concept['concept_id'].values.astype(np.int64))
+
+
+def map_concept_ids(rxnorm_ids, drug_concepts):
+    """
+    OMOP concept IDs of RxNorm IDs, missing (NULL) for unmapped IDs, as a
+    nullable integer array
+    """
+    sorted_rxnorm_ids, concept_ids = drug_concepts
+    rxnorm_ids = np.asarray(rxnorm_ids).astype(np.int64)
+    positions = np.searchsorted(sorted_rxnorm_ids, rxnorm_ids)
+    positions[positions == len(sorted_rxnorm_ids)] = 0
+    found = sorted_rxnorm_ids[positions] == rxnorm_ids
+    return pd.arrays.IntegerArray(np.where(found, concept_ids[positions], 0),
+                                  ~found)
+
+
+def _integer_column(values):
+    """Integer IDs, missing (NaN, eg. "no outcome") as NULL"""
+    values = np.array(pd.to_numeric(values), dtype=np.float64)
+    missing = np.isnan(values)
+    return pd.arrays.IntegerArray(
+        np.where(missing, 0, values).astype(np.int64), missing)
+
+
+def _float_column(values):
+    """Floats with infinite PRR (str or float `inf`) as NaN, ie. NULL"""
+    values = np.array(pd.to_numeric(values), dtype=np.float64)
+    values[values == np.inf] = np.nan
+    return values
+
+
+def prepare_prr_frame(df, n_drugs, drug_concepts):
+    """
+    Rows of a PRR table (in the CSV layout, see `prr_io.decode_ids`) as rows
+    of the database table: drugs mapped from RxNorm to OMOP concept IDs,
+    missing outcome IDs and infinite PRR and PRR_error as NULL, the mean
+    reporting frequency A / (A + B) added, and rows with A and C both zero
+    dropped.
+    """
+    counts = {column: pd.to_numeric(df[column]).values.astype(np.int64)
+              for column in ['A', 'B', 'C', 'D']}
+    keep = ~((counts['A'] == 0) & (counts['C'] == 0))
+    prepared = {
+        concept_column: map_concept_ids(df[id_column].values[keep],
+                                        drug_concepts)
+        for id_column, concept_column in zip(prr_io.drug_id_columns(n_drugs),
+                                             concept_columns(n_drugs))
+    }
+    prepared['condition_concept_id'] = _integer_column(df['outcome_id'])[keep]
+    prepared.update({column: values[keep] for column, values in counts.items()})
+    prepared['PRR'] = _float_column(df['PRR'])[keep]
+    prepared['PRR_error'] = _float_column(df['PRR_error'])[keep]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prepared['mean_reporting_frequency'] = (
+            prepared['A'] / (prepared['A'] + prepared['B']))
+    return pd.DataFrame(prepared)
+
+
+def encode_rows(df):
+    """Rows as tuples, with None for NULL, for `executemany`"""
+    columns = [df[column].astype(object).where(df[column].notna(), None)
+               .values for column in df.columns]
+    return list(zip(*columns))
+
+
+def encode_tsv(df):
+    """Rows as tab-separated text, with \\N for NULL, for `LOAD DATA`"""
+    return df.to_csv(sep='\t', header=False, index=False,
+                     na_rep='\\N').encode()
+
+
+class SQLiteBackend:
+    """
+    SQLite database file, for local use and testing. Rows are inserted with
+    one prepared statement per batch, and each batch is one transaction,
+    with the journal and syncing off during the load.
+    """
+    encode = staticmethod(encode_rows)
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+
+    def create_table(self, table_name, schema):
+        self.connection.execute(f'DROP TABLE IF EXISTS {table_name}')
+        self.connection.execute(f'CREATE TABLE {table_name} (' + ', '.join(
+            f'{column} {sql_type}' for column, sql_type in schema) + ')')
+
+    def insert(self, table_name, columns, batch):
+        placeholders = ', '.join('?' * len(columns))
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT INTO {table_name} ({", ".join(columns)}) '
+                f'VALUES ({placeholders})', batch)
+
+    def create_index(self, table_name, column):
+        with self.connection:
+            self.connection.execute(
+                f'CREATE INDEX {table_name.lower()}_{column} '
+                f'ON {table_name} ({column})')
+
+    def close(self):
+        self.connection.close()
+
+
+class MySQLBackend:
+    """
+    MySQL database (`mysql-connector-python`). With `load_data`, batches are
+    loaded from tab-separated files with `LOAD DATA LOCAL INFILE`, which the
+    server must allow (`local_infile`). Otherwise they are inserted with
+    multi-row INSERT statements of `INSERT_BATCH_ROWS` rows.
+    """
+
+    def __init__(self, host, user, password, database, load_data=False):
+        import mysql.connector
+        self.load_data = load_data
+        self.encode = encode_tsv if load_data else encode_rows
+        self.connection = mysql.connector.connect(
+            host=host, user=user, password=password, database=database,
+            allow_local_infile=load_data, autocommit=False)
+        cursor = self.connection.cursor()
+        cursor.execute('SET unique_checks = 0')
+        cursor.execute('SET foreign_key_checks = 0')
+        cursor.close()
+
+    def create_table(self, table_name, schema):
+        cursor = self.connection.cursor()
+        cursor.execute(f'DROP TABLE IF EXISTS {table_name}')
+        cursor.execute(f'CREATE TABLE {table_name} (' + ', '.join(
+            f'{column} {sql_type}' for column, sql_type in schema) + ')')
+        cursor.close()
+
+    def insert(self, table_name, columns, batch):
+        cursor = self.connection.cursor()
+        if self.load_data:
+            with tempfile.NamedTemporaryFile(suffix='.tsv') as f:
+                f.write(batch)
+                f.flush()
+                cursor.execute(
+                    f"LOAD DATA LOCAL INFILE '{f.name}' INTO TABLE {table_name} "
+                    f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+                    f"({', '.join(columns)})")
+        else:
+            # mysql-connector rewrites an executemany INSERT as one
+            #  multi-row statement
+            statement = (f'INSERT INTO {table_name} ({", ".join(columns)}) '
+                         f'VALUES ({", ".join(["%s"] * len(columns))})')
+            for start in range(0, len(batch), INSERT_BATCH_ROWS):
+                cursor.executemany(statement,
+                                   batch[start:start + INSERT_BATCH_ROWS])
+        self.connection.commit()
+        cursor.close()
+
+    def create_index(self, table_name, column):
+        cursor = self.connection.cursor()
+        cursor.execute(f'CREATE INDEX {table_name.lower()}_{column} '
+                       f'ON {table_name} ({column})')
+        cursor.close()
+
+    def close(self):
+        self.connection.close()
+
+
+def prepare_table_block(table_path, start, stop, n_drugs, drug_concepts,
+                        encode):
+    """Read, prepare and encode rows `start:stop` of a columnar PRR table"""
+    df = prr_io.read_prr_table_rows(table_path, start, stop)
+    return prepare_frame_block(df, n_drugs, drug_concepts, encode)
+
+
+def prepare_frame_block(df, n_drugs, drug_concepts, encode):
+    """
+    Prepare and encode a chunk of a PRR table. Returns the encoded batch,
+    its number of rows and the number of rows read.
+    """
+    with profiling.timer('prepare'):
+        prepared = prepare_prr_frame(df, n_drugs, drug_concepts)
+    with profiling.timer('encode'):
+        batch = encode(prepared)
+    return batch, len(prepared), len(df)
+
+
+def _source_blocks(source_path, n_drugs, drug_concepts, encode,
+                   rows_per_block):
+    """
+    Worker function, argument tuples and number of rows of the blocks of a
+    PRR table: a columnar table directory (`4.combine_prr_clean.py`), read
+    by the workers, or a `.csv.xz` export, read here in chunks
+    """
+    if source_path.is_dir():
+        n_rows = prr_io.prr_table_length(source_path)
+        blocks = ((source_path, start, min(start + rows_per_block, n_rows),
+                   n_drugs, drug_concepts, encode)
+                  for start in range(0, n_rows, rows_per_block))
+        return prepare_table_block, blocks, n_rows
+    chunks = pd.read_csv(source_path, chunksize=rows_per_block)
+    blocks = ((chunk, n_drugs, drug_concepts, encode) for chunk in chunks)
+    return prepare_frame_block, blocks, None
+
+
+def load_prr_table(backend, table_name, source_path, drug_concepts,
+                   rows_per_block=1_000_000, max_workers=None,
+                   max_pending=None, create_indexes=True):
+    """
+    Load a PRR table into the database table `table_name` (`"OFFSIDES"` or
+    `"TWOSIDES"`), replacing it.
+
+    Blocks of `rows_per_block` rows are prepared (see `prepare_prr_frame`)
+    and encoded for the backend in parallel, while the batches already
+    prepared are inserted. At most `max_pending` blocks are held at once.
+    Indexes (`INDEXES`) are created after all rows are loaded.
+
+    Parameters
+    ----------
+    backend : SQLiteBackend or MySQLBackend
+    table_name : str
+    source_path : pathlib.Path
+        Columnar table directory or `.csv.xz` export
+    drug_concepts : Tuple[np.ndarray, np.ndarray]
+        See `load_drug_concepts`
+    rows_per_block : int
+    max_workers : int
+    max_pending : int
+    create_indexes : bool
+
+    Returns
+    -------
+    dict
+        Rows read and loaded, and seconds and rows per second of the load
+        and of the indexing
+    """
+    try:
+        schema = SCHEMAS[table_name]
+    except KeyError:
+        raise ValueError(f'Unknown table {table_name}. '
+                         f'Options are {list(SCHEMAS)}')
+    columns = [column for column, _ in schema]
+    n_drugs = TABLE_DRUGS[table_name]
+    source_path = pathlib.Path(source_path)
+    block_function, blocks, n_source_rows = _source_blocks(
+        source_path, n_drugs, drug_concepts, backend.encode, rows_per_block)
+
+    backend.create_table(table_name, schema)
+    stats = {'rows_read': 0, 'rows': 0}
+    start_time = time.perf_counter()
+    max_workers = max_workers or os.cpu_count()
+    max_pending = max_pending or 2 * max_workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        pending = collections.deque()
+        progress = tqdm.tqdm(total=n_source_rows, unit='rows')
+        while True:
+            # Keep the pool busy, without holding more than max_pending blocks
+            for block in blocks:
+                pending.append(executor.submit(block_function, *block))
+                if len(pending) >= max_pending:
+                    break
+            if len(pending) == 0:
+                break
+
+            batch, n_rows, n_read = pending.popleft().result()
+            with profiling.timer('insert'):
+                backend.insert(table_name, columns, batch)
+            stats['rows'] += n_rows
+            stats['rows_read'] += n_read
+            progress.update(n_read)
+        progress.close()
+    stats['load_seconds'] = time.perf_counter() - start_time
+    stats['rows_per_second'] = stats['rows'] / max(stats['load_seconds'], 1e-9)
+    print(f'{table_name}: {stats["rows"]} rows loaded (of '
+          f'{stats["rows_read"]}) in {stats["load_seconds"]:.1f} s, '
+          f'{stats["rows_per_second"]:,.0f} rows/s')
+
+    start_time = time.perf_counter()
+    if create_indexes:
+        with profiling.timer('create_indexes'):
+            for column in INDEXES[table_name]:
+                backend.create_index(table_name, column)
+    stats['index_seconds'] = time.perf_counter() - start_time
+    if create_indexes:
+        print(f'{table_name}: {len(INDEXES[table_name])} indexes created in '
+              f'{stats["index_seconds"]:.1f} s')
+    return stats
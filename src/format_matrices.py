@@ -0,0 +1,302 @@
+import concurrent.futures
+import pathlib
+import pickle
+import re
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import checkpoint
+import matrices
+import profiling
+import scheduling
+
+# Files of `data/meta_unformatted/` read to build `data/meta_formatted/`
+REPORT_IDS_FILE = 'all_reportids_IN.npy'
+DRUG_IDS_FILE = 'unique_ingredients.npy'
+OUTCOMES_FILE = 'outcomes_table.csv.xz'
+
+# Rows of the outcomes table read at a time
+OUTCOMES_CHUNKSIZE = 1_000_000
+
+_CHUNK_NUMBER = re.compile(r'(?:.+_IN_)([0-9]+)(?:\.npy)')
+
+
+def exposure_chunk_files(aeolus_path):
+    """
+    The AEOLUS exposure chunks (`AEOLUS_all_reports_IN_{i}.npy`), in the
+    order of their reports (by chunk number, so 1, 2, ... not 1, 10, ...)
+    """
+    files = [path for path in pathlib.Path(aeolus_path).glob('*.npy')
+             if _CHUNK_NUMBER.match(path.name)]
+    return sorted(files,
+                  key=lambda path: int(_CHUNK_NUMBER.match(path.name).group(1)))
+
+
+def _load_exposure_chunk(chunk_file):
+    """A chunk as a CSC matrix with sorted indices and no explicit zeros"""
+    chunk = np.load(chunk_file, allow_pickle=True).item().tocsc()
+    chunk.sum_duplicates()
+    chunk.eliminate_zeros()
+    return chunk
+
+
+def _count_exposure_chunk(chunk_file):
+    """
+    Reports, drugs, entries per drug and last report with an exposure of a
+    chunk, or None if the file cannot be read
+    """
+    try:
+        chunk = _load_exposure_chunk(chunk_file)
+    except (OSError, pickle.UnpicklingError):
+        return None
+    n_rows, n_drugs = chunk.shape
+    last_row = chunk.indices.max() if chunk.nnz else -1
+    return n_rows, n_drugs, np.diff(chunk.indptr), int(last_row)
+
+
+def _fill_exposure_chunk(chunk_file, indices_path, starts, row_offset):
+    """
+    Write the reports (row indices) of a chunk's entries into the combined
+    matrix's `indices` buffer, each drug's at its position in that drug's
+    column (`starts`). Chunks fill disjoint parts of the buffer.
+    """
+    chunk = _load_exposure_chunk(chunk_file)
+    column_counts = np.diff(chunk.indptr)
+    positions = (np.repeat(starts - chunk.indptr[:-1], column_counts)
+                 + np.arange(chunk.nnz))
+    indices = np.load(indices_path, mmap_mode='r+')
+    indices[positions] = chunk.indices + row_offset
+    indices.flush()
+    return chunk.nnz
+
+
+def build_exposure_matrix(chunk_files, n_reports, n_drugs, scratch_path,
+                          max_workers=None):
+    """
+    Combine the AEOLUS exposure chunks, in order, into one (reports x drugs)
+    matrix in `matrices.EXPOSURE_FORMAT`.
+
+    Chunks are read in parallel twice: once to count each drug's entries,
+    so that the combined `indices` buffer is allocated once at its final
+    size (as a memory-mapped file in `scratch_path`), and once to write each
+    chunk's entries directly into their place in that buffer. No chunk is
+    held by the parent process, and nothing is concatenated, so peak memory
+    is about the size of the combined matrix.
+
+    Parameters
+    ----------
+    chunk_files : List[pathlib.Path]
+        Pickled sparse (reports x drugs) matrices, in report order (see
+        `exposure_chunk_files`)
+    n_reports : int
+        Number of reports (`len(report_id_vector)`). The combined chunks
+        have excess rows past the last report, which must be empty and are
+        dropped.
+    n_drugs : int
+        Number of drugs (`len(drug_id_vector)`), the columns of every chunk
+    scratch_path : pathlib.Path
+        Directory for the memory-mapped buffer, on a file system with room
+        for it
+    max_workers : int
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+
+    Raises
+    ------
+    ValueError
+        If a chunk has the wrong number of columns, a report past `n_reports`
+        is exposed, or an unreadable chunk is followed by a readable one
+        (which would shift every later report). Unreadable chunks at the end
+        are skipped with a warning.
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+            scheduling.pool_size(max_workers)) as executor:
+        with profiling.timer('count_chunks'):
+            counts = list(executor.map(_count_exposure_chunk, chunk_files))
+
+        unreadable = [str(path) for path, count in zip(chunk_files, counts)
+                      if count is None]
+        if unreadable:
+            n_read = counts.index(None)
+            if any(count is not None for count in counts[n_read:]):
+                raise ValueError(f'Unreadable exposure chunks before the last '
+                                 f'readable one: {", ".join(unreadable)}')
+            warnings.warn(f'Skipping unreadable exposure chunks: '
+                          f'{", ".join(unreadable)}')
+            chunk_files, counts = chunk_files[:n_read], counts[:n_read]
+
+        row_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        column_counts = np.zeros((len(counts) + 1, n_drugs), dtype=np.int64)
+        for i, (n_rows, chunk_drugs, chunk_counts, last_row) in enumerate(counts):
+            if chunk_drugs != n_drugs:
+                raise ValueError(f'{chunk_files[i]} has {chunk_drugs} drugs, '
+                                 f'not {n_drugs}')
+            if row_offsets[i] + last_row >= n_reports:
+                raise ValueError(f'{chunk_files[i]} has exposures past report '
+                                 f'{n_reports}')
+            row_offsets[i + 1] = row_offsets[i] + n_rows
+            column_counts[i + 1] = chunk_counts
+
+        # Where each chunk's entries of each drug start in the combined
+        #  `indices`: after the drug's entries in earlier chunks
+        indptr = np.zeros(n_drugs + 1, dtype=np.int64)
+        np.cumsum(column_counts.sum(axis=0), out=indptr[1:])
+        chunk_starts = indptr[:-1] + np.cumsum(column_counts, axis=0)[:-1]
+
+        shape = (n_reports, n_drugs)
+        index_dtype = np.int32 if max(int(indptr[-1]), *shape) <= \
+            np.iinfo(np.int32).max else np.int64
+        indices_path = pathlib.Path(scratch_path).joinpath('indices.npy')
+        np.lib.format.open_memmap(indices_path, mode='w+', dtype=index_dtype,
+                                  shape=(int(indptr[-1]),)).flush()
+
+        with profiling.timer('fill_chunks'):
+            list(executor.map(_fill_exposure_chunk, chunk_files,
+                              [indices_path] * len(chunk_files), chunk_starts,
+                              row_offsets[:-1]))
+
+    indices = np.load(indices_path, mmap_mode='r+')
+    matrix = scipy.sparse.csc_matrix(
+        (np.ones(len(indices), dtype=matrices.DATA_DTYPE), indices,
+         indptr.astype(index_dtype)), shape=shape, copy=False
+    )
+    matrix.has_sorted_indices = True
+    return matrix
+
+
+def _outcome_chunk_edges(chunk, report_order, sorted_report_ids):
+    """
+    Report indices and MedDRA IDs of the outcomes in a chunk of the outcomes
+    table, keeping only reports in `report_id_vector`. Each outcome has
+    exactly one of `primaryid` and `isr`, which is its report ID.
+    """
+    report_ids = chunk['primaryid'].fillna(chunk['isr'])
+    if report_ids.isnull().any():
+        raise ValueError('Outcomes without a primaryid or isr')
+    if chunk['outcome_concept_id'].isnull().any():
+        raise ValueError('Outcomes without an outcome_concept_id')
+    report_ids = report_ids.values.astype(np.int64)
+    positions = np.searchsorted(sorted_report_ids, report_ids)
+    positions[positions == len(sorted_report_ids)] = 0
+    known = sorted_report_ids[positions] == report_ids
+    return (report_order[positions[known]],
+            chunk['outcome_concept_id'].values[known].astype(np.int64))
+
+
+def build_outcome_matrix(outcomes_path, report_id_vector,
+                         chunksize=OUTCOMES_CHUNKSIZE):
+    """
+    Read the outcomes table in chunks into a (reports x outcomes) matrix in
+    `matrices.OUTCOME_FORMAT`, as `1.format_outcomes_data.ipynb` does with
+    the whole table.
+
+    Each chunk is reduced to two arrays (report index and MedDRA ID) of its
+    outcomes of reports in `report_id_vector`, and the arrays are
+    concatenated once. Outcomes are indexed by sorted MedDRA ID. As in the
+    notebook, if any report has no outcome, column 0 stands for "no outcome"
+    (with a missing ID) and has an entry for each of those reports, and the
+    IDs are float.
+
+    Returns
+    -------
+    outcome_matrix : scipy.sparse.csr_matrix
+    outcome_id_vector : np.ndarray
+        MedDRA ID of each column (NaN for "no outcome")
+    """
+    report_order = np.argsort(report_id_vector, kind='stable')
+    sorted_report_ids = report_id_vector[report_order]
+    if np.any(sorted_report_ids[1:] == sorted_report_ids[:-1]):
+        raise ValueError('report_id_vector has duplicate report IDs')
+
+    report_chunks, outcome_chunks = list(), list()
+    with profiling.timer('read_outcomes'):
+        for chunk in pd.read_csv(outcomes_path, chunksize=chunksize,
+                                 usecols=['primaryid', 'isr',
+                                          'outcome_concept_id']):
+            report_indices, outcome_ids = _outcome_chunk_edges(
+                chunk, report_order, sorted_report_ids)
+            report_chunks.append(report_indices.astype(np.int32))
+            outcome_chunks.append(outcome_ids)
+    report_indices = np.concatenate(report_chunks)
+    outcome_ids = np.concatenate(outcome_chunks)
+    del report_chunks, outcome_chunks
+
+    outcome_id_vector = np.unique(outcome_ids)
+    outcome_indices = np.searchsorted(outcome_id_vector, outcome_ids)
+    del outcome_ids
+
+    # Reports without outcomes, which the notebook's right merge keeps with a
+    #  missing MedDRA ID. That ID sorts first, so they share column 0, and
+    #  the IDs are float.
+    no_outcome = np.flatnonzero(
+        np.bincount(report_indices, minlength=len(report_id_vector)) == 0)
+    if len(no_outcome):
+        outcome_id_vector = np.concatenate(
+            [[np.nan], outcome_id_vector.astype(float)])
+        report_indices = np.concatenate(
+            [report_indices, no_outcome.astype(np.int32)])
+        outcome_indices = np.concatenate(
+            [outcome_indices + 1, np.zeros(len(no_outcome), dtype=np.int64)])
+    outcome_matrix = scipy.sparse.csr_matrix(
+        (np.ones(len(report_indices), dtype=matrices.DATA_DTYPE),
+         (report_indices, outcome_indices.astype(np.int32))),
+        shape=(len(report_id_vector), len(outcome_id_vector))
+    )
+    return outcome_matrix, outcome_id_vector
+
+
+def format_matrices(unformatted_path, aeolus_path, formatted_path,
+                    max_workers=None):
+    """
+    Build the files of `data/meta_formatted/` used in computation from
+    `data/meta_unformatted/` and `data/aeolus/`, replacing the notebooks
+    `1.format_outcomes_data.ipynb` and `2.format_drug_exposures_data.ipynb`:
+
+    * `report_id_vector.npy`, `drug_id_vector.npy` and
+      `outcome_id_vector.npy`
+    * `outcome_matrix.npz` and `drug_exposure_matrix.npz`, saved in the
+      layouts of `matrices` (their entries are those of the notebooks'
+      matrices, as bool)
+
+    The formatted `outcomes_table.csv.xz` of the notebook is not written.
+    Every file is written atomically.
+    """
+    unformatted_path = pathlib.Path(unformatted_path)
+    formatted_path = pathlib.Path(formatted_path)
+    formatted_path.mkdir(parents=True, exist_ok=True)
+
+    report_id_vector = np.load(
+        unformatted_path.joinpath(REPORT_IDS_FILE)).astype(int)
+    drug_id_vector = np.load(
+        unformatted_path.joinpath(DRUG_IDS_FILE)).astype(int)
+
+    outcome_matrix, outcome_id_vector = build_outcome_matrix(
+        unformatted_path.joinpath(OUTCOMES_FILE), report_id_vector)
+    matrices.save_matrix(formatted_path.joinpath('outcome_matrix.npz'),
+                         outcome_matrix, matrices.OUTCOME_FORMAT)
+    print(f'Outcomes: {outcome_matrix.shape}, {outcome_matrix.nnz} entries')
+    del outcome_matrix
+
+    chunk_files = exposure_chunk_files(aeolus_path)
+    with tempfile.TemporaryDirectory(dir=formatted_path) as scratch_path:
+        exposure_matrix = build_exposure_matrix(
+            chunk_files, len(report_id_vector), len(drug_id_vector),
+            scratch_path, max_workers)
+        matrices.save_matrix(formatted_path.joinpath('drug_exposure_matrix.npz'),
+                             exposure_matrix, matrices.EXPOSURE_FORMAT)
+        print(f'Exposures: {exposure_matrix.shape}, {exposure_matrix.nnz} '
+              f'entries from {len(chunk_files)} chunks')
+        del exposure_matrix
+
+    for name, vector in [('report_id_vector', report_id_vector),
+                         ('drug_id_vector', drug_id_vector),
+                         ('outcome_id_vector', outcome_id_vector)]:
+        with checkpoint.atomic_path(
+                formatted_path.joinpath(f'{name}.npy')) as temp_path:
+            np.save(temp_path, vector)
@@ -0,0 +1,247 @@
+import pathlib
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import calculate_prr
+import checkpoint
+import coexposure
+import matrices
+import score_store
+import utils
+
+# Releases appended to the matrices in `meta`, in order, with the first row
+#  and number of rows of each. A release's row is written last, so a release
+#  is ingested if and only if it is listed here.
+INCREMENTS_FILE = 'increments.csv'
+
+# Files of a release (reports x the same drug and outcome columns as the
+#  existing matrices), built by the preprocessing notebooks for its reports
+INCREMENT_FILES = ('drug_exposure_matrix.npz', 'outcome_matrix.npz',
+                   'report_id_vector.npy')
+
+
+def read_increments(meta_files_path):
+    """Releases ingested so far (see `INCREMENTS_FILE`)"""
+    increments_path = pathlib.Path(meta_files_path).joinpath(INCREMENTS_FILE)
+    if not increments_path.is_file():
+        return pd.DataFrame(columns=['release', 'first_report', 'n_reports'])
+    return pd.read_csv(increments_path, dtype={'release': str})
+
+
+def load_increment(increment_path):
+    """
+    Load the exposures, outcomes and report IDs of a release
+
+    Returns
+    -------
+    Tuple[scipy.sparse.csc_matrix, scipy.sparse.csc_matrix, numpy.ndarray]
+    """
+    increment_path = pathlib.Path(increment_path)
+    new_exposures = scipy.sparse.load_npz(
+        increment_path.joinpath('drug_exposure_matrix.npz')).tocsc()
+    new_outcomes = scipy.sparse.load_npz(
+        increment_path.joinpath('outcome_matrix.npz')).tocsc()
+    new_report_ids = np.load(increment_path.joinpath('report_id_vector.npy'))
+    return new_exposures, new_outcomes, new_report_ids
+
+
+def _pad_columns(new_rows, n_columns):
+    """
+    A release's rows with `n_columns` columns, the width of the existing
+    matrix. Matrices built from edge lists are only as wide as their last
+    column.
+    """
+    if new_rows.shape[1] > n_columns:
+        raise ValueError(f'New reports have {new_rows.shape[1]} columns, but '
+                         f'the matrix has {n_columns}. New drugs and '
+                         f'outcomes need a full rebuild.')
+    new_rows = new_rows.tocoo()
+    return scipy.sparse.csc_matrix(
+        (new_rows.data, (new_rows.row, new_rows.col)),
+        shape=(new_rows.shape[0], n_columns))
+
+
+def _append_rows(matrix, first_report, new_rows):
+    """
+    Rows `:first_report` of `matrix` followed by `new_rows`. Slicing makes
+    appending the same rows again (after an interruption) a no-op.
+    """
+    new_rows = _pad_columns(new_rows, matrix.shape[1])
+    return scipy.sparse.vstack([matrix[:first_report], new_rows]).tocsc()
+
+
+def append_reports(meta_files_path, increment_path, release):
+    """
+    Append the reports of a release (see `INCREMENT_FILES`) to the exposure
+    and outcome matrices and the report ID vector, and record the release in
+    `INCREMENTS_FILE`. Every file is replaced atomically, and the record is
+    written last, so an interrupted append is completed by calling this
+    again. A release already recorded is not appended twice.
+
+    The co-exposure counts (`coexposure_counts.npz`) no longer match the
+    matrix and are removed, to be rebuilt by `3.compute_prr.py` when needed.
+
+    Returns
+    -------
+    int
+        Row of the first appended report (the number of reports before)
+    """
+    meta_files_path = pathlib.Path(meta_files_path)
+    increments = read_increments(meta_files_path)
+    if release in increments['release'].values:
+        return int(increments.loc[increments['release'] == release,
+                                  'first_report'].iloc[0])
+
+    new_exposures, new_outcomes, new_report_ids = load_increment(increment_path)
+    if not new_exposures.shape[0] == new_outcomes.shape[0] == len(new_report_ids):
+        raise ValueError(f'Release {release} has {new_exposures.shape[0]} '
+                         f'exposure rows, {new_outcomes.shape[0]} outcome rows '
+                         f'and {len(new_report_ids)} report IDs')
+
+    # The report IDs are written after the matrices, so they give the number
+    #  of reports before this release even if the matrices were appended
+    report_id_vector = np.load(meta_files_path.joinpath('report_id_vector.npy'))
+    first_report = len(report_id_vector)
+    duplicates = np.intersect1d(report_id_vector, new_report_ids)
+    if len(duplicates) > 0:
+        raise ValueError(f'Release {release} repeats {len(duplicates)} '
+                         f'existing report IDs, eg. {duplicates[:5]}')
+
+    coexposure_counts_path = meta_files_path.joinpath('coexposure_counts.npz')
+    if coexposure_counts_path.is_file():
+        coexposure_counts_path.unlink()
+
+    for name, new_rows, matrix_format in [
+            ('drug_exposure_matrix.npz', new_exposures,
+             matrices.EXPOSURE_FORMAT),
+            ('outcome_matrix.npz', new_outcomes, matrices.OUTCOME_FORMAT)]:
+        matrix = scipy.sparse.load_npz(meta_files_path.joinpath(name)).tocsc()
+        matrix = _append_rows(matrix, first_report, new_rows)
+        matrices.save_matrix(meta_files_path.joinpath(name), matrix,
+                             matrix_format)
+        del matrix
+
+    with checkpoint.atomic_path(
+            meta_files_path.joinpath('report_id_vector.npy')) as temp_path:
+        np.save(temp_path, np.concatenate([report_id_vector, new_report_ids]))
+
+    increments = pd.concat([increments, pd.DataFrame({
+        'release': [release], 'first_report': [first_report],
+        'n_reports': [len(new_report_ids)],
+    })], ignore_index=True, sort=False)
+    with checkpoint.atomic_path(
+            meta_files_path.joinpath(INCREMENTS_FILE)) as temp_path:
+        increments.to_csv(temp_path, index=False)
+    return first_report
+
+
+def affected_drugs(new_exposures):
+    """Drugs exposed in at least one of the new reports"""
+    new_exposures = scipy.sparse.csc_matrix(new_exposures)
+    new_exposures.eliminate_zeros()
+    return np.flatnonzero(np.diff(new_exposures.indptr))
+
+
+def affected_combinations(combinations, new_exposures, n_drugs):
+    """
+    Drug combinations co-exposed in at least one of the new reports, found
+    from the co-exposure counts of the new reports alone. For more than two
+    drugs this may include some combinations that were not co-exposed (see
+    `coexposure.combination_coexposure`), which are then recomputed
+    unnecessarily but correctly.
+
+    The new reports' exposures are padded to `n_drugs` columns (the width of
+    the existing exposure matrix), as they are when appended.
+    """
+    new_counts = coexposure.coexposure_counts(
+        _pad_columns(new_exposures, n_drugs))
+    return coexposure.filter_combinations(combinations, new_counts,
+                                          min_coexposure=1)
+
+
+def _load_scores(drug_indices, n_rows, scores_path):
+    if len(drug_indices) == 1:
+        return utils.load_scores_offsides(drug_indices[0], n_rows, scores_path)
+    scores, _ = utils.load_scores_nsides(drug_indices, n_rows, scores_path)
+    return scores
+
+
+def extended_scores(drug_indices, base_scores_path, n_base_reports,
+                    increment_scores_paths):
+    """
+    Propensity scores of a drug (or combination) for every report: the
+    scores of the first `n_base_reports` reports, followed by the scores of
+    each ingested release's reports, in order. Scores in a store of bin
+    codes stay bin codes, and release scores are binned to match.
+
+    Parameters
+    ----------
+    drug_indices : Tuple[int, ...]
+    base_scores_path : pathlib.Path
+        Score store or directory of score files, as read by
+        `utils.load_scores_offsides` and `utils.load_scores_nsides`
+    n_base_reports : int
+        Number of reports before the first release
+    increment_scores_paths : List[pathlib.Path]
+        Directory of each release's score files (`{drug}.npz` or
+        `{i}_{j}.npy`), scored by the existing models
+
+    Returns
+    -------
+    numpy.ndarray
+        Scores, or `None` if any release has no scores for the combination
+    """
+    base_scores = _load_scores(drug_indices, n_base_reports, base_scores_path)
+    bins = None
+    if score_store.is_store(base_scores_path):
+        bins = score_store.store_bins(score_store.open_store(base_scores_path))
+    parts = [base_scores]
+    for scores_path in increment_scores_paths:
+        try:
+            scores = _load_scores(drug_indices, None, scores_path)
+        except FileNotFoundError:
+            return None
+        if bins is not None:
+            scores = score_store.quantize_scores(scores, 'bins', bins)
+        parts.append(scores)
+    return np.concatenate(parts)
+
+
+def write_extended_store(store_path, combinations, base_scores_path,
+                         n_base_reports, increment_scores_paths, codec='raw'):
+    """
+    Write the extended scores (see `extended_scores`) of `combinations` to a
+    new score store, with the quantization of the base store. Combinations
+    missing scores for a release are left out.
+
+    Returns
+    -------
+    List[Tuple[int, ...]]
+        Combinations written
+    """
+    quantization = 'float64'
+    bins = calculate_prr.DEFAULT_BINS
+    if score_store.is_store(base_scores_path):
+        base_store = score_store.open_store(base_scores_path)
+        quantization = base_store.meta['quantization']
+        if score_store.store_bins(base_store) is not None:
+            bins = score_store.store_bins(base_store)
+
+    written = list()
+
+    def items():
+        for combination in combinations:
+            scores = extended_scores(combination, base_scores_path,
+                                     n_base_reports, increment_scores_paths)
+            if scores is None:
+                continue
+            written.append(tuple(combination))
+            yield '_'.join(map(str, combination)), scores
+
+    with checkpoint.atomic_path(store_path) as temp_store_path:
+        score_store.create_store(temp_store_path, quantization, bins)
+        score_store.write_shard(temp_store_path, 'extended', items(),
+                                codec=codec)
+    return written
@@ -0,0 +1,106 @@
+import numpy as np
+import scipy.sparse
+
+import checkpoint
+
+# Layouts of the report matrices read by the PRR kernels. The outcome rows
+#  of the matched reports of every drug are gathered and summed, which CSR
+#  does by slicing each row, while CSC scans every column for each gather.
+#  Exposures are read by column, the sorted reports of a drug (see
+#  `coexposure.drug_report_indices`). Entries are bool, 1 byte instead of
+#  the 8 of float64, and indices are int32 when they fit, instead of int64.
+OUTCOME_FORMAT = 'csr'
+EXPOSURE_FORMAT = 'csc'
+DATA_DTYPE = np.dtype(bool)
+
+
+def _index_dtype(matrix):
+    if max(matrix.nnz, *matrix.shape) <= np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+
+def prepare_matrix(matrix, matrix_format):
+    """
+    A binary sparse matrix in `matrix_format` ("csr" or "csc"), with bool
+    entries, sorted indices without duplicates, and int32 indices when they
+    fit. Any nonzero entry is True. A `matrix` already in `matrix_format`
+    has its indices sorted in place.
+    """
+    matrix = matrix.asformat(matrix_format)
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    index_dtype = _index_dtype(matrix)
+    prepared = type(matrix)(
+        (np.ones(matrix.nnz, dtype=DATA_DTYPE),
+         matrix.indices.astype(index_dtype, copy=False),
+         matrix.indptr.astype(index_dtype, copy=False)),
+        shape=matrix.shape, copy=False
+    )
+    prepared.has_sorted_indices = True
+    return prepared
+
+
+def prepare_outcome_matrix(matrix):
+    """Reports (rows) by outcomes (columns), in `OUTCOME_FORMAT`"""
+    return prepare_matrix(matrix, OUTCOME_FORMAT)
+
+
+def prepare_exposure_matrix(matrix):
+    """Reports (rows) by drugs (columns), in `EXPOSURE_FORMAT`"""
+    return prepare_matrix(matrix, EXPOSURE_FORMAT)
+
+
+def check_matrix(matrix, matrix_format, name='matrix'):
+    """
+    Raise a ValueError unless `matrix` is in the layout of `prepare_matrix`
+    for `matrix_format`
+    """
+    problems = list()
+    if matrix.format != matrix_format:
+        problems.append(f'format is {matrix.format}, not {matrix_format}')
+    if matrix.dtype != DATA_DTYPE:
+        problems.append(f'entries are {matrix.dtype}, not {DATA_DTYPE}')
+    if matrix.indices.dtype != _index_dtype(matrix):
+        problems.append(f'indices are {matrix.indices.dtype}, '
+                        f'not {_index_dtype(matrix)}')
+    if matrix.format == matrix_format and not matrix.has_canonical_format:
+        problems.append('indices are unsorted or duplicated')
+    if problems:
+        raise ValueError(f'{name} is not in the expected layout: '
+                         f'{"; ".join(problems)}. See matrices.prepare_matrix.')
+
+
+def load_outcome_matrix(path, prepare=True):
+    """
+    Load an outcome matrix (eg. `outcome_matrix.npz`) in `OUTCOME_FORMAT`.
+    Matrices saved in another layout (eg. a CSC matrix of float64 ones, as
+    built by `1.format_outcomes_data.ipynb`) are converted, unless `prepare`
+    is False, in which case they raise a ValueError.
+    """
+    matrix = scipy.sparse.load_npz(path)
+    if prepare:
+        matrix = prepare_outcome_matrix(matrix)
+    check_matrix(matrix, OUTCOME_FORMAT, name=str(path))
+    return matrix
+
+
+def load_exposure_matrix(path, prepare=True):
+    """
+    Load an exposure matrix (eg. `drug_exposure_matrix.npz`) in
+    `EXPOSURE_FORMAT`, as `load_outcome_matrix`
+    """
+    matrix = scipy.sparse.load_npz(path)
+    if prepare:
+        matrix = prepare_exposure_matrix(matrix)
+    check_matrix(matrix, EXPOSURE_FORMAT, name=str(path))
+    return matrix
+
+
+def save_matrix(path, matrix, matrix_format):
+    """
+    Atomically save a matrix in the layout of `prepare_matrix`, so that it
+    loads without conversion
+    """
+    with checkpoint.atomic_path(path) as temp_path:
+        scipy.sparse.save_npz(temp_path, prepare_matrix(matrix, matrix_format))
@@ -0,0 +1,224 @@
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import pathlib
+
+import pandas as pd
+import tqdm
+
+import checkpoint
+import profiling
+import prr_io
+
+# Compression function, open function and file extension for each codec.
+#  Both formats allow concatenated streams, so independently compressed
+#  blocks can be written one after another and read back as a single file.
+CODECS = {
+    'xz': (lzma.compress, lzma.open, '.csv.xz'),
+    'gz': (gzip.compress, gzip.open, '.csv.gz'),
+}
+
+
+def _compress_frame(df, codec):
+    """CSV-format a DataFrame (without header) and compress it"""
+    compress, _, _ = CODECS[codec]
+    header = ','.join(df.columns) + '\n'
+    with profiling.timer('csv_format'):
+        body = df.to_csv(index=False, header=False).encode()
+    with profiling.timer('compress'):
+        compressed = compress(body)
+    profiling.count('bytes_compressed', len(body))
+    return header, compressed, len(df)
+
+
+def prr_files_block(file_paths, drug_id_vector, outcome_id_vector, codec):
+    """Read and compress a block of PRR result files (of any format)"""
+    frames = [prr_io.read_prr_result(path, drug_id_vector, outcome_id_vector)
+              for path in file_paths]
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    return _compress_frame(df, codec)
+
+
+def prr_table_block(table_path, start, stop, codec):
+    """Read and compress rows `start:stop` of a columnar PRR table"""
+    df = prr_io.read_prr_table_rows(table_path, start, stop)
+    return _compress_frame(df, codec)
+
+
+def _shard_path(save_path, codec, shard_number):
+    _, _, extension = CODECS[codec]
+    stem = save_path.name[:-len(extension)]
+    return save_path.parent.joinpath(f'{stem}.part-{shard_number:05d}{extension}')
+
+
+def manifest_path(save_path, codec='xz'):
+    """Path of the manifest `write_blocks` saves next to an output"""
+    _, _, extension = CODECS[codec]
+    stem = save_path.name[:-len(extension)]
+    return save_path.parent.joinpath(f'{stem}.manifest.json')
+
+
+def read_manifest(save_path, codec='xz'):
+    """The manifest saved by `write_blocks` for an output, or None"""
+    path = manifest_path(save_path, codec)
+    if not path.is_file():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_blocks(block_function, blocks, save_path, codec='xz',
+                 shard_rows=None, max_workers=None, max_pending=None,
+                 sources=None):
+    """
+    Compress blocks in parallel and write them, in order, to a single output
+    file or to a series of shards. Only `max_pending` blocks are in flight
+    at any time, which bounds memory use regardless of the size of the
+    output.
+
+    Parameters
+    ----------
+    block_function : Callable
+        Module-level function (eg. `prr_files_block`) called as
+        `block_function(*block, codec=codec)` in a worker process. Returns a
+        CSV header line, the compressed CSV body, and the number of rows.
+    blocks : List[tuple]
+        Arguments for each call of `block_function`
+    save_path : pathlib.Path
+        Output path, eg. `/data/tables/offsides.csv.xz`. With shards, files
+        are named like `offsides.part-00000.csv.xz`.
+    codec : str
+        One of `CODECS`
+    shard_rows : int
+        Start a new shard once a shard has at least this many rows. By
+        default everything is written to `save_path`.
+    max_workers : int
+        Number of worker processes (default is the number of processors)
+    max_pending : int
+        Maximum number of blocks being compressed or waiting to be written.
+        Default is twice the number of workers.
+    sources : List[str]
+        Names of the input files, recorded in the manifest (as `files`)
+
+    Returns
+    -------
+    dict
+        Manifest of the written shards (file name, rows, bytes, sha256), also
+        saved as `{stem}.manifest.json` next to the output.
+
+    Shards are written to temporary files and only moved into place (along
+    with the manifest) once every block has been written, so an interrupted
+    run leaves no partial output.
+    """
+    compress, _, extension = CODECS[codec]
+    if not save_path.name.endswith(extension):
+        raise ValueError(f'{save_path.name} should end with {extension} for {codec}')
+
+    # Shards are moved into place as the stack exits, then the manifest
+    with contextlib.ExitStack() as atomic_paths:
+        manifest = _write_blocks(block_function, blocks, save_path, codec,
+                                 shard_rows, max_workers, max_pending,
+                                 atomic_paths)
+    if sources is not None:
+        manifest['files'] = list(sources)
+    with checkpoint.atomic_path(manifest_path(save_path, codec)) as temp_path:
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _write_blocks(block_function, blocks, save_path, codec, shard_rows,
+                  max_workers, max_pending, atomic_paths):
+    compress, _, _ = CODECS[codec]
+    shards = list()
+    output = None
+
+    def open_shard():
+        path = (save_path if shard_rows is None else
+                _shard_path(save_path, codec, len(shards)))
+        shards.append({'file': path.name, 'rows': 0, 'bytes': 0,
+                       'sha256': hashlib.sha256()})
+        return open(atomic_paths.enter_context(checkpoint.atomic_path(path)),
+                    'wb')
+
+    def write(data):
+        output.write(data)
+        shards[-1]['bytes'] += len(data)
+        shards[-1]['sha256'].update(data)
+
+    max_workers = max_workers or os.cpu_count()
+    max_pending = max_pending or 2 * max_workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        pending = collections.deque()
+        block_iterator = iter(blocks)
+        progress = tqdm.tqdm(total=len(blocks))
+        while True:
+            # Keep the pool busy, without holding more than max_pending blocks
+            for block in block_iterator:
+                pending.append(executor.submit(block_function, *block, codec=codec))
+                if len(pending) >= max_pending:
+                    break
+            if len(pending) == 0:
+                break
+
+            header, data, n_rows = pending.popleft().result()
+            if output is None or (shard_rows is not None
+                                  and shards[-1]['rows'] >= shard_rows):
+                if output is not None:
+                    output.close()
+                output = open_shard()
+                write(compress(header.encode()))
+            write(data)
+            shards[-1]['rows'] += n_rows
+            progress.update()
+        progress.close()
+
+    if output is None:
+        output = open_shard()
+    output.close()
+
+    for shard in shards:
+        shard['sha256'] = shard['sha256'].hexdigest()
+    manifest = {
+        'codec': codec,
+        'rows': sum(shard['rows'] for shard in shards),
+        'blocks': len(blocks),
+        'shards': shards,
+    }
+    return manifest
+
+
+def verify_output(manifest, directory):
+    """
+    Check that every shard in a manifest has the recorded size and checksum,
+    and that it decompresses to a header plus the recorded number of rows.
+    """
+    _, open_function, _ = CODECS[manifest['codec']]
+    for shard in manifest['shards']:
+        path = pathlib.Path(directory).joinpath(shard['file'])
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(io.DEFAULT_BUFFER_SIZE * 256), b''):
+                digest.update(data)
+        if path.stat().st_size != shard['bytes'] or digest.hexdigest() != shard['sha256']:
+            return False
+
+        # An empty output (no blocks) is an empty file, with no header
+        if shard['bytes'] == 0:
+            if shard['rows'] != 0:
+                return False
+            continue
+
+        n_lines = 0
+        with open_function(path, 'rb') as f:
+            for data in iter(lambda: f.read(io.DEFAULT_BUFFER_SIZE * 256), b''):
+                n_lines += data.count(b'\n')
+        if n_lines != shard['rows'] + 1:
+            return False
+    return True
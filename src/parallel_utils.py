@@ -1,11 +1,16 @@
+import numpy as np
 import pandas as pd
 
 import calculate_prr
+import profiling
+import prr_io
+import shared_data
 import utils
 
 
 def prr_one_drug(drug_index, all_exposures, all_outcomes, n_reports,
-                 drug_id_vector, outcome_id_vector, scores_path, save_path):
+                 drug_id_vector, outcome_id_vector, scores_path, save_path,
+                 output_format='csv', rows='all', matching='sampled'):
     """
     Helper function to compute and save disproportionality statistics for a
     given drug. To use with `concurrent.futures` most easily, the user should
@@ -13,25 +18,78 @@ def prr_one_drug(drug_index, all_exposures, all_outcomes, n_reports,
     the resulting function requires only `drug_index`. This partial function
     can then be mapped to an iterable of integers for each drug index and
     easily parallelized using `concurrent.futures.ProcessPoolExecutor`.
+
+    `all_exposures` and `all_outcomes` may also be given as
+    `shared_data.SharedReference`s to matrices attached in the worker by
+    `shared_data.init_worker`, so that they are not pickled with each task.
+
+    `output_format` is any of `prr_io.WRITERS`, `"csv"` (`.csv.xz` files with
+    drug and outcome IDs) or `"npz"` (typed, columnar files with indices).
+    `rows` selects the outcomes written, every outcome or only exposed
+    outcomes or signals (see `calculate_prr.compute_prr_rows`), and
+    `matching` how C is computed (see `calculate_prr.MATCHING`).
     """
-    scores = utils.load_scores_offsides(drug_index, n_reports, scores_path)
-    drug_exposures = all_exposures[:, drug_index]
+    with profiling.timer('drug'):
+        all_exposures = shared_data.resolve(all_exposures)
+        all_outcomes = shared_data.resolve(all_outcomes)
+        scores = utils.load_scores_offsides(drug_index, n_reports, scores_path)
+        drug_exposures = all_exposures[:, drug_index]
+
+        drug_df, totals = _prr_helper(scores, drug_exposures, all_outcomes,
+                                      outcome_id_vector, rows, matching)
+
+        _save_drug_df(drug_df, totals, drug_index, drug_id_vector,
+                      outcome_id_vector, save_path, output_format)
+
+
+def prr_drug_block(drug_indices, all_exposures, all_outcomes, n_reports,
+                   drug_id_vector, outcome_id_vector, scores_path, save_path,
+                   output_format='csv', rows='all', matching='sampled'):
+    """
+    Compute and save disproportionality statistics for a block of drugs,
+    using one sparse matrix product for the whole block rather than separate
+    row gathers for each drug (see `calculate_prr.compute_ABCD_drug_block`).
+    Output files are identical to those of `prr_one_drug`. As with
+    `prr_one_drug`, use a `functools.partial` function so that only
+    `drug_indices` (a list of drug indices) must be given, and the matrices
+    may be `shared_data.SharedReference`s.
+    """
+    with profiling.timer('drug_block'):
+        all_exposures = shared_data.resolve(all_exposures)
+        all_outcomes = shared_data.resolve(all_outcomes)
+        exposures_and_scores = (
+            (all_exposures[:, drug_index],
+             utils.load_scores_offsides(drug_index, n_reports, scores_path))
+            for drug_index in drug_indices
+        )
+        A, a_plus_b, C, c_plus_d = calculate_prr.compute_ABCD_drug_block(
+            exposures_and_scores, all_outcomes, matching=matching)
 
-    drug_df = _prr_helper(scores, drug_exposures, all_outcomes,
-                          outcome_id_vector)
+        for i, drug_index in enumerate(drug_indices):
+            drug_df = _prr_frame(A[i], a_plus_b[i], C[i], c_plus_d[i],
+                                 outcome_id_vector, rows)
+            _save_drug_df(drug_df, (a_plus_b[i], c_plus_d[i]), drug_index,
+                          drug_id_vector, outcome_id_vector, save_path,
+                          output_format)
+    profiling.count('drugs', len(drug_indices))
 
+
+def _save_drug_df(drug_df, totals, drug_index, drug_id_vector,
+                  outcome_id_vector, save_path, output_format):
     drug_df = (
         drug_df
-        .assign(drug_id=drug_id_vector[drug_index])
-        .filter(items=['drug_id', 'outcome_id', 'A', 'B', 'C', 'D',
+        .assign(drug_index=drug_index)
+        .filter(items=['drug_index', 'outcome_index', 'A', 'B', 'C', 'D',
                        'PRR', 'PRR_error'])
     )
-    drug_df.to_csv(save_path.joinpath(f'{drug_index}.csv.xz'), index=False,
-                   compression='xz')
+    prr_io.write_prr_result(drug_df, save_path.joinpath(str(drug_index)),
+                            output_format, drug_id_vector, outcome_id_vector,
+                            totals, (drug_index,))
 
 
 def prr_one_combination(drug_indices, all_exposures, all_outcomes, n_reports,
-                        drug_id_vector, outcome_id_vector, scores_path, save_path):
+                        drug_id_vector, outcome_id_vector, scores_path, save_path,
+                        output_format='csv', rows='all', matching='sampled'):
     """
     Parameters
     ----------
@@ -43,6 +101,84 @@ def prr_one_combination(drug_indices, all_exposures, all_outcomes, n_reports,
         to enforce a sorting method on IDs which may not be integers.
     Other parameters are identical to the function for a single drug.
     """
+    with profiling.timer('combination'):
+        _prr_one_combination(drug_indices, all_exposures, all_outcomes,
+                             n_reports, drug_id_vector, outcome_id_vector,
+                             scores_path, save_path, output_format, rows,
+                             matching)
+
+
+def prr_resampled_combination(drug_indices, all_exposures, all_outcomes,
+                              n_reports, drug_id_vector, outcome_id_vector,
+                              scores_path, save_path, n_resamples=50):
+    """
+    Compute and save the mean, standard deviation and 95% interval of PRR
+    across `n_resamples` samples of unexposed controls (see
+    `calculate_prr.compute_ABCD_resampled`) for a drug (`drug_indices` of
+    length 1) or drug combination, as `{indices}.csv.xz`. Only outcomes with
+    A > 0 are written, since PRR is 0 in every resample otherwise. Other
+    parameters are those of `prr_one_combination`.
+    """
+    with profiling.timer('resampled_combination'):
+        all_exposures = shared_data.resolve(all_exposures)
+        all_outcomes = shared_data.resolve(all_outcomes)
+        if len(drug_indices) == 1:
+            scores = utils.load_scores_offsides(drug_indices[0], n_reports,
+                                                scores_path)
+            indices_string = str(drug_indices[0])
+        else:
+            # As in `_prr_one_combination`, some files fail to load
+            try:
+                scores, indices_string = utils.load_scores_nsides(
+                    drug_indices, n_reports, scores_path)
+            except:  # noqa:E722
+                return
+        drug_exposures = utils.compute_multi_exposure(drug_indices,
+                                                      all_exposures)
+        A, a_plus_b, C, c_plus_d = calculate_prr.compute_ABCD_resampled(
+            drug_exposures, scores, all_outcomes, n_resamples=n_resamples)
+
+        outcome_indices = np.flatnonzero(A > 0)
+        summaries = calculate_prr.summarize_prr_resamples(
+            A[outcome_indices], a_plus_b, C[:, outcome_indices], c_plus_d)
+        drug_df = pd.DataFrame().assign(
+            outcome_index=outcome_indices,
+            A=A[outcome_indices].astype(prr_io.COLUMN_DTYPES['A']),
+            **summaries
+        )
+        drug_columns = prr_io.drug_index_columns(len(drug_indices))
+        for drug_column, drug_index in zip(drug_columns, drug_indices):
+            drug_df[drug_column] = drug_index
+        drug_df = drug_df.loc[~pd.isnull(outcome_id_vector[outcome_indices])]
+        prr_io.write_resampled_csv(drug_df, save_path.joinpath(indices_string),
+                                   drug_id_vector, outcome_id_vector)
+
+
+def prr_resampled_combinations(combinations, *args, **kwargs):
+    """
+    `prr_resampled_combination` for each of a chunk of combinations, as one
+    task
+    """
+    for drug_indices in combinations:
+        prr_resampled_combination(drug_indices, *args, **kwargs)
+
+
+def prr_combinations(combinations, *args, **kwargs):
+    """
+    `prr_one_combination` for each of a chunk of combinations (eg. from
+    `scheduling.plan_chunks`), as one task. Other parameters are those of
+    `prr_one_combination`.
+    """
+    for drug_indices in combinations:
+        prr_one_combination(drug_indices, *args, **kwargs)
+
+
+def _prr_one_combination(drug_indices, all_exposures, all_outcomes, n_reports,
+                         drug_id_vector, outcome_id_vector, scores_path,
+                         save_path, output_format, rows, matching):
+    all_exposures = shared_data.resolve(all_exposures)
+    all_outcomes = shared_data.resolve(all_outcomes)
+
     # For some reason a number of files fail to load or don't contain data, etc.
     try:
         scores, indices_string = utils.load_scores_nsides(drug_indices, n_reports,
@@ -50,40 +186,69 @@ def prr_one_combination(drug_indices, all_exposures, all_outcomes, n_reports,
     except:  # noqa:E722
         return
 
+    drug_df, totals = prr_combination_frame(drug_indices, scores,
+                                            all_exposures, all_outcomes,
+                                            outcome_id_vector, rows,
+                                            matching)
+    prr_io.write_prr_result(drug_df, save_path.joinpath(indices_string),
+                            output_format, drug_id_vector, outcome_id_vector,
+                            totals, drug_indices)
+
+
+def prr_combination_frame(drug_indices, scores, all_exposures, all_outcomes,
+                          outcome_id_vector, rows='all', matching='sampled'):
+    """
+    Disproportionality statistics of one drug combination given its scores,
+    as saved by `prr_one_combination` (with columns `drug_index_1`, ...,
+    `drug_index_n`), and its numbers of exposed (A + B) and unexposed
+    (C + D) reports
+    """
     drug_exposures = utils.compute_multi_exposure(drug_indices, all_exposures)
 
-    drug_df = _prr_helper(scores, drug_exposures, all_outcomes,
-                          outcome_id_vector)
+    drug_df, totals = _prr_helper(scores, drug_exposures, all_outcomes,
+                                  outcome_id_vector, rows, matching)
 
-    # Add IDs of drugs as columns drug_1, drug_2, ..., drug_n
-    drug_columns = list()
-    for i, drug_index in enumerate(drug_indices):
-        drug_df[f'drug_{i+1}'] = drug_id_vector[drug_index]
-        drug_columns.append(f'drug_{i+1}')
+    # Add indices of drugs as columns drug_index_1, ..., drug_index_n. These
+    #  become the drug ID columns drug_1, drug_2, ..., drug_n in CSV output.
+    drug_columns = prr_io.drug_index_columns(len(drug_indices))
+    for drug_column, drug_index in zip(drug_columns, drug_indices):
+        drug_df[drug_column] = drug_index
 
-    drug_df = drug_df.filter(items=[*drug_columns, 'outcome_id', 'A', 'B', 'C',
-                                    'D', 'PRR', 'PRR_error'])
-    drug_df.to_csv(save_path.joinpath(indices_string + '.csv.xz'),
-                   index=False, compression='xz')
+    drug_df = drug_df.filter(items=[*drug_columns, 'outcome_index', 'A', 'B',
+                                    'C', 'D', 'PRR', 'PRR_error'])
+    return drug_df, totals
 
 
-def _prr_helper(scores, drug_exposures, all_outcomes, outcome_id_vector):
-    A, a_plus_b, C, c_plus_d = calculate_prr.compute_ABCD_one_drug(drug_exposures,
-                                                                   scores,
-                                                                   all_outcomes)
-    prr, prr_error = calculate_prr.compute_prr(A, a_plus_b, C, c_plus_d)
-    drug_df = (
-        pd.DataFrame()
-        .assign(
-            outcome_id=outcome_id_vector,
-            A=A,
-            B=a_plus_b - A,
-            C=C,
-            D=c_plus_d - C,
-            PRR=prr,
-            PRR_error=prr_error,
+def _prr_helper(scores, drug_exposures, all_outcomes, outcome_id_vector,
+                rows='all', matching='sampled'):
+    A, a_plus_b, C, c_plus_d = calculate_prr.compute_ABCD_one_drug(
+        drug_exposures, scores, all_outcomes, matching=matching)
+    drug_df = _prr_frame(A, a_plus_b, C, c_plus_d, outcome_id_vector, rows)
+    return drug_df, (a_plus_b, c_plus_d)
+
+
+def _prr_frame(A, a_plus_b, C, c_plus_d, outcome_id_vector, rows='all'):
+    outcome_indices, prr, prr_error = calculate_prr.compute_prr_rows(
+        A, a_plus_b, C, c_plus_d, rows)
+    A = A[outcome_indices]
+    C = C[outcome_indices]
+    # Expected counts (see `calculate_prr.expected_unexposed_by_bin`) are
+    #  stored rounded, though PRR is computed from the exact values
+    if C.dtype.kind == 'f':
+        C = np.rint(C).astype(np.int64)
+    with profiling.timer('dataframe_build'):
+        drug_df = (
+            pd.DataFrame()
+            .assign(
+                outcome_index=outcome_indices,
+                A=A,
+                B=a_plus_b - A,
+                C=C,
+                D=c_plus_d - C,
+                PRR=prr,
+                PRR_error=prr_error,
+            )
+            # The first entry in the outcome vector is `None`
+            .loc[~pd.isnull(outcome_id_vector[outcome_indices])]
         )
-        # The first entry in the outcome vector is `None`
-        .query('not outcome_id.isnull()')
-    )
     return drug_df
@@ -0,0 +1,258 @@
+import array
+import collections
+import contextlib
+import json
+import math
+import multiprocessing.util
+import os
+import pathlib
+import resource
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# Profiling is on when this environment variable names a directory for the
+#  reports (eg. `NSIDES_PROFILE=/data/profile python 3.compute_prr.py`).
+#  When off, `timer` returns a shared do-nothing context manager and
+#  `count` returns immediately, so instrumented code pays one check.
+PROFILE_VARIABLE = 'NSIDES_PROFILE'
+
+# Set by `start_stage` for the stage's worker processes to inherit
+STAGE_VARIABLE = 'NSIDES_PROFILE_STAGE'
+
+ENABLED = bool(os.environ.get(PROFILE_VARIABLE))
+
+# Latencies are kept as counts in logarithmic buckets (10 per decade, from
+#  1 microsecond to about 3 hours), which merge across workers and bound
+#  memory however many calls are timed
+_BUCKETS_PER_DECADE = 10
+_MIN_LOG10 = -6
+_N_BUCKETS = 10 * _BUCKETS_PER_DECADE
+
+_NULL_TIMER = contextlib.nullcontext()
+
+# Statistics of this process: per section, [calls, wall seconds, CPU seconds,
+#  latency histogram], and counters
+_SECTIONS = dict()
+_COUNTERS = collections.Counter()
+_STARTED = {'wall': time.time(), 'cpu': time.process_time()}
+_REGISTERED = {'pid': None}
+
+# Sections may be timed by several threads of a process
+_LOCK = threading.Lock()
+
+
+def _bucket(seconds):
+    if seconds <= 0:
+        return 0
+    bucket = int((math.log10(seconds) - _MIN_LOG10) * _BUCKETS_PER_DECADE)
+    return min(max(bucket, 0), _N_BUCKETS - 1)
+
+
+def _bucket_upper_bound(bucket):
+    return 10 ** (_MIN_LOG10 + (bucket + 1) / _BUCKETS_PER_DECADE)
+
+
+def _reset():
+    _SECTIONS.clear()
+    _COUNTERS.clear()
+    _STARTED.update(wall=time.time(), cpu=time.process_time())
+
+
+# Worker processes forked from a profiled process start from zero
+os.register_at_fork(after_in_child=_reset)
+
+
+def _register():
+    """Write this process's report when it exits (including pool workers)"""
+    if _REGISTERED['pid'] == os.getpid():
+        return
+    _REGISTERED['pid'] = os.getpid()
+    multiprocessing.util.Finalize(None, write_worker_report, exitpriority=10)
+
+
+class _Timer:
+    __slots__ = ('section', 'wall', 'cpu')
+
+    def __init__(self, section):
+        self.section = section
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        _register()
+        with _LOCK:
+            stats = _SECTIONS.get(self.section)
+            if stats is None:
+                stats = [0, 0.0, 0.0, array.array('q', [0] * _N_BUCKETS)]
+                _SECTIONS[self.section] = stats
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3][_bucket(wall)] += 1
+
+
+def timer(section):
+    """
+    Context manager timing a section of code (wall and CPU time, and the
+    distribution of its latency) when profiling is on
+
+    Example
+    -------
+    >>> with profiling.timer('score_load'):
+    ...     scores = np.load(path)
+    """
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(section)
+
+
+def count(counter, n=1):
+    """Add `n` to a counter (eg. `"bytes_read"`) when profiling is on"""
+    if not ENABLED:
+        return
+    _register()
+    with _LOCK:
+        _COUNTERS[counter] += n
+
+
+def _report_directory(stage):
+    return pathlib.Path(os.environ[PROFILE_VARIABLE]).joinpath(stage)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def write_worker_report(stage=None):
+    """
+    Write this process's statistics as `{stage}/{host}-{pid}.json` in the
+    profile directory. Called when each process exits, or directly.
+    """
+    if not ENABLED or not (_SECTIONS or _COUNTERS):
+        return
+    stage = stage or os.environ.get(STAGE_VARIABLE, 'default')
+    directory = _report_directory(stage)
+    directory.mkdir(parents=True, exist_ok=True)
+    report = {
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'wall_seconds': time.time() - _STARTED['wall'],
+        'cpu_seconds': time.process_time() - _STARTED['cpu'],
+        'peak_rss_mb': _peak_rss_mb(),
+        'sections': {section: {'calls': calls, 'wall_seconds': wall,
+                               'cpu_seconds': cpu, 'histogram': list(histogram)}
+                     for section, (calls, wall, cpu, histogram)
+                     in _SECTIONS.items()},
+        'counters': dict(_COUNTERS),
+    }
+    path = directory.joinpath(f'{socket.gethostname()}-{os.getpid()}.json')
+    with open(path, 'w') as f:
+        json.dump(report, f)
+
+
+def start_stage(stage):
+    """
+    Name the stage whose statistics are recorded from now on, in this process
+    and in the workers it starts. Reports of an earlier run of the stage are
+    removed.
+    """
+    if not ENABLED:
+        return
+    os.environ[STAGE_VARIABLE] = stage
+    directory = _report_directory(stage)
+    if directory.is_dir():
+        for path in directory.glob('*.json'):
+            path.unlink()
+    _reset()
+
+
+def _percentile(histogram, q):
+    """Upper bound of the bucket holding the `q` quantile of a histogram"""
+    cumulative = np.cumsum(histogram)
+    if cumulative[-1] == 0:
+        return float('nan')
+    bucket = int(np.searchsorted(cumulative, q * cumulative[-1]))
+    return _bucket_upper_bound(bucket)
+
+
+def write_stage_report(stage=None):
+    """
+    Combine the reports of every process of a stage into `{stage}.json` and
+    `{stage}.csv` (one row per section) in the profile directory: wall and
+    CPU time, calls and latency percentiles per section, summed counters (eg.
+    bytes read and written), and the peak RSS of each process.
+
+    Returns
+    -------
+    dict
+        The combined report, or `None` when profiling is off
+    """
+    if not ENABLED:
+        return None
+    stage = stage or os.environ.get(STAGE_VARIABLE, 'default')
+    write_worker_report(stage)
+    worker_reports = list()
+    for path in sorted(_report_directory(stage).glob('*.json')):
+        with open(path) as f:
+            worker_reports.append(json.load(f))
+
+    sections = dict()
+    counters = collections.Counter()
+    for report in worker_reports:
+        counters.update(report['counters'])
+        for section, stats in report['sections'].items():
+            total = sections.setdefault(section, {
+                'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                'histogram': np.zeros(_N_BUCKETS, dtype=np.int64)})
+            total['calls'] += stats['calls']
+            total['wall_seconds'] += stats['wall_seconds']
+            total['cpu_seconds'] += stats['cpu_seconds']
+            total['histogram'] += np.array(stats['histogram'])
+
+    rows = list()
+    for section, total in sorted(sections.items()):
+        histogram = total.pop('histogram')
+        total.update({
+            'mean_seconds': total['wall_seconds'] / total['calls'],
+            'p50_seconds': _percentile(histogram, 0.5),
+            'p90_seconds': _percentile(histogram, 0.9),
+            'p99_seconds': _percentile(histogram, 0.99),
+            'max_seconds': _bucket_upper_bound(int(np.flatnonzero(histogram)[-1])),
+        })
+        rows.append({'section': section, **total})
+
+    stage_report = {
+        'stage': stage,
+        'wall_seconds': max((report['wall_seconds']
+                             for report in worker_reports), default=0.0),
+        'cpu_seconds': sum(report['cpu_seconds'] for report in worker_reports),
+        'peak_rss_mb': max((report['peak_rss_mb']
+                            for report in worker_reports), default=0.0),
+        'n_processes': len(worker_reports),
+        'counters': dict(counters),
+        'sections': {row['section']: {key: value for key, value in row.items()
+                                      if key != 'section'} for row in rows},
+        'processes': [{key: report[key] for key in
+                       ('host', 'pid', 'wall_seconds', 'cpu_seconds',
+                        'peak_rss_mb')} for report in worker_reports],
+    }
+    profile_path = pathlib.Path(os.environ[PROFILE_VARIABLE])
+    with open(profile_path.joinpath(f'{stage}.json'), 'w') as f:
+        json.dump(stage_report, f, indent=2)
+    pd.DataFrame(rows, columns=['section', 'calls', 'wall_seconds',
+                                'cpu_seconds', 'mean_seconds', 'p50_seconds',
+                                'p90_seconds', 'p99_seconds', 'max_seconds']
+                 ).to_csv(profile_path.joinpath(f'{stage}.csv'), index=False)
+    return stage_report
@@ -0,0 +1,661 @@
+import concurrent.futures
+import hashlib
+import json
+import pathlib
+import re
+
+import numpy as np
+import pandas as pd
+
+import checkpoint
+import profiling
+import scheduling
+
+# Types used in the columnar formats. Drugs and outcomes are stored as their
+#  integer index into `drug_id_vector` and `outcome_id_vector`.
+COLUMN_DTYPES = {
+    'outcome_index': np.int32,
+    'A': np.int32,
+    'B': np.int32,
+    'C': np.int32,
+    'D': np.int32,
+    'PRR': np.float32,
+    'PRR_error': np.float32,
+}
+
+STAT_COLUMNS = ['A', 'B', 'C', 'D', 'PRR', 'PRR_error']
+
+# Summaries of PRR across resampled controls (see
+#  `calculate_prr.summarize_prr_resamples`)
+RESAMPLE_COLUMNS = ['A', 'PRR_mean', 'PRR_sd', 'PRR_lower', 'PRR_upper']
+
+# B and D are not stored in `.npz` result files. Each is derived from A (or
+#  C) and the drug's number of exposed (A + B) or unexposed (C + D)
+#  reports, which are stored once per file as `totals`.
+DERIVED_COLUMNS = {'B': ('A', 0), 'D': ('C', 1)}
+
+# Side table of a table directory with the numbers of exposed (A + B) and
+#  unexposed (C + D) reports of each drug (or combination) in the table. As
+#  in `.npz` files, B and D are not stored in the table, but derived from
+#  these when it is read.
+TOTALS_TABLE = 'totals'
+
+# Manifest of a table directory written by `write_prr_table`: its number of
+#  rows, the names of the files combined into it, and a checksum of each
+#  block of rows (see `verify_prr_table`)
+TABLE_MANIFEST = 'manifest.json'
+
+# File extension of a single drug or combination's results in each format
+EXTENSIONS = {
+    'csv': '.csv.xz',
+    'npz': '.npz',
+}
+
+
+def drug_index_columns(n_drugs):
+    """Names of drug index columns, `drug_index` or `drug_index_1`, ..."""
+    if n_drugs == 1:
+        return ['drug_index']
+    return [f'drug_index_{i + 1}' for i in range(n_drugs)]
+
+
+def drug_id_columns(n_drugs):
+    """Names of drug ID columns, `drug_id` or `drug_1`, `drug_2`, ..."""
+    if n_drugs == 1:
+        return ['drug_id']
+    return [f'drug_{i + 1}' for i in range(n_drugs)]
+
+
+def _n_drugs(columns):
+    return sum(1 for column in columns if re.match('drug_index', column))
+
+
+def decode_ids(index_df, drug_id_vector, outcome_id_vector,
+               columns=STAT_COLUMNS):
+    """
+    Convert a results DataFrame with integer `drug_index*` and
+    `outcome_index` columns to the ID-based layout of the CSV files:
+    `drug_id` (or `drug_1`, ..., `drug_n`), `outcome_id`, and `columns` (by
+    default A, B, C, D, PRR and PRR_error).
+    """
+    n_drugs = _n_drugs(index_df.columns)
+    id_df = pd.DataFrame()
+    for index_column, id_column in zip(drug_index_columns(n_drugs),
+                                       drug_id_columns(n_drugs)):
+        id_df[id_column] = drug_id_vector[index_df[index_column].values]
+    id_df['outcome_id'] = outcome_id_vector[index_df['outcome_index'].values]
+    for column in columns:
+        id_df[column] = index_df[column].values
+    return id_df
+
+
+def write_csv(index_df, file_stem, drug_id_vector, outcome_id_vector,
+              totals=None, drug_indices=None):
+    """Write results with drug and outcome IDs to `{file_stem}.csv.xz`"""
+    (
+        decode_ids(index_df, drug_id_vector, outcome_id_vector)
+        .to_csv(f'{file_stem}.csv.xz', index=False, compression='xz')
+    )
+
+
+def write_resampled_csv(index_df, file_stem, drug_id_vector,
+                        outcome_id_vector):
+    """
+    Atomically write resampled PRR summaries (`RESAMPLE_COLUMNS`) with drug
+    and outcome IDs to `{file_stem}.csv.xz`
+    """
+    with profiling.timer('write'):
+        with checkpoint.atomic_path(f'{file_stem}.csv.xz') as temp_path:
+            (
+                decode_ids(index_df, drug_id_vector, outcome_id_vector,
+                           RESAMPLE_COLUMNS)
+                .to_csv(temp_path, index=False, compression='xz')
+            )
+
+
+def write_npz(index_df, file_stem, drug_id_vector, outcome_id_vector,
+              totals=None, drug_indices=None):
+    """
+    Write results to an uncompressed, typed `{file_stem}.npz`. Drugs and
+    outcomes are kept as integer indices (the ID vectors are not needed).
+    Because every row of a file has the same drug(s), each drug index is
+    stored once rather than once per row, as are the numbers of exposed
+    (A + B) and unexposed (C + D) reports, `totals`, instead of B and D.
+    Both `drug_indices` and `totals` are by default taken from the first
+    row.
+    """
+    if totals is None:
+        totals = ((index_df['A'].iloc[0] + index_df['B'].iloc[0],
+                   index_df['C'].iloc[0] + index_df['D'].iloc[0])
+                  if len(index_df) else (0, 0))
+    arrays = {
+        column: index_df[column].values.astype(dtype)
+        for column, dtype in COLUMN_DTYPES.items()
+        if column not in DERIVED_COLUMNS
+    }
+    arrays['totals'] = np.array(totals, dtype=np.int64)
+    n_drugs = _n_drugs(index_df.columns)
+    if drug_indices is None:
+        drug_indices = [index_df[column].iloc[0] if len(index_df) else -1
+                        for column in drug_index_columns(n_drugs)]
+    arrays['drug_indices'] = np.array(drug_indices, dtype=np.int32)
+    np.savez(f'{file_stem}.npz', **arrays)
+
+
+WRITERS = {
+    'csv': write_csv,
+    'npz': write_npz,
+}
+
+
+def write_prr_result(index_df, file_stem, output_format, drug_id_vector,
+                     outcome_id_vector, totals=None, drug_indices=None):
+    """
+    Save the results for one drug (or drug combination). The file is written
+    atomically (see `checkpoint.atomic_path`), so it is complete if it exists.
+
+    Parameters
+    ----------
+    index_df : pandas.DataFrame
+        Columns `drug_index` (or `drug_index_1`, ..., `drug_index_n`),
+        `outcome_index`, A, B, C, D, PRR and PRR_error
+    file_stem : pathlib.Path
+        Path to save to, without extension (eg. `/data/prr/1/1234`)
+    output_format : str
+        One of `WRITERS`, `"csv"` (`.csv.xz` with IDs) or `"npz"` (columnar)
+    drug_id_vector : numpy.ndarray
+    outcome_id_vector : numpy.ndarray
+    totals : Tuple[int, int]
+        Numbers of exposed (A + B) and unexposed (C + D) reports
+    drug_indices : Tuple[int, ...]
+        Indices of the drug (or combination). These and `totals` are needed
+        in `.npz` files when `index_df` may have no rows (see
+        `calculate_prr.compute_prr_rows`).
+    """
+    try:
+        writer = WRITERS[output_format]
+    except KeyError:
+        raise ValueError(f'Unknown output format {output_format}. '
+                         f'Options are {list(WRITERS)}')
+    extension = EXTENSIONS[output_format]
+    with profiling.timer('write'):
+        with checkpoint.atomic_path(f'{file_stem}{extension}') as temp_path:
+            writer(index_df, str(temp_path)[:-len(extension)], drug_id_vector,
+                   outcome_id_vector, totals, drug_indices)
+            if profiling.ENABLED:
+                profiling.count('bytes_written', temp_path.stat().st_size)
+
+
+def read_npz_indices(path):
+    """Read a `.npz` result file as a DataFrame of indices and statistics"""
+    with np.load(path) as npz:
+        arrays = {column: npz[column] for column in COLUMN_DTYPES
+                  if column in npz.files}
+        # Files written before `totals` was stored have B and D
+        if 'totals' in npz.files:
+            totals = npz['totals']
+            for column, (total_column, k) in DERIVED_COLUMNS.items():
+                arrays[column] = (totals[k] - arrays[total_column]).astype(
+                    COLUMN_DTYPES[column])
+        index_df = pd.DataFrame({column: arrays[column]
+                                 for column in COLUMN_DTYPES})
+        drug_indices = npz['drug_indices']
+    columns = drug_index_columns(len(drug_indices))
+    for column, drug_index in zip(columns, drug_indices):
+        index_df[column] = np.int32(drug_index)
+    return index_df.filter(items=[*columns, *COLUMN_DTYPES])
+
+
+def _npz_totals(npz):
+    if 'totals' in npz.files:
+        return npz['totals'].astype(np.int64)
+    # Files written before `totals` was stored have B and D
+    if len(npz['A']) == 0:
+        return np.zeros(2, dtype=np.int64)
+    return np.array([npz['A'][0] + npz['B'][0], npz['C'][0] + npz['D'][0]],
+                    dtype=np.int64)
+
+
+def read_npz_totals(path):
+    """
+    Drug indices and numbers of exposed (A + B) and unexposed (C + D)
+    reports of a `.npz` result file
+    """
+    with np.load(path) as npz:
+        return npz['drug_indices'], tuple(int(n) for n in _npz_totals(npz))
+
+
+def npz_length(path):
+    """Number of rows of a `.npz` result file"""
+    with np.load(path) as npz:
+        return npz['outcome_index'].shape[0]
+
+
+def _write_totals(table_path, drug_columns, drug_indices, totals):
+    totals_path = table_path.joinpath(TOTALS_TABLE)
+    totals_path.mkdir(parents=True, exist_ok=True)
+    drug_indices = np.asarray(drug_indices, dtype=np.int32).reshape(
+        -1, len(drug_columns))
+    totals = np.asarray(totals, dtype=np.int64).reshape(-1, 2)
+    for k, column in enumerate(drug_columns):
+        np.save(totals_path.joinpath(f'{column}.npy'), drug_indices[:, k])
+    np.save(totals_path.joinpath('n_exposed.npy'), totals[:, 0])
+    np.save(totals_path.joinpath('n_unexposed.npy'), totals[:, 1])
+
+
+def read_totals(table_path, decode=True):
+    """
+    The side table of a table written by `write_prr_table`: the numbers of
+    exposed (`n_exposed`, A + B) and unexposed (`n_unexposed`, C + D)
+    reports of each drug (or combination), stored once rather than as B and
+    D on every row. With `decode`, drugs are IDs rather than indices.
+    Returns None for a table written without one.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    table_path = pathlib.Path(table_path)
+    totals_path = table_path.joinpath(TOTALS_TABLE)
+    if not totals_path.is_dir():
+        return None
+    drug_columns = sorted(path.name[:-len('.npy')]
+                          for path in totals_path.glob('drug_index*.npy'))
+    totals_df = pd.DataFrame({
+        column: np.load(totals_path.joinpath(f'{column}.npy'))
+        for column in [*drug_columns, 'n_exposed', 'n_unexposed']
+    })
+    if decode:
+        drug_id_vector = np.load(table_path.joinpath('drug_id_vector.npy'),
+                                 allow_pickle=True)
+        for index_column, id_column in zip(
+                drug_columns, drug_id_columns(len(drug_columns))):
+            totals_df[index_column] = drug_id_vector[totals_df[index_column]]
+            totals_df = totals_df.rename(columns={index_column: id_column})
+    return totals_df
+
+
+def read_prr_result(path, drug_id_vector, outcome_id_vector):
+    """
+    Read a result file of either format as a DataFrame in the CSV layout,
+    with drug and outcome IDs.
+    """
+    path = pathlib.Path(path)
+    if path.name.endswith(EXTENSIONS['csv']):
+        return pd.read_csv(path)
+    return decode_ids(read_npz_indices(path), drug_id_vector,
+                      outcome_id_vector)
+
+
+def find_prr_results(prr_files_path):
+    """All result files (of any format) in a directory"""
+    return sorted(path for extension in EXTENSIONS.values()
+                  for path in prr_files_path.glob(f'*{extension}'))
+
+
+def write_prr_table(npz_paths, table_path, drug_id_vector, outcome_id_vector,
+                    files_per_block=64, max_workers=None):
+    """
+    Combine `.npz` result files into a columnar table: a directory with one
+    uncompressed `.npy` file per column (memory-mappable), plus the drug and
+    outcome ID vectors needed to decode the index columns. The numbers of
+    exposed and unexposed reports of each drug are stored once, in a side
+    table (see `read_totals`), instead of B and D on every row. Columns are
+    preallocated, and blocks of `files_per_block` files are copied directly
+    into their rows in parallel, so memory use is that of one block per
+    worker. The directory is written atomically (see
+    `checkpoint.atomic_path`), with a manifest of its rows and the sha256 of
+    the rows copied from each block (`manifest.json`, see
+    `verify_prr_table`).
+
+    Returns
+    -------
+    dict
+        The manifest
+    """
+    with checkpoint.atomic_path(table_path) as temp_table_path:
+        return _write_prr_table(npz_paths, temp_table_path, drug_id_vector,
+                                outcome_id_vector, files_per_block,
+                                max_workers)
+
+
+def _table_column_dtypes(drug_columns, derived=True):
+    """Types of the stored columns of a table, without B and D if `derived`"""
+    column_dtypes = {column: np.int32 for column in drug_columns}
+    column_dtypes.update({column: dtype
+                          for column, dtype in COLUMN_DTYPES.items()
+                          if not (derived and column in DERIVED_COLUMNS)})
+    return column_dtypes
+
+
+def _rows_digest(columns):
+    """sha256 of the values of each column (in order) of a block of rows"""
+    digest = hashlib.sha256()
+    for values in columns.values():
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+
+def _fill_table_block(npz_paths, table_path, start):
+    """
+    Copy a block of `.npz` result files into the preallocated columns of a
+    table, from row `start`. Blocks fill disjoint rows. Returns the sha256
+    of the rows copied, computed from the files.
+    """
+    block_df = pd.concat([read_npz_indices(path) for path in npz_paths],
+                         ignore_index=True)
+    stop = start + len(block_df)
+    copied = dict()
+    for column in table_columns(table_path):
+        values = np.load(table_path.joinpath(f'{column}.npy'), mmap_mode='r+')
+        copied[column] = block_df[column].values.astype(values.dtype)
+        values[start:stop] = copied[column]
+        values.flush()
+    return _rows_digest(copied)
+
+
+def _table_rows_digest(table_path, start, stop):
+    """sha256 of rows `start:stop` of a table, as in `_fill_table_block`"""
+    return _rows_digest({
+        column: np.load(table_path.joinpath(f'{column}.npy'),
+                        mmap_mode='r')[start:stop]
+        for column in table_columns(table_path)
+    })
+
+
+def _write_prr_table(npz_paths, table_path, drug_id_vector, outcome_id_vector,
+                     files_per_block, max_workers):
+    table_path.mkdir(parents=True, exist_ok=True)
+    np.save(table_path.joinpath('drug_id_vector.npy'), drug_id_vector)
+    np.save(table_path.joinpath('outcome_id_vector.npy'), outcome_id_vector)
+
+    # First pass over the (small) index arrays to find the size of the table
+    n_rows = list()
+    n_drugs = 1
+    drug_indices = list()
+    totals = list()
+    for path in npz_paths:
+        with np.load(path) as npz:
+            n_rows.append(npz['outcome_index'].shape[0])
+            n_drugs = len(npz['drug_indices'])
+            drug_indices.append(npz['drug_indices'])
+            totals.append(_npz_totals(npz))
+    total_rows = sum(n_rows)
+    _write_totals(table_path, drug_index_columns(n_drugs), drug_indices,
+                  totals)
+
+    for column, dtype in _table_column_dtypes(
+            drug_index_columns(n_drugs)).items():
+        np.lib.format.open_memmap(
+            table_path.joinpath(f'{column}.npy'), mode='w+', dtype=dtype,
+            shape=(total_rows,)).flush()
+
+    row_starts = np.concatenate([[0], np.cumsum(n_rows, dtype=np.int64)])
+    block_starts = list(range(0, len(npz_paths), files_per_block))
+    with concurrent.futures.ProcessPoolExecutor(
+            scheduling.pool_size(max_workers)) as executor:
+        with profiling.timer('fill_table'):
+            digests = list(executor.map(
+                _fill_table_block,
+                [npz_paths[i:i + files_per_block] for i in block_starts],
+                [table_path] * len(block_starts),
+                [int(row_starts[i]) for i in block_starts]))
+
+    manifest = {
+        'rows': int(total_rows),
+        'files': [pathlib.Path(path).name for path in npz_paths],
+        'blocks': [
+            {'start': int(row_starts[i]),
+             'stop': int(row_starts[min(i + files_per_block, len(npz_paths))]),
+             'sha256': digest}
+            for i, digest in zip(block_starts, digests)
+        ],
+    }
+    with open(table_path.joinpath(TABLE_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_table_manifest(table_path):
+    """
+    The manifest saved by `write_prr_table` with a table, or None for a
+    table without one (eg. rewritten by `update_prr_table`)
+    """
+    manifest_path = pathlib.Path(table_path).joinpath(TABLE_MANIFEST)
+    if not manifest_path.is_file():
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def verify_prr_table(table_path, max_workers=None):
+    """
+    Check a table against the manifest `write_prr_table` saved with it: that
+    every column and the side table of totals have the recorded numbers of
+    rows, and that each block of rows has the recorded sha256. Blocks are
+    checked in parallel. Returns False for a table without a manifest.
+    """
+    table_path = pathlib.Path(table_path)
+    manifest = read_table_manifest(table_path)
+    if manifest is None:
+        return False
+
+    for column in table_columns(table_path):
+        values = np.load(table_path.joinpath(f'{column}.npy'), mmap_mode='r')
+        if values.shape != (manifest['rows'],):
+            return False
+    totals_df = read_totals(table_path, decode=False)
+    if totals_df is None or len(totals_df) != len(manifest['files']):
+        return False
+
+    blocks = manifest['blocks']
+    with concurrent.futures.ProcessPoolExecutor(
+            scheduling.pool_size(max_workers)) as executor:
+        digests = executor.map(_table_rows_digest,
+                               [table_path] * len(blocks),
+                               [block['start'] for block in blocks],
+                               [block['stop'] for block in blocks])
+        return all(digest == block['sha256']
+                   for digest, block in zip(digests, blocks))
+
+
+def table_columns(table_path):
+    """
+    Stored columns of a table written by `write_prr_table`, drugs first.
+    Tables written before the side table of totals also store B and D.
+    """
+    table_path = pathlib.Path(table_path)
+    drug_columns = sorted(path.name[:-len('.npy')]
+                          for path in table_path.glob('drug_index*.npy'))
+    return [*drug_columns,
+            *(column for column in COLUMN_DTYPES
+              if table_path.joinpath(f'{column}.npy').is_file())]
+
+
+def _totals_lookup(table_path, drug_columns, n_drug_ids):
+    """
+    Sorted keys (see `combination_keys`) of the drugs in the side table of
+    totals, and the (n x 2) totals in the same order
+    """
+    totals_df = read_totals(table_path, decode=False)
+    keys = combination_keys([totals_df[column].values.astype(np.int64)
+                             for column in drug_columns], n_drug_ids)
+    order = np.argsort(keys, kind='mergesort')
+    return keys[order], totals_df[['n_exposed', 'n_unexposed']].values[order]
+
+
+def _derive_columns(index_df, drug_columns, totals_lookup, n_drug_ids):
+    """Add B and D to rows of a table, from its side table of totals"""
+    sorted_keys, totals = totals_lookup
+    keys = combination_keys([index_df[column].values.astype(np.int64)
+                             for column in drug_columns], n_drug_ids)
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == len(sorted_keys)] = 0
+    if len(keys) and np.any(sorted_keys[positions] != keys):
+        raise ValueError('Rows of drugs without totals')
+    for column, (total_column, k) in DERIVED_COLUMNS.items():
+        index_df[column] = (totals[positions, k]
+                            - index_df[total_column].values).astype(
+            COLUMN_DTYPES[column])
+    return index_df[[*drug_columns, *COLUMN_DTYPES]]
+
+
+def iter_prr_table(table_path, chunksize=1_000_000, decode=True, start=0):
+    """
+    Read a table written by `write_prr_table` in chunks of `chunksize` rows,
+    beginning at row `start`.
+    Columns are memory-mapped, so only the current chunk is read from disk.
+    B and D are derived from A and C and the side table of totals.
+    With `decode`, chunks are in the CSV layout (drug and outcome IDs),
+    otherwise they have the integer index columns.
+
+    Yields
+    ------
+    pandas.DataFrame
+    """
+    table_path = pathlib.Path(table_path)
+    drug_id_vector = np.load(table_path.joinpath('drug_id_vector.npy'),
+                             allow_pickle=True)
+    outcome_id_vector = np.load(table_path.joinpath('outcome_id_vector.npy'),
+                                allow_pickle=True)
+    columns = {
+        column: np.load(table_path.joinpath(f'{column}.npy'), mmap_mode='r')
+        for column in table_columns(table_path)
+    }
+    drug_columns = [column for column in columns
+                    if column.startswith('drug_index')]
+    totals_lookup = None
+    if not all(column in columns for column in DERIVED_COLUMNS):
+        totals_lookup = _totals_lookup(table_path, drug_columns,
+                                       len(drug_id_vector))
+    n_rows = columns['outcome_index'].shape[0]
+    # An empty table still gives one (empty) chunk
+    for chunk_start in range(start, max(n_rows, start + 1), chunksize):
+        index_df = pd.DataFrame({
+            column: np.asarray(values[chunk_start:chunk_start + chunksize])
+            for column, values in columns.items()
+        })
+        if totals_lookup is not None:
+            index_df = _derive_columns(index_df, drug_columns, totals_lookup,
+                                       len(drug_id_vector))
+        if decode:
+            yield decode_ids(index_df, drug_id_vector, outcome_id_vector)
+        else:
+            yield index_df
+
+
+def read_prr_table(table_path, decode=True):
+    """Read an entire table written by `write_prr_table` into memory"""
+    chunks = list(iter_prr_table(table_path, chunksize=np.iinfo(np.int64).max,
+                                 decode=decode))
+    return chunks[0]
+
+
+def prr_table_length(table_path):
+    """Number of rows in a table written by `write_prr_table`"""
+    table_path = pathlib.Path(table_path)
+    return np.load(table_path.joinpath('outcome_index.npy'),
+                   mmap_mode='r').shape[0]
+
+
+def read_prr_table_rows(table_path, start, stop, decode=True):
+    """Read rows `start:stop` of a table written by `write_prr_table`"""
+    chunks = iter_prr_table(table_path, chunksize=stop - start, decode=decode,
+                            start=start)
+    return next(chunks)
+
+
+def combination_keys(drug_index_arrays, n_drug_ids):
+    """One int64 key per row for the drug index columns of a table"""
+    keys = np.zeros(len(drug_index_arrays[0]), dtype=np.int64)
+    for values in drug_index_arrays:
+        keys = keys * n_drug_ids + values
+    return keys
+
+
+def update_prr_table(table_path, npz_paths, chunksize=1_000_000):
+    """
+    Replace the rows of some drugs (or combinations) in a table written by
+    `write_prr_table` with the rows of new `.npz` result files. Rows of
+    every other drug are carried forward unchanged, followed by the new
+    rows. The table is rewritten atomically (see `checkpoint.atomic_path`),
+    one chunk of `chunksize` rows at a time, with the same stored columns
+    (B and D only for a table without a side table of totals).
+
+    Returns
+    -------
+    int
+        Number of rows in the updated table
+    """
+    table_path = pathlib.Path(table_path)
+    drug_id_vector = np.load(table_path.joinpath('drug_id_vector.npy'),
+                             allow_pickle=True)
+    outcome_id_vector = np.load(table_path.joinpath('outcome_id_vector.npy'),
+                                allow_pickle=True)
+    drug_columns = [column for column in table_columns(table_path)
+                    if column.startswith('drug_index')]
+
+    n_new_rows = list()
+    replaced = list()
+    new_totals = list()
+    for path in npz_paths:
+        with np.load(path) as npz:
+            n_new_rows.append(npz['outcome_index'].shape[0])
+            replaced.append(npz['drug_indices'].astype(np.int64))
+            new_totals.append(_npz_totals(npz))
+    new_drug_indices = np.array(replaced).reshape(-1, len(drug_columns))
+    replaced = combination_keys(new_drug_indices.T, len(drug_id_vector))
+    old_totals = read_totals(table_path, decode=False)
+
+    # First pass over the drug columns to find the rows carried forward
+    keep = list()
+    for index_df in iter_prr_table(table_path, chunksize=chunksize,
+                                   decode=False):
+        keys = combination_keys([index_df[column].values.astype(np.int64)
+                                 for column in drug_columns],
+                                len(drug_id_vector))
+        keep.append(~np.isin(keys, replaced))
+    n_kept = sum(int(chunk_keep.sum()) for chunk_keep in keep)
+    total_rows = n_kept + sum(n_new_rows)
+
+    with checkpoint.atomic_path(table_path) as temp_table_path:
+        temp_table_path.mkdir(parents=True, exist_ok=True)
+        np.save(temp_table_path.joinpath('drug_id_vector.npy'), drug_id_vector)
+        np.save(temp_table_path.joinpath('outcome_id_vector.npy'),
+                outcome_id_vector)
+        if old_totals is not None:
+            old_keys = combination_keys(
+                [old_totals[column].values.astype(np.int64)
+                 for column in drug_columns], len(drug_id_vector))
+            kept_totals = old_totals.loc[~np.isin(old_keys, replaced)]
+            _write_totals(
+                temp_table_path, drug_columns,
+                np.concatenate([kept_totals[drug_columns].values,
+                                new_drug_indices]),
+                np.concatenate([
+                    kept_totals[['n_exposed', 'n_unexposed']].values,
+                    np.array(new_totals).reshape(-1, 2)]))
+        column_dtypes = _table_column_dtypes(drug_columns,
+                                             derived=old_totals is not None)
+        columns = {
+            column: np.lib.format.open_memmap(
+                temp_table_path.joinpath(f'{column}.npy'), mode='w+',
+                dtype=dtype, shape=(total_rows,))
+            for column, dtype in column_dtypes.items()
+        }
+
+        start = 0
+        chunks = iter_prr_table(table_path, chunksize=chunksize, decode=False)
+        for index_df, chunk_keep in zip(chunks, keep):
+            rows = int(chunk_keep.sum())
+            for column, values in columns.items():
+                values[start:start + rows] = index_df[column].values[chunk_keep]
+            start += rows
+        for path, rows in zip(npz_paths, n_new_rows):
+            index_df = read_npz_indices(path)
+            for column, values in columns.items():
+                values[start:start + rows] = index_df[column].values
+            start += rows
+        for values in columns.values():
+            values.flush()
+    return total_rows
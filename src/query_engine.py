@@ -0,0 +1,398 @@
+import json
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+import calculate_prr
+import checkpoint
+import prr_io
+
+# Directory of a table (eg. `data/tables/twosides/query_index/`) holding its
+#  query index. Rewriting the table (`prr_io.update_prr_table`) removes it.
+INDEX_DIR = 'query_index'
+
+# Rows of the columns copied at a time while building an index
+_CHUNK_ROWS = 10_000_000
+
+# Rows of a condition read at a time by `PRRTable.top_prr`
+_TOP_BLOCK_ROWS = 4096
+
+
+def _position_dtype(n_rows):
+    if n_rows <= np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+
+def _save_gathered(path, values, order):
+    """Save `values[order]`, gathering a chunk of `order` at a time"""
+    gathered = np.lib.format.open_memmap(path, mode='w+', dtype=values.dtype,
+                                         shape=order.shape)
+    for start in range(0, len(order), _CHUNK_ROWS):
+        gathered[start:start + _CHUNK_ROWS] = values[
+            order[start:start + _CHUNK_ROWS]]
+    gathered.flush()
+    return np.load(path, mmap_mode='r')
+
+
+def _run_starts(arrays):
+    """Positions where any of equal-length sorted `arrays` changes value"""
+    n_rows = len(arrays[0])
+    starts = [np.zeros(min(n_rows, 1), dtype=np.int64)]
+    for start in range(1, n_rows, _CHUNK_ROWS):
+        stop = min(start + _CHUNK_ROWS, n_rows)
+        changed = np.zeros(stop - start, dtype=bool)
+        for values in arrays:
+            changed |= (np.asarray(values[start:stop])
+                        != np.asarray(values[start - 1:stop - 1]))
+        starts.append(np.flatnonzero(changed) + start)
+    return np.concatenate(starts)
+
+
+def build_query_index(table_path):
+    """
+    Build the query index of a table written by `prr_io.write_prr_table`,
+    in `{table_path}/query_index/` (written atomically):
+
+    * The table's columns, sorted by drug (or drug pair) and outcome, so
+      that the rows of a drug are one slice. Where the table has its side
+      table of totals, B and D are not copied, but derived from A and C
+      and the totals of each drug (`group_*.npy`), as in `.npz` results.
+    * `drug_offsets.npy`, where the rows of each drug index start
+      (TWOSIDES: of the first drug of each pair)
+    * For TWOSIDES, the rows sorted by the second drug of each pair
+      (`drug_2_order.npy`) and their `drug_2_offsets.npy`
+    * The rows sorted by outcome and decreasing PRR (NaN last,
+      `condition_order.npy`) and their `condition_offsets.npy`
+
+    Sorting needs about 20 bytes of memory per row. Columns are copied a
+    chunk at a time.
+
+    Returns
+    -------
+    int
+        Number of rows indexed
+    """
+    table_path = pathlib.Path(table_path)
+    with checkpoint.atomic_path(table_path.joinpath(INDEX_DIR)) as index_path:
+        index_path.mkdir(parents=True)
+        return _build_query_index(table_path, index_path)
+
+
+def _build_query_index(table_path, index_path):
+    n_drug_ids = len(np.load(table_path.joinpath('drug_id_vector.npy'),
+                             allow_pickle=True))
+    n_outcome_ids = len(np.load(table_path.joinpath('outcome_id_vector.npy'),
+                                allow_pickle=True))
+    columns = {
+        column: np.load(table_path.joinpath(f'{column}.npy'), mmap_mode='r')
+        for column in prr_io.table_columns(table_path)
+    }
+    drug_columns = [column for column in columns
+                    if column.startswith('drug_index')]
+    totals_df = prr_io.read_totals(table_path, decode=False)
+    n_rows = len(columns['outcome_index'])
+    position_dtype = _position_dtype(n_rows)
+
+    # Sorted by drug (or pair), then outcome
+    keys = np.empty(n_rows, dtype=np.int64)
+    for start in range(0, n_rows, _CHUNK_ROWS):
+        stop = min(start + _CHUNK_ROWS, n_rows)
+        keys[start:stop] = prr_io.combination_keys(
+            [columns[column][start:stop].astype(np.int64)
+             for column in drug_columns], n_drug_ids
+        ) * n_outcome_ids + columns['outcome_index'][start:stop]
+    order = np.argsort(keys, kind='stable').astype(position_dtype)
+    del keys
+    stored = [*drug_columns, 'outcome_index', 'A', 'C', 'PRR', 'PRR_error']
+    if totals_df is None:
+        stored += ['B', 'D']
+    sorted_columns = {
+        column: _save_gathered(index_path.joinpath(f'{column}.npy'),
+                               columns[column], order)
+        for column in stored
+    }
+    del order
+
+    first_drug = sorted_columns[drug_columns[0]]
+    np.save(index_path.joinpath('drug_offsets.npy'),
+            np.searchsorted(first_drug, np.arange(n_drug_ids + 1)))
+    if len(drug_columns) == 2:
+        second_drug = sorted_columns[drug_columns[1]]
+        drug_2_order = np.argsort(second_drug, kind='stable').astype(
+            position_dtype)
+        np.save(index_path.joinpath('drug_2_order.npy'), drug_2_order)
+        np.save(index_path.joinpath('drug_2_offsets.npy'), np.searchsorted(
+            second_drug, np.arange(n_drug_ids + 1), sorter=drug_2_order))
+        del drug_2_order
+
+    # Decreasing PRR within each outcome, with NaN last
+    prr_key = -np.asarray(sorted_columns['PRR'], dtype=np.float64)
+    prr_key[np.isnan(prr_key)] = np.inf
+    condition_order = np.lexsort(
+        (prr_key, sorted_columns['outcome_index'])).astype(position_dtype)
+    del prr_key
+    np.save(index_path.joinpath('condition_order.npy'), condition_order)
+    np.save(index_path.joinpath('condition_offsets.npy'), np.searchsorted(
+        sorted_columns['outcome_index'], np.arange(n_outcome_ids + 1),
+        sorter=condition_order))
+    del condition_order
+
+    # Totals of each drug (or pair), whose rows start at `group_starts`
+    if totals_df is not None:
+        group_starts = _run_starts([sorted_columns[column]
+                                    for column in drug_columns])
+        group_keys = prr_io.combination_keys(
+            [np.asarray(sorted_columns[column][group_starts]).astype(np.int64)
+             for column in drug_columns], n_drug_ids)
+        totals_keys = prr_io.combination_keys(
+            [totals_df[column].values.astype(np.int64)
+             for column in drug_columns], n_drug_ids)
+        totals_order = np.argsort(totals_keys, kind='stable')
+        positions = np.searchsorted(totals_keys, group_keys,
+                                    sorter=totals_order)
+        positions[positions == len(totals_keys)] = 0
+        positions = totals_order[positions]
+        if len(group_keys) and np.any(totals_keys[positions] != group_keys):
+            raise ValueError(f'{table_path} has drugs without totals')
+        np.save(index_path.joinpath('group_starts.npy'), group_starts)
+        for column in ('n_exposed', 'n_unexposed'):
+            np.save(index_path.joinpath(f'group_{column}.npy'),
+                    totals_df[column].values[positions])
+
+    with open(index_path.joinpath('index.json'), 'w') as f:
+        json.dump({'rows': n_rows, 'drug_columns': drug_columns,
+                   'derived': totals_df is not None}, f)
+    return n_rows
+
+
+def has_query_index(table_path):
+    return pathlib.Path(table_path).joinpath(INDEX_DIR, 'index.json').is_file()
+
+
+class PRRTable:
+    """
+    Queries of an OFFSIDES or TWOSIDES table by drug and condition (outcome)
+    ID, answered from the memory-mapped query index (see
+    `build_query_index`). Each query reads only the slices of the index for
+    the given drug or condition. Results are DataFrames in the CSV layout
+    of `prr_io.decode_ids`.
+
+    >>> twosides = PRRTable('/data/tables/twosides/')
+    >>> twosides.drug_rows(1000560, condition_id=35708093)
+    >>> twosides.top_prr(35708093, k=10)
+    """
+
+    def __init__(self, table_path):
+        self.table_path = pathlib.Path(table_path)
+        index_path = self.table_path.joinpath(INDEX_DIR)
+        if not has_query_index(self.table_path):
+            raise FileNotFoundError(f'{self.table_path} has no query index. '
+                                    f'See query_engine.build_query_index.')
+        with open(index_path.joinpath('index.json')) as f:
+            self.metadata = json.load(f)
+        self.drug_columns = self.metadata['drug_columns']
+        self.n_drugs = len(self.drug_columns)
+
+        def load(name):
+            return np.load(index_path.joinpath(f'{name}.npy'), mmap_mode='r')
+
+        stored = [*self.drug_columns, 'outcome_index', 'A', 'C', 'PRR',
+                  'PRR_error']
+        if not self.metadata['derived']:
+            stored += ['B', 'D']
+        self.columns = {column: load(column) for column in stored}
+        self.drug_offsets = load('drug_offsets')
+        if self.n_drugs == 2:
+            self.drug_2_order = load('drug_2_order')
+            self.drug_2_offsets = load('drug_2_offsets')
+        self.condition_order = load('condition_order')
+        self.condition_offsets = load('condition_offsets')
+        if self.metadata['derived']:
+            self.group_starts = load('group_starts')
+            self.group_totals = (load('group_n_exposed'),
+                                 load('group_n_unexposed'))
+
+        self.drug_id_vector = np.load(
+            self.table_path.joinpath('drug_id_vector.npy'), allow_pickle=True)
+        self.outcome_id_vector = np.load(
+            self.table_path.joinpath('outcome_id_vector.npy'),
+            allow_pickle=True)
+        self._drug_indices = self._id_indices(self.drug_id_vector)
+        self._outcome_indices = self._id_indices(self.outcome_id_vector)
+
+    def __len__(self):
+        return self.metadata['rows']
+
+    @staticmethod
+    def _id_indices(id_vector):
+        """
+        IDs as sorted numbers and their indices, so that IDs are matched by
+        value whether stored as str, int or float (eg. `10000031` and
+        `10000031.0`). IDs that are not numbers (eg. "no outcome") are NaN.
+        """
+        ids = pd.to_numeric(np.asarray(id_vector).astype(str),
+                            errors='coerce').astype(np.float64)
+        order = np.argsort(ids, kind='mergesort')
+        return ids[order], order
+
+    def _lookup(self, indices, id_, kind):
+        """Indices of an ID (some drug IDs have several), in order"""
+        sorted_ids, order = indices
+        try:
+            value = float(id_)
+        except (TypeError, ValueError):
+            value = np.nan
+        start = np.searchsorted(sorted_ids, value, side='left')
+        stop = np.searchsorted(sorted_ids, value, side='right')
+        if np.isnan(value) or start == stop:
+            raise KeyError(f'Unknown {kind} ID {id_}')
+        return order[start:stop].tolist()
+
+    def _frame(self, rows):
+        """Rows (positions in the sorted columns) in the CSV layout"""
+        rows = np.sort(np.asarray(rows, dtype=np.int64))
+        index_df = pd.DataFrame({
+            column: np.asarray(values[rows])
+            for column, values in self.columns.items()
+        })
+        if self.metadata['derived']:
+            groups = np.searchsorted(self.group_starts, rows, side='right') - 1
+            for column, (total_column, k) in prr_io.DERIVED_COLUMNS.items():
+                index_df[column] = (
+                    np.asarray(self.group_totals[k][groups])
+                    - index_df[total_column].values
+                ).astype(prr_io.COLUMN_DTYPES[column])
+        return prr_io.decode_ids(index_df, self.drug_id_vector,
+                                 self.outcome_id_vector)
+
+    def _condition_rows(self, outcome_indices):
+        return np.concatenate([np.asarray(self.condition_order[
+            self.condition_offsets[i]:self.condition_offsets[i + 1]])
+            for i in outcome_indices])
+
+    def _drug_row_count(self, drug_indices):
+        count = sum(int(self.drug_offsets[i + 1] - self.drug_offsets[i])
+                    for i in drug_indices)
+        if self.n_drugs == 2:
+            count += sum(int(self.drug_2_offsets[i + 1]
+                             - self.drug_2_offsets[i]) for i in drug_indices)
+        return count
+
+    def _drug_rows(self, drug_indices):
+        """Rows with a drug in any slot, sorted"""
+        rows = [np.arange(self.drug_offsets[i], self.drug_offsets[i + 1])
+                for i in drug_indices]
+        if self.n_drugs == 2:
+            rows += [np.asarray(self.drug_2_order[
+                self.drug_2_offsets[i]:self.drug_2_offsets[i + 1]])
+                for i in drug_indices]
+        # A pair of two indices of the same drug ID is in both slots
+        return np.unique(np.concatenate(rows).astype(np.int64))
+
+    def drug_rows(self, drug_id, condition_id=None):
+        """
+        Rows of a drug (for TWOSIDES, of every pair with the drug in either
+        slot), optionally only those of a condition. Reads the drug's rows
+        or the condition's, whichever are fewer.
+        """
+        drug_indices = self._lookup(self._drug_indices, drug_id, 'drug')
+        if condition_id is None:
+            return self._frame(self._drug_rows(drug_indices))
+
+        outcome_indices = self._lookup(self._outcome_indices, condition_id,
+                                       'condition')
+        n_condition_rows = sum(
+            int(self.condition_offsets[i + 1] - self.condition_offsets[i])
+            for i in outcome_indices)
+        if n_condition_rows < self._drug_row_count(drug_indices):
+            rows = np.sort(self._condition_rows(outcome_indices))
+            has_drug = np.zeros(len(rows), dtype=bool)
+            for column in self.drug_columns:
+                has_drug |= np.isin(self.columns[column][rows], drug_indices)
+            rows = rows[has_drug]
+        else:
+            rows = self._drug_rows(drug_indices)
+            rows = rows[np.isin(self.columns['outcome_index'][rows],
+                                outcome_indices)]
+        return self._frame(rows)
+
+    def signals(self, drug_id, rule=calculate_prr.SignalRule(),
+                condition_id=None):
+        """Rows of a drug with A > 0 that meet `rule` (see `drug_rows`)"""
+        df = self.drug_rows(drug_id, condition_id)
+        keep = (df['A'].values > 0) & calculate_prr.is_signal(
+            df['PRR'].values.astype(np.float64),
+            df['PRR_error'].values.astype(np.float64), rule)
+        return df.loc[keep].reset_index(drop=True)
+
+    def pair_rows(self, drug_id_1, drug_id_2, condition_id=None):
+        """
+        Rows of a TWOSIDES pair, in either order, optionally only those of
+        a condition. Found by binary search within the first drug's slice.
+        """
+        if self.n_drugs != 2:
+            raise ValueError('pair_rows needs a table of drug pairs')
+        indices_1 = self._lookup(self._drug_indices, drug_id_1, 'drug')
+        indices_2 = self._lookup(self._drug_indices, drug_id_2, 'drug')
+        outcome_indices = (None if condition_id is None else self._lookup(
+            self._outcome_indices, condition_id, 'condition'))
+        first_drug, second_drug = self.drug_columns
+        rows = list()
+        for first_indices, second_indices in [(indices_1, indices_2),
+                                              (indices_2, indices_1)]:
+            for i in first_indices:
+                start, stop = self.drug_offsets[i], self.drug_offsets[i + 1]
+                partners = self.columns[second_drug][start:stop]
+                for j in second_indices:
+                    pair_start = start + np.searchsorted(partners, j, 'left')
+                    pair_stop = start + np.searchsorted(partners, j, 'right')
+                    if outcome_indices is None:
+                        rows.append(np.arange(pair_start, pair_stop))
+                        continue
+                    outcomes = self.columns['outcome_index'][pair_start:pair_stop]
+                    for k in outcome_indices:
+                        rows.append(pair_start + np.arange(
+                            np.searchsorted(outcomes, k, 'left'),
+                            np.searchsorted(outcomes, k, 'right')))
+        rows = np.unique(np.concatenate(rows)) if rows else np.zeros(0, int)
+        return self._frame(rows)
+
+    def condition_rows(self, condition_id):
+        """Rows of a condition, by decreasing PRR"""
+        outcome_indices = self._lookup(self._outcome_indices, condition_id,
+                                       'condition')
+        df = self._frame(self._condition_rows(outcome_indices))
+        return df.sort_values('PRR', ascending=False, kind='mergesort',
+                              na_position='last').reset_index(drop=True)
+
+    def top_prr(self, condition_id, k=10, min_a=1, finite=True):
+        """
+        The `k` rows of a condition with the highest PRR, among rows with
+        A >= `min_a` and, with `finite`, a finite PRR (C > 0). Rows are read
+        in decreasing PRR until `k` are found.
+        """
+        outcome_indices = self._lookup(self._outcome_indices, condition_id,
+                                       'condition')
+        found = list()
+        for i in outcome_indices:
+            start = self.condition_offsets[i]
+            stop = self.condition_offsets[i + 1]
+            n_found = 0
+            for block_start in range(start, stop, _TOP_BLOCK_ROWS):
+                rows = np.asarray(self.condition_order[
+                    block_start:min(block_start + _TOP_BLOCK_ROWS, stop)])
+                PRR = np.asarray(self.columns['PRR'][rows])
+                keep = np.asarray(self.columns['A'][rows]) >= min_a
+                if finite:
+                    keep &= np.isfinite(PRR)
+                found.append(rows[keep])
+                n_found += int(keep.sum())
+                if n_found >= k:
+                    break
+        rows = np.concatenate(found) if found else np.zeros(0, int)
+        df = self._frame(rows)
+        return (df.sort_values('PRR', ascending=False, kind='mergesort',
+                               na_position='last')
+                .head(k).reset_index(drop=True))
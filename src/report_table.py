@@ -0,0 +1,250 @@
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+import checkpoint
+
+# Files of `data/meta_unformatted/`: pickled dicts from report ID to a list
+#  of ages, a year, and a sex or list of sexes
+AGES_FILE = 'all_ages.npy'
+YEARS_FILE = 'all_years.npy'
+SEXES_FILE = 'all_sexes.npy'
+DEMOGRAPHICS_FILE = 'faers_demographics.csv.xz'
+
+# Columns of the REPORT table, in the types of its columnar format. Ages
+#  are kept as given (eg. 86.62), missing ages are NaN, and reports without
+#  a year have `MISSING_YEAR`.
+REPORT_COLUMN_DTYPES = {
+    'report_id': np.int64,
+    'report_year': np.int16,
+    'person_age': np.float64,
+    'person_sex': 'S1',
+}
+MISSING_YEAR = -1
+
+SEXES = ('F', 'M', 'U')
+
+# Values of the sex mapping meaning unknown, and pairs meaning one sex
+_UNKNOWN_SEXES = {'NS', 'UNK', '', 'YR', ('NS', ''), ('M', 'F'), ('F', 'M'),
+                  ('', 'NS')}
+_PAIR_SEXES = {('', 'M'): 'M', ('NS', 'M'): 'M', ('', 'F'): 'F'}
+
+# Units of `age_code` other than years, as the number of units in a year
+_AGE_UNITS = {'MON': 12, 'WK': 52, 'DY': 365}
+
+
+def load_mapping(path):
+    """
+    A pickled dict from report ID to value as flat arrays: sorted report
+    IDs and their values (an object array)
+    """
+    mapping = np.load(path, allow_pickle=True).item()
+    report_ids = np.fromiter(mapping.keys(), dtype=np.int64,
+                             count=len(mapping))
+    values = np.empty(len(mapping), dtype=object)
+    values[:] = list(mapping.values())
+    order = np.argsort(report_ids, kind='stable')
+    return report_ids[order], values[order]
+
+
+def align(report_ids, values, report_id_vector, name='mapping'):
+    """
+    Values of a mapping (see `load_mapping`) for each report of
+    `report_id_vector`. Raises a ValueError if a report is not in the
+    mapping.
+    """
+    positions = np.searchsorted(report_ids, report_id_vector)
+    positions[positions == len(report_ids)] = 0
+    missing = report_ids[positions] != report_id_vector
+    if missing.any():
+        raise ValueError(f'{missing.sum()} reports are not in the {name}, '
+                         f'eg. {report_id_vector[missing][:5].tolist()}')
+    return values[positions]
+
+
+def first_ages(age_lists):
+    """First age in each list, or NaN for an empty list"""
+    return np.fromiter((ages[0] if len(ages) else np.nan
+                        for ages in age_lists),
+                       dtype=np.float64, count=len(age_lists))
+
+
+def report_years(years):
+    """Years as `REPORT_COLUMN_DTYPES['report_year']`, or `MISSING_YEAR`"""
+    years = pd.to_numeric(pd.Series(years, dtype=object))
+    return (years.fillna(MISSING_YEAR).values
+            .astype(REPORT_COLUMN_DTYPES['report_year']))
+
+
+def clean_sex(value):
+    """
+    'F', 'M' or 'U' for a value of the sex mapping (a sex, or a list of the
+    sexes given for a report), or the value itself if no rule applies
+    """
+    if isinstance(value, (list, tuple)):
+        value = tuple(value)
+        if len(value) == 0:
+            return 'U'
+        if len(value) == 1 or (len(value) == 2 and value[0] == value[1]):
+            value = value[0]
+    if value in _UNKNOWN_SEXES:
+        return 'U'
+    return _PAIR_SEXES.get(value, value)
+
+
+def clean_sexes(values):
+    """
+    `clean_sex` of every value, applied once per distinct value. Raises a
+    ValueError for values that do not clean to one of `SEXES`.
+    """
+    codes, uniques = pd.factorize(pd.Series(
+        [tuple(value) if isinstance(value, list) else value
+         for value in values], dtype=object))
+    if (codes < 0).any():
+        raise ValueError(f'{(codes < 0).sum()} reports have no sex')
+    cleaned = [clean_sex(value) for value in uniques]
+    unmapped = [value for value, sex in zip(uniques, cleaned)
+                if sex not in SEXES]
+    if unmapped:
+        raise ValueError(f'Sexes without a cleaning rule: {unmapped}')
+    return np.array(cleaned)[codes]
+
+
+def build_report_table(report_id_vector, ages, years, sexes):
+    """
+    The REPORT table (see `nb/3.format_tables/REPORT.ipynb`) of the reports
+    of `report_id_vector`, in its order.
+
+    Parameters
+    ----------
+    report_id_vector : np.ndarray
+    ages, years, sexes : Tuple[np.ndarray, np.ndarray]
+        Mappings from report ID to a list of ages, a year and a sex, as
+        given by `load_mapping`
+
+    Returns
+    -------
+    pandas.DataFrame
+        With the columns and types of `REPORT_COLUMN_DTYPES`, but
+        `person_sex` as str
+    """
+    report_id_vector = np.asarray(report_id_vector, dtype=np.int64)
+    return pd.DataFrame({
+        'report_id': report_id_vector,
+        'report_year': report_years(
+            align(*years, report_id_vector, 'year mapping')),
+        'person_age': first_ages(
+            align(*ages, report_id_vector, 'age mapping')),
+        'person_sex': clean_sexes(
+            align(*sexes, report_id_vector, 'sex mapping')),
+    })
+
+
+def age_disagreements(report_df, demographics_df):
+    """
+    Reports whose age in the REPORT table differs from the FAERS
+    demographics age (`age`, in units of `age_code`) converted to years, as
+    investigated in `REPORT.ipynb`. These are kept in the table, as they are
+    also in the `effect_faers` database.
+
+    Parameters
+    ----------
+    report_df : pandas.DataFrame
+        REPORT table
+    demographics_df : pandas.DataFrame
+        With columns `isr_report_id`, `age` and `age_code`
+
+    Returns
+    -------
+    pandas.DataFrame
+        Columns `report_id`, `age`, `age_code`, `person_age` and the age in
+        years (`age_years`)
+    """
+    merged = report_df.merge(
+        demographics_df.filter(items=['isr_report_id', 'age', 'age_code']),
+        how='left', left_on='report_id', right_on='isr_report_id')
+    if merged['isr_report_id'].isnull().any():
+        raise ValueError('Reports without a row in the demographics table')
+
+    age = pd.to_numeric(merged['age'], errors='coerce').values
+    person_age = merged['person_age'].values
+    with np.errstate(invalid='ignore'):
+        differs = ((person_age != age) & (age != 0)
+                   & ~np.isnan(age) & ~np.isnan(person_age))
+    merged = merged.loc[differs]
+    age = age[differs].astype(np.int64)
+    person_age = merged['person_age'].values.astype(np.int64)
+    units = merged['age_code'].map(_AGE_UNITS).values
+    with np.errstate(invalid='ignore'):
+        age_years = np.trunc(age / units)
+    disagrees = (age != person_age) & ~np.isnan(age_years) & \
+        (age_years != person_age)
+    return (
+        merged
+        .loc[disagrees, ['report_id', 'age', 'age_code', 'person_age']]
+        .assign(age_years=age_years[disagrees].astype(np.int64))
+    )
+
+
+def write_report_table(report_df, table_path):
+    """
+    Write the REPORT table as a directory with one uncompressed `.npy` file
+    per column (memory-mappable), atomically
+    """
+    with checkpoint.atomic_path(table_path) as temp_table_path:
+        temp_table_path.mkdir(parents=True)
+        for column, dtype in REPORT_COLUMN_DTYPES.items():
+            np.save(temp_table_path.joinpath(f'{column}.npy'),
+                    report_df[column].values.astype(dtype))
+
+
+def read_report_table(table_path, mmap_mode=None):
+    """
+    Read a table written by `write_report_table`, with `person_sex` as str
+    """
+    table_path = pathlib.Path(table_path)
+    columns = {
+        column: np.load(table_path.joinpath(f'{column}.npy'),
+                        mmap_mode=mmap_mode)
+        for column in REPORT_COLUMN_DTYPES
+    }
+    columns['person_sex'] = columns['person_sex'].astype(str)
+    return pd.DataFrame(columns)
+
+
+def export_report_csv(report_df, csv_path):
+    """
+    Write the REPORT table as `.csv.xz`, as `REPORT.ipynb` does, with
+    missing years empty
+    """
+    report_df = report_df.assign(report_year=report_df['report_year'].astype(
+        'Int16').mask(report_df['report_year'] == MISSING_YEAR))
+    with checkpoint.atomic_path(csv_path) as temp_path:
+        report_df.to_csv(temp_path, index=False, compression='xz')
+
+
+def format_report_table(unformatted_path, formatted_path, table_path,
+                        csv_path=None):
+    """
+    Build the REPORT table from the mappings in `data/meta_unformatted/`
+    and `report_id_vector.npy`, write it to `table_path` and, with
+    `csv_path`, as `.csv.xz`.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    unformatted_path = pathlib.Path(unformatted_path)
+    report_id_vector = np.load(
+        pathlib.Path(formatted_path).joinpath('report_id_vector.npy'))
+    report_df = build_report_table(
+        report_id_vector,
+        ages=load_mapping(unformatted_path.joinpath(AGES_FILE)),
+        years=load_mapping(unformatted_path.joinpath(YEARS_FILE)),
+        sexes=load_mapping(unformatted_path.joinpath(SEXES_FILE)),
+    )
+    write_report_table(report_df, table_path)
+    if csv_path is not None:
+        export_report_csv(report_df, csv_path)
+    return report_df
@@ -0,0 +1,162 @@
+import itertools
+import math
+import os
+
+import numpy as np
+
+# Cost of a drug (or combination) that does not depend on its exposed
+#  reports, relative to the cost of one exposed report, per report in the
+#  matrix. Loading and binning the scores of every report costs about as
+#  much as matching and summing the outcomes of n_reports / 16 exposed
+#  reports (measured with `calculate_prr.compute_ABCD_one_drug` on
+#  synthetic data, see `synthetic.make_dataset`).
+FIXED_COST_PER_REPORT = 1 / 16
+
+
+def pool_size(max_workers=None):
+    """Number of processes a `ProcessPoolExecutor(max_workers)` starts"""
+    return max_workers or os.cpu_count() or 1
+
+
+def unit_costs(n_exposed, n_reports):
+    """
+    Estimated cost of computing PRR for drugs (or combinations) with
+    `n_exposed` exposed reports each, in units of one exposed report
+    """
+    n_exposed = np.asarray(n_exposed, dtype=np.float64)
+    return n_exposed + n_reports * FIXED_COST_PER_REPORT
+
+
+def exposure_costs(all_exposures, drug_indices=None):
+    """
+    Estimated cost of each drug (see `unit_costs`), from the number of
+    nonzero entries in its column of the exposure matrix
+
+    Parameters
+    ----------
+    all_exposures : scipy.sparse.csc_matrix
+        Matrix of reports (rows) by drugs (columns), eg. attached with
+        `shared_data.attach_sparse_matrix`
+    drug_indices : array-like of int
+        Drugs to estimate, by default every drug
+
+    Returns
+    -------
+    np.ndarray
+    """
+    n_exposed = all_exposures.getnnz(axis=0)
+    if drug_indices is not None:
+        n_exposed = n_exposed[np.asarray(drug_indices, dtype=np.int64)]
+    return unit_costs(n_exposed, all_exposures.shape[0])
+
+
+def combination_costs(combinations, counts, n_reports):
+    """
+    Estimated cost of each drug combination (see `unit_costs`), from the
+    number of co-exposed reports in `counts` (see
+    `coexposure.coexposure_counts`), or the same for every combination when
+    `counts` is None
+    """
+    if counts is None or len(combinations) == 0:
+        return unit_costs(np.zeros(len(combinations)), n_reports)
+    drug_arrays = np.asarray(combinations, dtype=np.int64)
+    if drug_arrays.shape[1] == 1:
+        drug_arrays = np.concatenate([drug_arrays, drug_arrays], axis=1)
+    n_exposed = np.min([
+        np.asarray(counts[drug_arrays[:, a], drug_arrays[:, b]]).ravel()
+        for a, b in itertools.combinations(range(drug_arrays.shape[1]), 2)
+    ], axis=0)
+    return unit_costs(n_exposed, n_reports)
+
+
+def plan_chunks(costs, n_workers, max_size=None, min_size=1,
+                chunks_per_worker=4):
+    """
+    Group units of work into chunks for a process pool, largest first, with
+    chunks that shrink as the work runs out (guided self-scheduling).
+
+    Each chunk takes the most expensive remaining units, up to a cost of
+    `remaining / (chunks_per_worker * n_workers)`. Early chunks are large,
+    which keeps the overhead per unit small. The last chunks are small, so
+    workers finish at about the same time instead of waiting on one
+    expensive chunk. A unit that is more expensive than the target cost is a
+    chunk of its own.
+
+    Parameters
+    ----------
+    costs : array-like of float
+        Estimated cost of each unit (eg. from `exposure_costs`)
+    n_workers : int
+    max_size : int
+        Most units in a chunk (eg. the block size of a kernel)
+    min_size : int
+        Fewest units in a chunk, except the last
+    chunks_per_worker : int
+
+    Returns
+    -------
+    List[np.ndarray]
+        Indices into `costs` of the units in each chunk, in the order in
+        which chunks should be submitted
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    order = np.argsort(-costs, kind='stable')
+    cumulative = np.cumsum(costs[order])
+    max_size = len(order) if max_size is None else max_size
+    chunks = list()
+    start = 0
+    while start < len(order):
+        done = cumulative[start - 1] if start > 0 else 0.0
+        target = (cumulative[-1] - done) / (chunks_per_worker * n_workers)
+        stop = int(np.searchsorted(cumulative, done + target, side='right'))
+        stop = min(max(stop, start + min_size, start + 1), start + max_size,
+                   len(order))
+        chunks.append(order[start:stop])
+        start = stop
+    return chunks
+
+
+def split_archives(archive_pairs, pair_costs, n_workers, chunks_per_worker=2):
+    """
+    Tasks for the TWOSIDES archives, each an archive and the pairs to compute
+    from it, largest first. Archives more expensive than a worker's share of
+    the work, `total / (chunks_per_worker * n_workers)`, are split into
+    tasks for subsets of their pairs, balanced by cost, so that one large
+    archive does not keep a single worker busy after the rest are done.
+    Every task of a split archive reads the whole archive, so archives are
+    only split into parts of at least that share.
+
+    Parameters
+    ----------
+    archive_pairs : Dict[str, List[Tuple[int, int]]]
+        Pairs in each archive (eg. from the file map), by archive name
+    pair_costs : Dict[str, np.ndarray]
+        Estimated cost of each of these pairs (see `combination_costs`)
+    n_workers : int
+    chunks_per_worker : int
+
+    Returns
+    -------
+    List[Tuple[str, List[Tuple[int, int]]]]
+    """
+    archive_costs = {name: float(np.sum(costs))
+                     for name, costs in pair_costs.items()}
+    max_cost = (sum(archive_costs.values())
+                / (chunks_per_worker * n_workers))
+    tasks = list()
+    for name, pairs in archive_pairs.items():
+        costs = np.asarray(pair_costs[name], dtype=np.float64)
+        n_parts = 1
+        if max_cost > 0 and len(pairs) > 1:
+            n_parts = min(max(math.floor(archive_costs[name] / max_cost), 1),
+                          len(pairs))
+        # Most expensive pairs first, each to the cheapest part so far
+        parts = [list() for _ in range(n_parts)]
+        part_costs = np.zeros(n_parts)
+        for i in np.argsort(-costs, kind='stable'):
+            part = int(np.argmin(part_costs))
+            parts[part].append(pairs[i])
+            part_costs[part] += costs[i]
+        tasks.extend((part_costs[k], name, part) for k, part in enumerate(parts))
+    tasks.sort(key=lambda task: -task[0])
+    return [(name, part) for _, name, part in tasks]
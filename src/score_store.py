@@ -0,0 +1,258 @@
+import collections
+import json
+import pathlib
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import calculate_prr
+import checkpoint
+
+# A store is a directory of shards. Each shard is a data file of
+#  concatenated members (`{shard}.bin`) and an index (`{shard}.index.csv`)
+#  giving each member's key, byte offset and length, so any member can be
+#  read with one seek, without touching the rest of the store.
+#
+# Members are compressed independently ("zlib"), or stored uncompressed
+#  ("raw") so that they can be memory-mapped directly.
+#
+# A store can instead be a single dense (n_keys x n_reports) matrix
+#  (`scores.npy`, memory-mapped) with its keys (`keys.npy`), which suits
+#  OFFSIDES, where every drug has scores for the same reports.
+CODECS = ('zlib', 'raw')
+
+# Scores may be kept as "float64" (as computed), "float16", or "bins", the
+#  uint8 bin codes of the propensity score bins used for matching. Bin codes
+#  are all that `calculate_prr.compute_ABCD_one_drug` needs, and are 8x
+#  smaller than the scores. float16 scores keep the scores themselves, but
+#  scores within about 1e-3 of a bin edge may fall in the neighbouring bin.
+QUANTIZATIONS = ('float64', 'float16', 'bins')
+
+# Written when a store is created, to tell stores apart from directories of
+#  individual score files. Holds the layout, quantization and bins.
+MARKER = 'score_store.json'
+
+ScoreStore = collections.namedtuple('ScoreStore', ['path', 'index', 'meta',
+                                                   'matrix'])
+
+# Stores opened in this process, and their fingerprints, by path
+_OPEN_STORES = dict()
+_FINGERPRINTS = dict()
+
+
+def is_store(path):
+    return pathlib.Path(path).joinpath(MARKER).is_file()
+
+
+def _write_meta(store_path, layout, quantization, bins):
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'Unknown quantization {quantization}. '
+                         f'Options are {QUANTIZATIONS}')
+    meta = {'layout': layout, 'quantization': quantization,
+            'bins': None if bins is None else [float(b) for b in bins]}
+    with open(store_path.joinpath(MARKER), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def create_store(store_path, quantization='float64',
+                 bins=calculate_prr.DEFAULT_BINS):
+    """
+    Create an (empty) sharded store. Arrays written to its shards should be
+    quantized with `quantize_scores(scores, quantization, bins)`.
+    """
+    store_path = pathlib.Path(store_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+    _write_meta(store_path, 'shards', quantization,
+                bins if quantization == 'bins' else None)
+    return store_path
+
+
+def quantize_scores(scores, quantization, bins=calculate_prr.DEFAULT_BINS):
+    """Convert propensity scores to one of `QUANTIZATIONS`"""
+    if quantization == 'bins':
+        if len(bins) >= np.iinfo(np.uint8).max:
+            raise ValueError('Too many bins for uint8 bin codes')
+        return calculate_prr.bin_scores(scores, bins=bins)
+    return np.asarray(scores, dtype=quantization)
+
+
+def write_shard(store_path, shard_name, items, codec='zlib', level=1):
+    """
+    Write score arrays to one shard of a store. Shards can be written
+    concurrently (eg. one per source archive) as long as names differ.
+
+    Parameters
+    ----------
+    store_path : pathlib.Path
+        Store directory, created by `create_store`
+    shard_name : str
+    items : Iterable[Tuple[str, numpy.ndarray]]
+        Pairs of key (eg. `"1234"` for a drug, `"12_34"` for a pair) and
+        one-dimensional score array, which is quantized as set for the store
+    codec : str
+        `"zlib"` or `"raw"`
+    level : int
+        zlib compression level
+
+    Returns
+    -------
+    int
+        Number of arrays written
+    """
+    if codec not in CODECS:
+        raise ValueError(f'Unknown codec {codec}. Options are {CODECS}')
+    store_path = pathlib.Path(store_path)
+    with open(store_path.joinpath(MARKER)) as f:
+        meta = json.load(f)
+    bins = None if meta['bins'] is None else np.array(meta['bins'])
+
+    rows = list()
+    offset = 0
+    with open(store_path.joinpath(f'{shard_name}.bin'), 'wb') as f:
+        for key, array in items:
+            array = quantize_scores(array, meta['quantization'], bins)
+            array = np.ascontiguousarray(array)
+            data = array.tobytes()
+            if codec == 'zlib':
+                data = zlib.compress(data, level)
+            f.write(data)
+            rows.append([key, shard_name, offset, len(data), codec,
+                         array.dtype.str, array.shape[0]])
+            offset += len(data)
+
+    # The index is written last, so a shard without an index is incomplete
+    (
+        pd.DataFrame(rows, columns=['key', 'shard', 'offset', 'length',
+                                    'codec', 'dtype', 'n'])
+        .to_csv(store_path.joinpath(f'{shard_name}.index.csv'), index=False)
+    )
+    return len(rows)
+
+
+def open_store(store_path):
+    """
+    Read the index of every shard in a store. Stores are cached per process,
+    so this is cheap to call repeatedly (eg. once per task in a worker).
+    """
+    store_path = pathlib.Path(store_path)
+    if store_path in _OPEN_STORES:
+        return _OPEN_STORES[store_path]
+    if not is_store(store_path):
+        raise FileNotFoundError(f'{store_path} is not a score store')
+
+    with open(store_path.joinpath(MARKER)) as f:
+        meta = json.load(f)
+
+    if meta.get('layout') == 'matrix':
+        keys = np.load(store_path.joinpath('keys.npy')).astype(str)
+        index = pd.DataFrame({'row': np.arange(len(keys))}, index=keys)
+        matrix = np.load(store_path.joinpath('scores.npy'), mmap_mode='r')
+        store = ScoreStore(store_path, index, meta, matrix)
+        _OPEN_STORES[store_path] = store
+        return store
+
+    index_paths = sorted(store_path.glob('*.index.csv'))
+    if len(index_paths) == 0:
+        index = pd.DataFrame(columns=['shard', 'offset', 'length', 'codec',
+                                      'dtype', 'n'])
+    else:
+        index = pd.concat(
+            [pd.read_csv(path, dtype={'key': str}) for path in index_paths],
+            ignore_index=True, sort=False
+        ).set_index('key')
+    store = ScoreStore(store_path, index, meta, None)
+    _OPEN_STORES[store_path] = store
+    return store
+
+
+def read_scores(store, key):
+    """
+    Read one array from a store. Only the member's own bytes are read.
+    Uncompressed members are memory-mapped. Arrays are read-only, and are
+    `uint8` bin codes for stores quantized to `"bins"` (see `store_bins`).
+    """
+    if store.matrix is not None:
+        return store.matrix[store.index.at[key, 'row']]
+    shard, offset, length, codec, dtype, n = store.index.loc[key]
+    data_path = store.path.joinpath(f'{shard}.bin')
+    if codec == 'raw':
+        return np.memmap(data_path, dtype=np.dtype(dtype), mode='r',
+                         offset=int(offset), shape=(int(n),))
+    with open(data_path, 'rb') as f:
+        f.seek(int(offset))
+        data = zlib.decompress(f.read(int(length)))
+    return np.frombuffer(data, dtype=np.dtype(dtype))
+
+
+def store_keys(store):
+    return store.index.index.tolist()
+
+
+def store_fingerprint(store):
+    """
+    Fingerprint of every file in a store (see `checkpoint.file_fingerprint`),
+    computed once per process like `open_store`
+    """
+    if store.path not in _FINGERPRINTS:
+        _FINGERPRINTS[store.path] = checkpoint.file_fingerprint(
+            *sorted(store.path.iterdir()))
+    return _FINGERPRINTS[store.path]
+
+
+def store_bins(store):
+    """Bins of a store holding bin codes, otherwise `None`"""
+    if store.meta.get('quantization') != 'bins':
+        return None
+    return np.array(store.meta['bins'])
+
+
+def check_bins(store, bins):
+    """Raise a ValueError if a store holds bin codes for other `bins`"""
+    stored_bins = store_bins(store)
+    if stored_bins is None:
+        return
+    if len(stored_bins) != len(bins) or not np.allclose(stored_bins, bins):
+        raise ValueError(f'{store.path} holds bin codes for bins {stored_bins},'
+                         f' not {bins}')
+
+
+def write_score_matrix(store_path, keys, arrays, quantization='bins',
+                       bins=calculate_prr.DEFAULT_BINS):
+    """
+    Write scores as a dense, memory-mappable (n_keys x n_reports) matrix
+    store. Rows are written one at a time, so only one array is in memory.
+
+    Parameters
+    ----------
+    store_path : pathlib.Path
+    keys : List[str]
+        Key of each row (eg. drug index)
+    arrays : Iterable[numpy.ndarray]
+        Scores for each key, in the order of `keys`. All the same length.
+    quantization : str
+        One of `QUANTIZATIONS`
+    bins : numpy.ndarray
+        Bins for `"bins"` quantization
+    """
+    store_path = pathlib.Path(store_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+    matrix = None
+    for row, array in enumerate(arrays):
+        array = quantize_scores(array, quantization, bins)
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(
+                store_path.joinpath('scores.npy'), mode='w+',
+                dtype=array.dtype, shape=(len(keys), array.shape[0]))
+        matrix[row] = array
+    if matrix is None:
+        np.save(store_path.joinpath('scores.npy'), np.zeros((0, 0)))
+    else:
+        matrix.flush()
+    np.save(store_path.joinpath('keys.npy'), np.array(keys, dtype=str))
+
+    # The marker is written last, so an incomplete store is not recognised
+    _write_meta(store_path, 'matrix', quantization,
+                bins if quantization == 'bins' else None)
+    return len(keys)
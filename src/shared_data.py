@@ -0,0 +1,97 @@
+import collections
+import pathlib
+
+import numpy as np
+import scipy.sparse
+
+# Data attached in this (worker) process, by name. Filled by `init_worker`.
+_WORKER_DATA = dict()
+
+# Placeholder passed to workers in place of the data it names
+SharedReference = collections.namedtuple('SharedReference', ['name'])
+
+_SPARSE_CLASSES = {
+    'csc': scipy.sparse.csc_matrix,
+    'csr': scipy.sparse.csr_matrix,
+}
+
+
+def publish_sparse_matrix(matrix, directory, name):
+    """
+    Write the `data`, `indices` and `indptr` buffers of a sparse matrix as
+    uncompressed `.npy` files so that worker processes can memory-map them,
+    sharing one copy through the page cache instead of each holding its own.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csc_matrix or scipy.sparse.csr_matrix
+    directory : pathlib.Path
+        Where to write the buffers. Should have room for the uncompressed
+        matrix.
+    name : str
+        Name under which workers will find the matrix
+
+    Returns
+    -------
+    dict
+        Small, picklable description of the published matrix, to be given to
+        `init_worker` (or `attach_sparse_matrix`).
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for attribute in ('data', 'indices', 'indptr'):
+        np.save(directory.joinpath(f'{name}.{attribute}.npy'),
+                getattr(matrix, attribute))
+    return {'directory': str(directory), 'name': name,
+            'format': matrix.format, 'shape': matrix.shape}
+
+
+def attach_sparse_matrix(spec):
+    """
+    Memory-map a matrix written by `publish_sparse_matrix`. No buffers are
+    copied, and the returned matrix is read-only.
+    """
+    directory = pathlib.Path(spec['directory'])
+    data, indices, indptr = [
+        np.load(directory.joinpath(f"{spec['name']}.{attribute}.npy"),
+                mmap_mode='r')
+        for attribute in ('data', 'indices', 'indptr')
+    ]
+    matrix_class = _SPARSE_CLASSES[spec['format']]
+    return matrix_class((data, indices, indptr), shape=spec['shape'],
+                        copy=False)
+
+
+def init_worker(matrix_specs, objects=None):
+    """
+    Initializer for `concurrent.futures.ProcessPoolExecutor`. Attaches every
+    published matrix once per worker, and stores any other `objects` (eg. a
+    file map DataFrame) so they are sent once per worker rather than pickled
+    with every task.
+
+    Parameters
+    ----------
+    matrix_specs : Dict[str, dict]
+        Map of name to the output of `publish_sparse_matrix`
+    objects : Dict[str, object]
+        Map of name to any other picklable object
+    """
+    for name, spec in matrix_specs.items():
+        _WORKER_DATA[name] = attach_sparse_matrix(spec)
+    if objects is not None:
+        _WORKER_DATA.update(objects)
+
+
+def resolve(value):
+    """
+    Return the data named by a `SharedReference`, or `value` unchanged if it
+    is not a reference. This lets worker functions accept either the data
+    itself or a reference to data attached by `init_worker`.
+    """
+    if isinstance(value, SharedReference):
+        try:
+            return _WORKER_DATA[value.name]
+        except KeyError:
+            raise KeyError(f'{value.name} was not attached in this process. '
+                           'Was the pool created with init_worker?')
+    return value
@@ -0,0 +1,223 @@
+import collections
+import io
+import pathlib
+import tarfile
+
+import numpy as np
+import scipy.sparse
+
+# A synthetic FAERS-like dataset: matrices of reports by drugs and outcomes,
+#  and the ID vectors for their columns and rows, in the layout of
+#  `data/meta` (see AWS.md)
+SyntheticData = collections.namedtuple('SyntheticData', [
+    'exposures', 'outcomes', 'drug_id_vector', 'outcome_id_vector',
+    'report_id_vector'
+])
+
+# Number of reports, drugs and outcomes in FAERS (4,396 exposure columns,
+#  see README)
+FAERS_SHAPE = (4_694_086, 4_396, 17_000)
+
+
+def zipf_frequencies(n_items, largest, smallest=1, exponent=1.0):
+    """
+    Skewed frequencies, as in FAERS, where a few drugs (or outcomes) appear in
+    many reports and most appear in few: the item of rank r has frequency
+    `largest * r ** -exponent`, and at least `smallest`.
+    """
+    ranks = np.arange(1, n_items + 1)
+    return np.maximum(largest * ranks ** -exponent, smallest).astype(np.int64)
+
+
+def make_exposure_matrix(n_reports, n_drugs, rng, max_fraction=0.05,
+                         min_exposed=5, exponent=1.0):
+    """
+    (reports x drugs) exposure matrix. The most common drug is in
+    `max_fraction` of reports, with Zipf-distributed frequencies (see
+    `zipf_frequencies`), in shuffled column order.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+    """
+    frequencies = zipf_frequencies(n_drugs, max(int(n_reports * max_fraction), 1),
+                                   min(min_exposed, n_reports), exponent)
+    rng.shuffle(frequencies)
+    columns = [np.unique(rng.randint(0, n_reports, frequency))
+               for frequency in frequencies]
+    indptr = np.concatenate([[0], np.cumsum([len(rows) for rows in columns])])
+    indices = np.concatenate(columns) if columns else np.zeros(0, np.int64)
+    return scipy.sparse.csc_matrix(
+        (np.ones(len(indices)), indices, indptr), shape=(n_reports, n_drugs)
+    )
+
+
+def make_outcome_matrix(n_reports, n_outcomes, rng, outcomes_per_report=3,
+                        exponent=1.0):
+    """
+    (reports x outcomes) outcome matrix, with about `outcomes_per_report`
+    outcomes per report and Zipf-distributed outcome frequencies. Column 0
+    stands for "no outcome", as in the outcome matrix of the preprocessing
+    notebooks, whose first outcome ID is missing.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+    """
+    weights = 1.0 / np.arange(1, n_outcomes) ** exponent
+    nnz = n_reports * outcomes_per_report
+    outcomes = 1 + rng.choice(n_outcomes - 1, nnz, p=weights / weights.sum())
+    outcome_matrix = scipy.sparse.csc_matrix(
+        (np.ones(nnz), (rng.randint(0, n_reports, nnz), outcomes)),
+        shape=(n_reports, n_outcomes)
+    )
+    outcome_matrix.sum_duplicates()
+    outcome_matrix.data[:] = 1
+    return outcome_matrix
+
+
+def make_dataset(n_reports, n_drugs, n_outcomes, seed=0, **kwargs):
+    """
+    Deterministic synthetic dataset (the same `seed` gives the same data).
+    Keyword arguments are passed to `make_exposure_matrix`.
+
+    Returns
+    -------
+    SyntheticData
+    """
+    rng = np.random.RandomState(seed)
+    exposures = make_exposure_matrix(n_reports, n_drugs, rng, **kwargs)
+    outcomes = make_outcome_matrix(n_reports, n_outcomes, rng)
+    drug_id_vector = np.sort(rng.choice(10 * n_drugs, n_drugs, replace=False))
+    outcome_id_vector = np.concatenate([
+        [np.nan],
+        np.sort(rng.choice(10 * n_outcomes, n_outcomes - 1, replace=False)) + 1e7
+    ])
+    report_id_vector = np.arange(n_reports) + 1_000_000
+    return SyntheticData(exposures, outcomes, drug_id_vector, outcome_id_vector,
+                         report_id_vector)
+
+
+def make_propensity_scores(exposed_rows, n_reports, rng):
+    """
+    Scores for one drug (or combination): higher for exposed reports, so that
+    matching has the overlap and imbalance of real scores
+    """
+    scores = rng.beta(2, 5, n_reports)
+    scores[exposed_rows] = rng.beta(5, 2, len(exposed_rows))
+    return scores
+
+
+def write_meta(data, meta_path):
+    """Save a dataset's matrices and vectors as in `data/meta`"""
+    meta_path = pathlib.Path(meta_path)
+    meta_path.mkdir(parents=True, exist_ok=True)
+    scipy.sparse.save_npz(meta_path.joinpath('drug_exposure_matrix.npz'),
+                          data.exposures)
+    scipy.sparse.save_npz(meta_path.joinpath('outcome_matrix.npz'),
+                          data.outcomes)
+    np.save(meta_path.joinpath('drug_id_vector.npy'), data.drug_id_vector)
+    np.save(meta_path.joinpath('outcome_id_vector.npy'), data.outcome_id_vector)
+    np.save(meta_path.joinpath('report_id_vector.npy'), data.report_id_vector)
+
+
+def write_scores(data, scores_path, drugs=None, seed=0):
+    """Save averaged propensity scores as `{drug}.npz`, as in `data/scores/1`"""
+    scores_path = pathlib.Path(scores_path)
+    scores_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    drugs = range(data.exposures.shape[1]) if drugs is None else drugs
+    for drug in drugs:
+        exposed_rows = data.exposures[:, drug].nonzero()[0]
+        scores = make_propensity_scores(exposed_rows, data.exposures.shape[0],
+                                        rng)
+        np.savez_compressed(scores_path.joinpath(f'{drug}.npz'), scores=scores)
+
+
+def _add_array(tar, name, array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=True)
+    member = tarfile.TarInfo(name)
+    member.size = buffer.tell()
+    buffer.seek(0)
+    tar.addfile(member, buffer)
+
+
+def write_offsides_archives(data, archives_path, drugs=None, n_bootstraps=20,
+                            drugs_per_archive=20, seed=0):
+    """
+    Write OFFSIDES-style archives, `scores_{k}.tgz`, each with the bootstrap
+    score files (`scores_lrc_{bootstrap}__{drug}.npy`), logs with their AUC
+    (`log_lrc_{bootstrap}__{drug}.npy`) and an interaction file
+    (`interactions__{drug}.npy`) of `drugs_per_archive` drugs. About one
+    bootstrap iteration in five has AUC <= 0.5, and some drugs have none
+    above.
+
+    Returns
+    -------
+    List[pathlib.Path]
+    """
+    archives_path = pathlib.Path(archives_path)
+    archives_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    n_reports = data.exposures.shape[0]
+    drugs = list(range(data.exposures.shape[1]) if drugs is None else drugs)
+    archive_paths = list()
+    for k, start in enumerate(range(0, len(drugs), drugs_per_archive), start=1):
+        archive_path = archives_path.joinpath(f'scores_{k}.tgz')
+        with tarfile.open(archive_path, mode='w:gz') as tar:
+            for drug in drugs[start:start + drugs_per_archive]:
+                exposed_rows = data.exposures[:, drug].nonzero()[0]
+                scores = make_propensity_scores(exposed_rows, n_reports, rng)
+                drug_auc = rng.uniform(0.3, 0.9)
+                for bootstrap in range(n_bootstraps):
+                    noise = rng.normal(0, 0.02, n_reports)
+                    _add_array(tar, f'scores_lrc_{bootstrap}__{drug}.npy',
+                               np.clip(scores + noise, 0, 1))
+                    auc = np.clip(drug_auc + rng.normal(0, 0.1), 0, 1)
+                    _add_array(tar, f'log_lrc_{bootstrap}__{drug}.npy',
+                               np.array({'auc': auc}))
+                _add_array(tar, f'interactions__{drug}.npy',
+                           rng.rand(data.exposures.shape[1]))
+        archive_paths.append(archive_path)
+    return archive_paths
+
+
+def common_pairs(data, n_pairs):
+    """The `n_pairs` drug pairs co-exposed in the most reports"""
+    binary = data.exposures.astype(bool).astype(np.int32)
+    counts = scipy.sparse.triu(binary.T.dot(binary), k=1).tocoo()
+    order = np.argsort(-counts.data, kind='stable')[:n_pairs]
+    return [(int(a), int(b)) for a, b in zip(counts.row[order], counts.col[order])]
+
+
+def write_twosides_archives(data, archives_path, pairs, pairs_per_archive=50,
+                            seed=0):
+    """
+    Write TWOSIDES-style archives, `scores_{k}.tgz`, with the score file
+    (`scores_lrc__{i}_{j}.npy`) and log (`log_lrc__{i}_{j}.npy`) of
+    `pairs_per_archive` drug pairs each
+
+    Returns
+    -------
+    List[pathlib.Path]
+    """
+    archives_path = pathlib.Path(archives_path)
+    archives_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    n_reports = data.exposures.shape[0]
+    archive_paths = list()
+    for k, start in enumerate(range(0, len(pairs), pairs_per_archive), start=1):
+        archive_path = archives_path.joinpath(f'scores_{k}.tgz')
+        with tarfile.open(archive_path, mode='w:gz') as tar:
+            for drug_1, drug_2 in pairs[start:start + pairs_per_archive]:
+                exposed_rows = np.intersect1d(
+                    data.exposures[:, drug_1].nonzero()[0],
+                    data.exposures[:, drug_2].nonzero()[0]
+                )
+                scores = make_propensity_scores(exposed_rows, n_reports, rng)
+                _add_array(tar, f'scores_lrc__{drug_1}_{drug_2}.npy', scores)
+                _add_array(tar, f'log_lrc__{drug_1}_{drug_2}.npy',
+                           np.array({'auc': rng.uniform(0.5, 0.9)}))
+        archive_paths.append(archive_path)
+    return archive_paths
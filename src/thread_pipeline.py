@@ -0,0 +1,127 @@
+import queue
+import threading
+
+# Placed on a queue once per thread of the next stage when a stage is done
+_DONE = object()
+
+# Seconds between checks for a failure elsewhere in the pipeline while a
+#  thread waits on a queue
+_POLL_SECONDS = 0.1
+
+
+class _Pipeline:
+    def __init__(self, n_stages, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(n_stages)]
+        self.failed = threading.Event()
+        self.errors = list()
+        self.lock = threading.Lock()
+
+    def put(self, stage_queue, item):
+        """Put an item on a queue, unless the pipeline has failed"""
+        while not self.failed.is_set():
+            try:
+                stage_queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, stage_queue):
+        """Next item of a queue, or `_DONE` if the pipeline has failed"""
+        while not self.failed.is_set():
+            try:
+                return stage_queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def fail(self, error):
+        with self.lock:
+            self.errors.append(error)
+        self.failed.set()
+
+
+def run_thread_pipeline(source, stages, queue_size=2):
+    """
+    Pass the items of `source` through a sequence of stages, each run by its
+    own threads and connected to the next by a queue holding at most
+    `queue_size` items. Stages run concurrently, so reading, computing and
+    writing overlap (the GIL is released by zlib, lzma and most of numpy),
+    and at most about `queue_size` items wait between two stages, which
+    bounds memory use however many items there are.
+
+    Parameters
+    ----------
+    source : Iterable
+        Consumed by one thread (eg. a generator reading an archive)
+    stages : List[Tuple[Callable, int]]
+        Function applied to each item, and the number of threads running
+        it. The results of a stage are the items of the next, and items for
+        which a function returns None are dropped.
+    queue_size : int
+
+    Returns
+    -------
+    list
+        The results of the last stage, in the order in which they finished
+
+    Raises
+    ------
+    Exception
+        The first error raised in any thread. The other threads stop, and
+        remaining items are discarded.
+    """
+    pipeline = _Pipeline(len(stages), queue_size)
+    results = list()
+    n_running = [n_threads for _, n_threads in stages]
+
+    def read_source():
+        try:
+            for item in source:
+                if not pipeline.put(pipeline.queues[0], item):
+                    return
+        except Exception as error:
+            pipeline.fail(error)
+            return
+        for _ in range(stages[0][1]):
+            pipeline.put(pipeline.queues[0], _DONE)
+
+    def run_stage(k):
+        function, _ = stages[k]
+        is_last = k == len(stages) - 1
+        try:
+            while True:
+                item = pipeline.get(pipeline.queues[k])
+                if item is _DONE:
+                    break
+                result = function(item)
+                if result is None:
+                    continue
+                if is_last:
+                    with pipeline.lock:
+                        results.append(result)
+                elif not pipeline.put(pipeline.queues[k + 1], result):
+                    return
+        except Exception as error:
+            pipeline.fail(error)
+            return
+        # The last thread of a stage to finish ends the next stage
+        with pipeline.lock:
+            n_running[k] -= 1
+            is_last_thread = n_running[k] == 0
+        if is_last_thread and not is_last:
+            for _ in range(stages[k + 1][1]):
+                pipeline.put(pipeline.queues[k + 1], _DONE)
+
+    threads = [threading.Thread(target=read_source, daemon=True)]
+    for k, (_, n_threads) in enumerate(stages):
+        threads.extend(threading.Thread(target=run_stage, args=(k,),
+                                        daemon=True)
+                       for _ in range(n_threads))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if pipeline.errors:
+        raise pipeline.errors[0]
+    return results
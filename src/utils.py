@@ -1,7 +1,15 @@
+import io
 import re
 import tarfile
 
 import numpy as np
+import scipy.sparse
+
+import calculate_prr
+import checkpoint
+import coexposure
+import profiling
+import score_store
 
 
 def extract_indices(filename):
@@ -14,6 +22,63 @@ def extract_indices(filename):
         return False, False
 
 
+def parse_member_offsides(subfile):
+    """
+    Find the drug, bootstrap iteration and file type (`"scores"`, `"log"` or
+    `"interaction"`) of a member of an OFFSIDES archive. Interaction files
+    have no bootstrap iteration, and their drug is returned as a string.
+    """
+    if 'interaction' in subfile:
+        drug = re.match(r'(?:interactions__)([0-9]+)(?:\.npy)', subfile)
+        if not drug:
+            raise ValueError(f'{subfile} not matched')
+        return drug.group(1), None, 'interaction'
+    drug, bootstrap = extract_indices(subfile)
+    file_type = re.match('^[a-z]+(?=_.+)', subfile).group()
+    return drug, bootstrap, file_type
+
+
+def iter_archive_arrays(archive_path, member_filter=None):
+    """
+    Stream through a `.tar.gz` archive once, loading `.npy` members directly
+    into memory (nothing is extracted to disk). Because the archive is read
+    sequentially, it is decompressed exactly once.
+
+    Parameters
+    ----------
+    archive_path : pathlib.Path
+    member_filter : Callable[[str], bool]
+        Only members whose names pass this filter are loaded. Others are
+        still yielded, with `None` in place of the array, so that callers can
+        record every member.
+
+    Yields
+    ------
+    Tuple[str, numpy.ndarray]
+        Member name and loaded array (or `None`)
+    """
+    with tarfile.open(archive_path, mode='r|gz') as tar:
+        yield from iter_tar_arrays(tar, member_filter)
+
+
+def iter_tar_arrays(tar, member_filter=None):
+    """
+    `iter_archive_arrays` of an archive already opened (in stream mode, eg.
+    `tarfile.open(archive_path, mode='r|gz')`), which is not closed
+    """
+    for member in tar:
+        if not member.isfile():
+            continue
+        if member_filter is not None and not member_filter(member.name):
+            yield member.name, None
+            continue
+        with profiling.timer('archive_extract'):
+            buffer = io.BytesIO(tar.extractfile(member).read())
+            array = np.load(buffer, allow_pickle=True, encoding='latin1')
+        profiling.count('bytes_extracted', member.size)
+        yield member.name, array
+
+
 def extract_indices_twosides(filename, original_name=True):
     """Extract indices of two drugs from a filename"""
     # The original names of files were, for example, scores_lrc__1001_1888.npy
@@ -55,7 +120,8 @@ def extract_drug_files(tar_path_to_members, extract_dir):
     return file_name_to_extracted_path
 
 
-def load_scores_offsides(drug_index, n_rows, scores_path):
+def load_scores_offsides(drug_index, n_rows, scores_path,
+                         bins=calculate_prr.DEFAULT_BINS):
     """
     Parameters
     ----------
@@ -63,41 +129,82 @@ def load_scores_offsides(drug_index, n_rows, scores_path):
     n_rows : int
     scores_path : pathlib.Path
         Path to the directory where propensity scores for each drug are stored
-        as <drug index>.npz files.
+        as <drug index>.npz files, or to a score store (see `score_store`).
+    bins : numpy.ndarray
+        Propensity score bins that will be used for matching. Checked against
+        stores that hold bin codes rather than scores.
 
     Returns
     -------
     numpy.ndarray
+        Scores, or `uint8` bin codes from a store quantized to bins, either
+        of which can be given to `calculate_prr.compute_ABCD_one_drug`
     """
-    score_path = scores_path.joinpath(f'{drug_index}.npz')
-    scores_item = np.load(score_path)
+    with profiling.timer('score_load'):
+        if score_store.is_store(scores_path):
+            store = score_store.open_store(scores_path)
+            score_store.check_bins(store, bins)
+            scores = score_store.read_scores(store, str(drug_index))
+        else:
+            score_path = scores_path.joinpath(f'{drug_index}.npz')
+            scores_item = np.load(score_path)
+            scores = scores_item['scores']
+    profiling.count('score_bytes_read', scores.nbytes)
 
     # Slice to the relevant number of reports (originally 4_838_588, not 4_694_086)
-    scores = scores_item['scores']
     scores = scores[:n_rows]
     return scores
 
 
-def load_scores_nsides(drug_indices, n_rows, scores_path):
+def load_scores_nsides(drug_indices, n_rows, scores_path,
+                       bins=calculate_prr.DEFAULT_BINS):
     indices_string = '_'.join(map(str, drug_indices))
-    score_path = scores_path.joinpath(indices_string + '.npy')
-    scores = np.load(score_path)
+    with profiling.timer('score_load'):
+        if score_store.is_store(scores_path):
+            store = score_store.open_store(scores_path)
+            score_store.check_bins(store, bins)
+            scores = score_store.read_scores(store, indices_string)
+        else:
+            score_path = scores_path.joinpath(indices_string + '.npy')
+            scores = np.load(score_path)
+    profiling.count('score_bytes_read', scores.nbytes)
 
     # Slice to the relevant number of reports (originally 4_838_588, not 4_694_086)
     scores = scores[:n_rows]
     return scores, indices_string
 
 
+def score_fingerprint(drug_indices, scores_path):
+    """
+    Fingerprint of the propensity scores of a drug (or combination) as read
+    by `load_scores_offsides` or `load_scores_nsides`, for recording
+    completed work (see `checkpoint.TaskManifest`). Scores in a store share
+    the fingerprint of the store.
+    """
+    if score_store.is_store(scores_path):
+        return score_store.store_fingerprint(score_store.open_store(scores_path))
+    indices_string = '_'.join(map(str, drug_indices))
+    extension = '.npz' if len(drug_indices) == 1 else '.npy'
+    return checkpoint.file_fingerprint(
+        scores_path.joinpath(indices_string + extension))
+
+
 def compute_multi_exposure(drug_indices, all_exposures):
     """
     Computes a binary vector for multiple exposures. A report has a 1 if it
-    was exposed to all drugs in `drug_indices` and 0 otherwise.
+    was exposed to all drugs in `drug_indices` and 0 otherwise. Reports are
+    found by intersecting the drugs' sorted report indices (see
+    `coexposure.multi_exposure_indices`).
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        Shape is (n_reports x 1)
     """
-    drug_exposures = None
-    for drug_index in drug_indices:
-        exposure = all_exposures[:, drug_index]
-        if drug_exposures is None:
-            drug_exposures = exposure
-        else:
-            drug_exposures = drug_exposures.multiply(exposure)
-    return drug_exposures
+    report_indices = coexposure.multi_exposure_indices(drug_indices,
+                                                       all_exposures)
+    return scipy.sparse.csc_matrix(
+        (np.ones(len(report_indices), dtype=all_exposures.dtype),
+         report_indices, [0, len(report_indices)]),
+        shape=(all_exposures.shape[0], 1)
+    )